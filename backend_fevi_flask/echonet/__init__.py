@@ -2,25 +2,78 @@
 The echonet package contains code for loading echocardiogram videos, and
 functions for training and testing segmentation and ejection fraction
 prediction models.
+
+The ``datasets'' and ``utils'' submodules (and the commands of ``main'') are
+imported on first use, so that importing echonet or reading its config does
+not load PyTorch.
 """
 
+import importlib
+
 import click
 
 from echonet.__version__ import __version__
 from echonet.config import CONFIG as config
-import echonet.datasets as datasets
-import echonet.utils as utils
 
 
-@click.group()
+class _LazyGroup(click.Group):
+    """Group of commands that are only imported when they are invoked.
+
+    ``lazy_commands'' maps each command name to the module defining it (as
+    ``run'') and its short help, which is shown by ``--help'' without
+    importing the module.
+    """
+
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx, cmd_name):
+        if cmd_name not in self.commands and cmd_name in self.lazy_commands:
+            module = importlib.import_module(self.lazy_commands[cmd_name][0])
+            self.add_command(module.run, cmd_name)
+        return super().get_command(ctx, cmd_name)
+
+    def format_commands(self, ctx, formatter):
+        names = self.list_commands(ctx)
+        if not names:
+            return
+        limit = formatter.width - 6 - max(map(len, names))
+
+        rows = []
+        for name in names:
+            if name in self.commands:
+                if self.commands[name].hidden:
+                    continue
+                rows.append((name, self.commands[name].get_short_help_str(limit)))
+            else:
+                rows.append((name, click.utils.make_default_short_help(self.lazy_commands[name][1], limit)))
+        with formatter.section("Commands"):
+            formatter.write_dl(rows)
+
+
+@click.group(cls=_LazyGroup, lazy_commands={
+    "pack": ("echonet.utils.pack", "Decodes a dataset once into a packed store for ``Echo(packed=...)''."),
+    "segmentation": ("echonet.utils.segmentation", "Trains/tests segmentation model."),
+    "stats": ("echonet.utils.stats", "Computes mean and std of a split once and saves them to a file."),
+    "video": ("echonet.utils.video", "Trains/tests EF prediction model."),
+})
 def main():
     """Entry point for command line interface."""
 
 
-del click
+def __getattr__(name):
+    # Submodules are imported on first access (PEP 562)
+    if name in ("datasets", "utils"):
+        return importlib.import_module("echonet." + name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
 
+def __dir__():
+    return sorted(list(globals()) + ["datasets", "utils"])
 
-main.add_command(utils.segmentation.run)
-main.add_command(utils.video.run)
 
 __all__ = ["__version__", "config", "datasets", "main", "utils"]
@@ -21,4 +21,5 @@ for filename in ["echonet.cfg",
 
 CONFIG = types.SimpleNamespace(
     FILENAME=_FILENAME,
-    DATA_DIR=_PARAM.get("data_dir", "a4c-video-dir/"))
+    DATA_DIR=_PARAM.get("data_dir", "a4c-video-dir/"),
+    CACHE_DIR=_PARAM.get("cache_dir", os.path.expanduser("~/.cache/echonet/")))
@@ -1,8 +1,32 @@
 """
 The echonet.datasets submodule defines a Pytorch dataset for loading
 echocardiogram videos.
+
+Classes are imported from their modules on first access, so that PyTorch is
+only loaded when ``Echo'' is used.
 """
 
-from .echo import Echo
+import importlib
+
+_CLASSES = {
+    "Echo": ".echo",
+    "ClipWindows": ".echo",
+    "VideoCache": ".cache",
+    "PackedVideos": ".packed",
+}
+
+
+def __getattr__(name):
+    # PEP 562: import the defining module when a class is first accessed
+    if name in _CLASSES:
+        value = getattr(importlib.import_module(_CLASSES[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_CLASSES))
+
 
-__all__ = ["Echo"]
+__all__ = ["Echo", "ClipWindows", "VideoCache", "PackedVideos"]
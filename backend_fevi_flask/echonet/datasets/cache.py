@@ -0,0 +1,144 @@
+"""Cache of decoded videos."""
+
+import collections
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+import echonet
+
+
+class VideoCache(object):
+    """Cache of decoded videos, with an in-memory LRU tier and an on-disk tier.
+
+    Videos are stored as the uint8 arrays returned by ``echonet.utils.loadvideo''
+    and keyed by absolute path, modification time and size, so a video that is
+    replaced on disk is decoded again.
+
+    The in-memory tier holds at most ``max_bytes'' bytes and evicts the least
+    recently used videos first. It belongs to the process that owns the cache:
+    each DataLoader worker keeps its own copy, so the budget applies per
+    worker (use ``persistent_workers'' to keep it between epochs). The on-disk
+    tier is shared by all processes; entries are written to a temporary file
+    and atomically renamed into place, so concurrent workers never read a
+    partially written video.
+
+    Args:
+        max_bytes (int, optional): Memory budget of the in-memory tier in bytes.
+            If 0, videos are not kept in memory. Defaults to 1 GiB.
+        cache_dir (str or None, optional): Directory of the on-disk tier. If
+            ``None'', there is no on-disk tier. Defaults to ``None''.
+    """
+
+    def __init__(self, max_bytes=2 ** 30, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        self._videos = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Videos held in memory are not sent to worker processes
+        state = self.__dict__.copy()
+        state["_videos"] = collections.OrderedDict()
+        state["_bytes"] = 0
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._videos)
+
+    @property
+    def nbytes(self):
+        """Number of bytes held by the in-memory tier."""
+        return self._bytes
+
+    def loadvideo(self, filename, start=0, stop=None, step=1):
+        """Loads a video through the cache (same arguments as ``echonet.utils.loadvideo'').
+
+        The whole video is decoded and cached on a miss; frame ranges are
+        sliced from the cached array.
+        """
+        return self._get(filename)[:, start:stop:step]
+
+    def videoshape(self, filename):
+        """Returns the shape of a video (same as ``echonet.utils.videoshape'')."""
+        key = self._key(filename)
+        with self._lock:
+            if key in self._videos:
+                return self._videos[key].shape
+        return echonet.utils.videoshape(filename)
+
+    def clear(self):
+        """Empties the in-memory tier (the on-disk tier is kept)."""
+        with self._lock:
+            self._videos.clear()
+            self._bytes = 0
+
+    def _key(self, filename):
+        filename = os.path.abspath(filename)
+        st = os.stat(filename)
+        return hashlib.sha1("{}|{}|{}".format(filename, st.st_mtime_ns, st.st_size).encode()).hexdigest()
+
+    def _get(self, filename):
+        key = self._key(filename)
+        with self._lock:
+            if key in self._videos:
+                self._videos.move_to_end(key)
+                return self._videos[key]
+
+        video = self._load_disk(key)
+        if video is None:
+            video = echonet.utils.loadvideo(filename)
+            self._save_disk(key, video)
+
+        self._put(key, video)
+        return video
+
+    def _put(self, key, video):
+        if video.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._videos:
+                return
+            self._videos[key] = video
+            self._bytes += video.nbytes
+            while self._bytes > self.max_bytes:
+                (_, evicted) = self._videos.popitem(last=False)
+                self._bytes -= evicted.nbytes
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".npy")
+
+    def _load_disk(self, key):
+        if self.cache_dir is None:
+            return None
+        try:
+            return np.load(self._disk_path(key))
+        except (FileNotFoundError, ValueError):
+            # Missing, or not readable as an array
+            return None
+
+    def _save_disk(self, key, video):
+        if self.cache_dir is None:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, video)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
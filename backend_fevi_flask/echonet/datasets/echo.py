@@ -2,10 +2,16 @@
 
 import os
 import collections
+import hashlib
+import io
+import multiprocessing
+import pickle
+import tempfile
 import pandas
 
 import numpy as np
 import skimage.draw
+import torch
 import torchvision
 import echonet
 
@@ -48,13 +54,38 @@ class Echo(torchvision.datasets.VisionDataset):
         max_length (int or None, optional): Maximum number of frames to clip from video (main use is for shortening excessively
             long videos when ``length'' is set to None). If ``None'', shortening is not applied to any video.
             Defaults to 250.
-        clips (int, optional): Number of clips to sample. Main use is for test-time augmentation with random clips.
+        clips (int or ``all'', optional): Number of clips to sample. Main use is for test-time augmentation with random clips.
+            If ``all'', clips are taken according to ``clip_stride'', ``max_clips'' and ``clip_starts''.
             Defaults to 1.
+        clip_stride (int, optional): Distance in frames between the starts of consecutive clips when ``clips'' is ``all''.
+            Defaults to 1 (a clip starting at every frame).
+        max_clips (int or None, optional): Maximum number of clips when ``clips'' is ``all''. Extra clips are subsampled
+            evenly across the video. If ``None'', the number of clips is not limited.
+            Defaults to ``None''.
+        clip_starts (dict or None, optional): Maps filenames to the frames where clips should start when ``clips'' is ``all''
+            (e.g. beats detected by segmentation), for beat-aligned test-time augmentation. Videos that are not in the
+            dict use ``clip_stride''. Defaults to ``None''.
+        keyframes (bool, optional): If True, no clip is taken (an empty video of dimensions (3, 0, height, width) is
+            returned) and only the frames needed by ``LargeFrame'' and ``SmallFrame'' targets are decoded; ``length'',
+            ``period'' and ``clips'' are ignored. Defaults to False.
+        windowed (bool, optional): If True and ``clips'' is ``all'', an ``echonet.datasets.ClipWindows'' is returned
+            instead of an array of clips, so that memory is proportional to the length of the video rather than to
+            the number of clips (use ``ClipWindows.collate'' as the collate function of the DataLoader).
+            Defaults to False.
         pad (int or None, optional): Number of pixels to pad all frames on each side (used as augmentation).
             and a window of the original size is taken. If ``None'', no padding occurs.
             Defaults to ``None''.
         noise (float or None, optional): Fraction of pixels to black out as simulated noise. If ``None'', no simulated noise is added.
             Defaults to ``None''.
+        noise_seed (int or None, optional): Seed for the simulated noise. If given, each video always gets the same noise
+            (seeded by ``noise_seed'' and its index), and the pixels blacked out at a lower ``noise'' are a subset of those
+            at a higher one. If ``None'', noise is drawn from ``np.random''. Defaults to ``None''.
+        packed (str, echonet.datasets.PackedVideos or None, optional): Dataset packed by ``echonet pack''. If given,
+            labels, videos and traces are read from it instead of ``root''. Defaults to ``None''.
+        trace_workers (int, optional): Number of subprocesses used to rasterize the traces (done once, when ``LargeTrace''
+            or ``SmallTrace'' targets are requested). If 0, traces are rasterized in the main process. Defaults to 0.
+        cache (echonet.datasets.VideoCache or None, optional): Cache for decoded videos (used to avoid decoding the
+            same video in every epoch). If ``None'', videos are decoded every time. Defaults to ``None''.
         target_transform (callable, optional): A function/transform that takes in the target and transforms it.
         external_test_location (string): Path to videos to use for external testing.
     """
@@ -65,8 +96,17 @@ class Echo(torchvision.datasets.VisionDataset):
                  length=16, period=2,
                  max_length=250,
                  clips=1,
+                 clip_stride=1,
+                 max_clips=None,
+                 clip_starts=None,
+                 keyframes=False,
+                 windowed=False,
                  pad=None,
                  noise=None,
+                 noise_seed=None,
+                 packed=None,
+                 trace_workers=0,
+                 cache=None,
                  target_transform=None,
                  external_test_location=None,
                  crops="all"):
@@ -85,8 +125,20 @@ class Echo(torchvision.datasets.VisionDataset):
         self.max_length = max_length
         self.period = period
         self.clips = clips
+        self.clip_stride = clip_stride
+        self.max_clips = max_clips
+        self.clip_starts = clip_starts
+        self.keyframes = keyframes
+        self.windowed = windowed
         self.pad = pad
         self.noise = noise
+        self.noise_seed = noise_seed
+        if isinstance(packed, str):
+            packed = echonet.datasets.PackedVideos(packed)
+        self.packed = packed
+        self.masks = None
+        self.cache = cache
+        self._reader = None
         self.target_transform = target_transform
         self.external_test_location = external_test_location
 
@@ -96,7 +148,7 @@ class Echo(torchvision.datasets.VisionDataset):
             self.fnames = sorted(os.listdir(self.external_test_location))
         else:
             # Load video-level labels
-            with open(os.path.join(self.root, "FileList.csv")) as f:
+            with open(os.path.join(self.root if self.packed is None else self.packed.path, "FileList.csv")) as f:
                 data = pandas.read_csv(f)
             data["Split"].map(lambda x: x.upper())
 
@@ -108,78 +160,44 @@ class Echo(torchvision.datasets.VisionDataset):
             self.fnames = [fn + ".avi" for fn in self.fnames if os.path.splitext(fn)[1] == ""]  # Assume avi if no suffix
             self.outcome = data.values.tolist()
 
-            # Check that files are present
-            missing = set(self.fnames) - set(os.listdir(os.path.join(self.root, "Videos")))
-            if len(missing) != 0:
-                print("{} videos could not be found in {}:".format(len(missing), os.path.join(self.root, "Videos")))
-                for f in sorted(missing):
-                    print("\t", f)
-                raise FileNotFoundError(os.path.join(self.root, "Videos", sorted(missing)[0]))
-
-            # Load traces
-            self.frames = collections.defaultdict(list)
-            self.trace = collections.defaultdict(_defaultdict_of_lists)
-
-            with open(os.path.join(self.root, "VolumeTracings.csv")) as f:
-                header = f.readline().strip().split(",")
-                assert header == ["FileName", "X1", "Y1", "X2", "Y2", "Frame"]
-
-                for line in f:
-                    filename, x1, y1, x2, y2, frame = line.strip().split(',')
-                    x1 = float(x1)
-                    y1 = float(y1)
-                    x2 = float(x2)
-                    y2 = float(y2)
-                    frame = int(frame)
-                    if frame not in self.trace[filename]:
-                        self.frames[filename].append(frame)
-                    self.trace[filename][frame].append((x1, y1, x2, y2))
-            for filename in self.frames:
-                for frame in self.frames[filename]:
-                    self.trace[filename][frame] = np.array(self.trace[filename][frame])
+            if self.packed is not None:
+                # Packed datasets already hold the videos and the traced frames
+                missing = set(self.fnames) - set(self.packed.fnames)
+                if len(missing) != 0:
+                    print("{} videos could not be found in {}:".format(len(missing), self.packed.path))
+                    for f in sorted(missing):
+                        print("\t", f)
+                    raise FileNotFoundError(os.path.join(self.packed.path, sorted(missing)[0]))
+
+                self.frames = collections.defaultdict(list, {f: self.packed.traceframes(f) for f in self.fnames})
+                self.trace = None
+            else:
+                # Check that files are present
+                missing = set(self.fnames) - set(os.listdir(os.path.join(self.root, "Videos")))
+                if len(missing) != 0:
+                    print("{} videos could not be found in {}:".format(len(missing), os.path.join(self.root, "Videos")))
+                    for f in sorted(missing):
+                        print("\t", f)
+                    raise FileNotFoundError(os.path.join(self.root, "Videos", sorted(missing)[0]))
+
+                # Load traces
+                self.frames, self.trace, tracings_key = _load_tracings(os.path.join(self.root, "VolumeTracings.csv"))
 
             # A small number of videos are missing traces; remove these videos
             keep = [len(self.frames[f]) >= 2 for f in self.fnames]
             self.fnames = [f for (f, k) in zip(self.fnames, keep) if k]
             self.outcome = [f for (f, k) in zip(self.outcome, keep) if k]
 
-    def __getitem__(self, index):
-        # Find filename of video
-        if self.split == "EXTERNAL_TEST":
-            video = os.path.join(self.external_test_location, self.fnames[index])
-        elif self.split == "CLINICAL_TEST":
-            video = os.path.join(self.root, "ProcessedStrainStudyA4c", self.fnames[index])
-        else:
-            video = os.path.join(self.root, "Videos", self.fnames[index])
-
-        # Load video into np.array
-        video = echonet.utils.loadvideo(video).astype(np.float32)
-
-        # Add simulated noise (black out random pixels)
-        # 0 represents black at this point (video has not been normalized yet)
-        if self.noise is not None:
-            n = video.shape[1] * video.shape[2] * video.shape[3]
-            ind = np.random.choice(n, round(self.noise * n), replace=False)
-            f = ind % video.shape[1]
-            ind //= video.shape[1]
-            i = ind % video.shape[2]
-            ind //= video.shape[2]
-            j = ind
-            video[:, f, i, j] = 0
-
-        # Apply normalization
-        if isinstance(self.mean, (float, int)):
-            video -= self.mean
-        else:
-            video -= self.mean.reshape(3, 1, 1, 1)
-
-        if isinstance(self.std, (float, int)):
-            video /= self.std
-        else:
-            video /= self.std.reshape(3, 1, 1, 1)
+            if self.packed is None and len(self.fnames) != 0 and ("LargeTrace" in self.target_type or "SmallTrace" in self.target_type):
+                # Rasterize all traces once, assuming every video has the size of the first one
+                _, _, h, w = self._video_shape(0)
+                self._close_reader()
+                self.mask_shape = (h, w)
+                self.mask_index, self.masks = _load_trace_masks(self.frames, self.trace, self.mask_shape, tracings_key, trace_workers)
 
+    def __getitem__(self, index):
         # Set number of frames
-        c, f, h, w = video.shape
+        c, f, h, w = self._video_shape(index)
         if self.length is None:
             # Take as many frames as possible
             length = f // self.period
@@ -191,49 +209,81 @@ class Echo(torchvision.datasets.VisionDataset):
             # Shorten videos to max_length
             length = min(length, self.max_length)
 
-        if f < length * self.period:
-            # Pad video with frames filled with zeros if too short
-            # 0 represents the mean color (dark grey), since this is after normalization
-            video = np.concatenate((video, np.zeros((c, length * self.period - f, h, w), video.dtype)), axis=1)
-            c, f, h, w = video.shape  # pylint: disable=E0633
+        # Videos that are too short are padded with frames filled with zeros
+        total = max(f, length * self.period)
+
+        key = self.fnames[index]
+        frame_targets = "LargeFrame" in self.target_type or "SmallFrame" in self.target_type
 
-        if self.clips == "all":
-            # Take all possible clips of desired length
-            start = np.arange(f - (length - 1) * self.period)
+        if self.keyframes:
+            # No clip is taken
+            pass
+        elif self.clips == "all":
+            # Take all possible clips of desired length (as allowed by the test-time augmentation policy)
+            starts = None if self.clip_starts is None else self.clip_starts.get(key)
+            start = echonet.utils.select_clips(total - (length - 1) * self.period, self.clip_stride, self.max_clips, starts)
         else:
             # Take random clips from video
-            start = np.random.choice(f - (length - 1) * self.period, self.clips)
+            start = np.random.choice(total - (length - 1) * self.period, self.clips)
+
+        # Only decode the frames the clips need (frames lo, lo + step, ..., < hi)
+        if self.keyframes:
+            # Only the small and large frames (if used as targets)
+            small, large = (self.frames[key][0], self.frames[key][-1]) if frame_targets else (0, 0)
+            lo, hi = min(small, large), max(small, large) + 1
+            step = max(hi - 1 - lo, 1)
+            if not frame_targets:
+                hi = lo
+        elif self.clips == "all" or frame_targets:
+            # Full-frame targets index into the whole video, so it is decoded entirely
+            lo, hi, step = 0, total, 1
+        else:
+            lo = start.min()
+            hi = start.max() + (length - 1) * self.period + 1
+            step = self.period if np.all(start % self.period == lo % self.period) else 1
+
+        # Load (uint8) frames into np.array
+        video = self._load_video(index, lo, min(hi, f), step)
+
+        # Add simulated noise (black out random pixels)
+        # 0 represents black at this point (video has not been normalized yet)
+        if self.noise is not None:
+            # Each pixel is blacked out independently with probability ``noise''
+            if self.noise_seed is None:
+                rng = np.random.default_rng(np.random.randint(2 ** 32, dtype=np.uint64))
+            else:
+                rng = np.random.default_rng((self.noise_seed, index))
+            video = video * (rng.random(video.shape[1:], dtype=np.float32) >= self.noise)
 
         # Gather targets
         target = []
         for t in self.target_type:
-            key = self.fnames[index]
             if t == "Filename":
                 target.append(self.fnames[index])
             elif t == "LargeIndex":
                 # Traces are sorted by cross-sectional area
                 # Largest (diastolic) frame is last
-                target.append(np.int(self.frames[key][-1]))
+                target.append(int(self.frames[key][-1]))
             elif t == "SmallIndex":
                 # Largest (diastolic) frame is first
-                target.append(np.int(self.frames[key][0]))
+                target.append(int(self.frames[key][0]))
             elif t == "LargeFrame":
-                target.append(video[:, self.frames[key][-1], :, :])
+                target.append(self._normalize(video[:, (self.frames[key][-1] - lo) // step, :, :]))
             elif t == "SmallFrame":
-                target.append(video[:, self.frames[key][0], :, :])
+                target.append(self._normalize(video[:, (self.frames[key][0] - lo) // step, :, :]))
             elif t in ["LargeTrace", "SmallTrace"]:
+                if self.packed is not None:
+                    target.append(self.packed.trace(key, t == "LargeTrace"))
+                    continue
+                if self.masks is not None and (h, w) == self.mask_shape:
+                    mask = np.unpackbits(self.masks[self.mask_index[key], int(t == "LargeTrace")], count=h * w)
+                    target.append(mask.reshape(h, w).astype(np.float32))
+                    continue
                 if t == "LargeTrace":
                     t = self.trace[key][self.frames[key][-1]]
                 else:
                     t = self.trace[key][self.frames[key][0]]
-                x1, y1, x2, y2 = t[:, 0], t[:, 1], t[:, 2], t[:, 3]
-                x = np.concatenate((x1[1:], np.flip(x2[1:])))
-                y = np.concatenate((y1[1:], np.flip(y2[1:])))
-
-                r, c = skimage.draw.polygon(np.rint(y).astype(np.int), np.rint(x).astype(np.int), (video.shape[2], video.shape[3]))
-                mask = np.zeros((video.shape[2], video.shape[3]), np.float32)
-                mask[r, c] = 1
-                target.append(mask)
+                target.append(trace_mask(t, (h, w)))
             else:
                 if self.split == "CLINICAL_TEST" or self.split == "EXTERNAL_TEST":
                     target.append(np.float32(0))
@@ -246,24 +296,114 @@ class Echo(torchvision.datasets.VisionDataset):
                 target = self.target_transform(target)
 
         # Select clips from video
-        video = tuple(video[:, s + self.period * np.arange(length), :, :] for s in start)
-        if self.clips == 1:
-            video = video[0]
+        # Clips are gathered, normalized, and padded/cropped (used as augmentation) directly
+        # into a single output, where 0 represents the mean color (dark grey) after normalization
+        if self.keyframes:
+            windows = None
+            start, length, period = np.zeros(0, np.int64), 0, self.period
+        elif self.windowed and self.clips == "all":
+            # The whole video is kept once, and clips are gathered from it when needed
+            windows = ClipWindows(None, start, length, self.period)
+            start, length, period = np.zeros(1, np.int64), total, 1
         else:
-            video = np.stack(video)
+            windows = None
+            period = self.period
+        output = np.zeros((len(start), c, length, h, w), np.float32)
 
+        # Shift of the crop of the original size taken out of the frames padded with zeros
+        di = dj = 0
         if self.pad is not None:
-            # Add padding of zeros (mean color of videos)
-            # Crop of original size is taken out
-            # (Used as augmentation)
-            c, l, h, w = video.shape
-            temp = np.zeros((c, l, h + 2 * self.pad, w + 2 * self.pad), dtype=video.dtype)
-            temp[:, :, self.pad:-self.pad, self.pad:-self.pad] = video  # pylint: disable=E1130
             i, j = np.random.randint(0, 2 * self.pad, 2)
-            video = temp[:, :, i:(i + h), j:(j + w)]
+            di, dj = self.pad - i, self.pad - j
+
+        for (k, s) in enumerate(start):
+            # Frames past the end of the video are left as padding
+            frames = (s - lo) // step + (period // step) * np.arange(length)
+            frames = frames[frames < video.shape[1]]
+            clip = output[k, :, :len(frames), max(di, 0):(h + min(di, 0)), max(dj, 0):(w + min(dj, 0))]
+            clip[...] = video[:, frames, max(-di, 0):(h + min(-di, 0)), max(-dj, 0):(w + min(-dj, 0))]
+            self._normalize(clip, out=clip)
+
+        if windows is not None:
+            windows.video = output[0]
+            video = windows
+        elif self.clips == 1 or self.keyframes:
+            video = output[0] if len(output) != 0 else np.zeros((c, 0, h, w), np.float32)
+        else:
+            video = output
 
         return video, target
 
+    def _normalize(self, video, out=None):
+        """Converts frames with dimensions (channels=3, ...) to float32 and normalizes them by ``mean'' and ``std''."""
+        if out is None:
+            out = video.astype(np.float32)
+        shape = (3,) + (1,) * (video.ndim - 1)
+
+        if isinstance(self.mean, (float, int)):
+            out -= self.mean
+        else:
+            out -= self.mean.reshape(shape)
+
+        if isinstance(self.std, (float, int)):
+            out /= self.std
+        else:
+            out /= self.std.reshape(shape)
+        return out
+
+    def _video_path(self, index):
+        """Returns the path of the ``index''-th video."""
+        if self.split == "EXTERNAL_TEST":
+            return os.path.join(self.external_test_location, self.fnames[index])
+        if self.split == "CLINICAL_TEST":
+            return os.path.join(self.root, "ProcessedStrainStudyA4c", self.fnames[index])
+        return os.path.join(self.root, "Videos", self.fnames[index])
+
+    def __getstate__(self):
+        # Open videos are not sent to worker processes
+        state = self.__dict__.copy()
+        state["_reader"] = None
+        return state
+
+    def _close_reader(self):
+        if self._reader is not None:
+            self._reader[1].close()
+            self._reader = None
+
+    def _video_shape(self, index):
+        """Returns the shape (channels=3, frames, height, width) of the ``index''-th video.
+
+        AVIs are left open for the ``_load_video'' call that follows in
+        ``__getitem__'', so that each video is only opened once.
+        """
+        if self.packed is not None:
+            return self.packed.videoshape(self.fnames[index])
+        if self.cache is not None:
+            return self.cache.videoshape(self._video_path(index))
+        self._close_reader()
+        self._reader = (index, echonet.utils.VideoReader(self._video_path(index)))
+        return self._reader[1].shape
+
+    def _load_video(self, index, start=0, stop=None, step=1):
+        """Loads frames ``start'', ``start + step'', ... (up to ``stop'') of the ``index''-th video.
+
+        Subclasses can override this (together with ``_video_shape'') to serve
+        videos that were already decoded.
+
+        Returns:
+            A np.ndarray of uint8's with dimensions (channels=3, frames, height, width).
+        """
+        if self.packed is not None:
+            return self.packed.loadvideo(self.fnames[index], start, stop, step)
+        if self.cache is not None:
+            return self.cache.loadvideo(self._video_path(index), start, stop, step)
+        if self._reader is not None and self._reader[0] == index:
+            reader = self._reader[1]
+            self._reader = None
+            with reader:
+                return reader.loadvideo(start, stop, step)
+        return echonet.utils.loadvideo(self._video_path(index), start, stop, step)
+
     def __len__(self):
         return len(self.fnames)
 
@@ -273,6 +413,200 @@ class Echo(torchvision.datasets.VisionDataset):
         return '\n'.join(lines).format(**self.__dict__)
 
 
+class ClipWindows(object):
+    """Clips of a video that are only gathered when needed.
+
+    Holds a normalized video once, together with the frames where clips
+    start; clip ``k'' consists of frames ``start[k] + period * i'' for
+    ``i'' in ``range(length)''. Behaves like an array with dimensions
+    (clips, channels=3, length, height, width) when converted with
+    ``np.asarray''.
+
+    Args:
+        video (np.array shape=(3, frames, height, width)): normalized video
+        start (np.array): first frame of each clip
+        length (int): number of frames in each clip
+        period (int): sampling period of the frames of a clip
+    """
+
+    def __init__(self, video, start, length, period):
+        self.video = video
+        self.start = np.asarray(start)
+        self.length = length
+        self.period = period
+
+    def __len__(self):
+        return len(self.start)
+
+    @property
+    def shape(self):
+        c, _, h, w = self.video.shape
+        return (len(self), c, self.length, h, w)
+
+    def subset(self, index):
+        """Returns the windows of clips ``index'' (anything that can index ``start'')."""
+        return ClipWindows(self.video, self.start[index], self.length, self.period)
+
+    def clips(self, video=None, start=0, stop=None):
+        """Gathers clips ``start'' to ``stop''.
+
+        Args:
+            video (np.array, torch.Tensor or None, optional): copy of ``video''
+                to gather from (e.g. a tensor already moved to the GPU).
+                Defaults to ``video''.
+            start (int, optional): first clip. Defaults to 0.
+            stop (int or None, optional): clip after the last one. Defaults to all clips.
+
+        Returns:
+            An array (or tensor, if ``video'' is a tensor) with dimensions
+            (clips, channels=3, length, height, width).
+        """
+        if video is None:
+            video = self.video
+        frames = self.start[start:stop].reshape(-1, 1) + self.period * np.arange(self.length)
+        if isinstance(video, torch.Tensor):
+            return video[:, torch.as_tensor(frames, device=video.device)].transpose(0, 1).contiguous()
+        return np.ascontiguousarray(video[:, frames].swapaxes(0, 1))
+
+    def __array__(self, dtype=None, copy=None):
+        clips = self.clips()
+        return clips if dtype is None else clips.astype(dtype)
+
+    @staticmethod
+    def collate(batch):
+        """Collates (ClipWindows, target) samples into a list of ClipWindows and a batch of targets."""
+        windows, target = zip(*batch)
+        return list(windows), torch.utils.data.default_collate(list(target))
+
+
+def trace_mask(trace, shape):
+    """Rasterizes a trace of the left ventricle into a mask.
+
+    Args:
+        trace (np.array shape=(n, 4)): rows of (x1, y1, x2, y2) from VolumeTracings.csv
+            (the first row is the long axis, the rest are the left and right borders)
+        shape (tuple of ints): (height, width) of the mask
+
+    Returns:
+        A np.array of float32's with dimensions ``shape''; 1 inside the left ventricle and 0 outside.
+    """
+
+    x1, y1, x2, y2 = trace[:, 0], trace[:, 1], trace[:, 2], trace[:, 3]
+    x = np.concatenate((x1[1:], np.flip(x2[1:])))
+    y = np.concatenate((y1[1:], np.flip(y2[1:])))
+
+    r, c = skimage.draw.polygon(np.rint(y).astype(int), np.rint(x).astype(int), shape)
+    mask = np.zeros(shape, np.float32)
+    mask[r, c] = 1
+    return mask
+
+
+def _load_tracings(filename):
+    """Loads the traces of VolumeTracings.csv.
+
+    The rows are grouped by video and frame with pandas, and the grouped
+    arrays are cached (as a pickle keyed by the hash of the file) in
+    ``echonet.config.CACHE_DIR'', so later loads skip parsing.
+
+    Returns:
+        A tuple (frames, trace, key). ``frames[filename]'' lists the traced
+        frames of a video in the order they appear in the file,
+        ``trace[filename][frame]'' is a np.array with rows (x1, y1, x2, y2),
+        and ``key'' is the hash of the file.
+    """
+
+    with open(filename, "rb") as f:
+        data = f.read()
+    key = hashlib.sha1(data).hexdigest()
+    cache = os.path.join(echonet.config.CACHE_DIR, "VolumeTracings-{}.pkl".format(key))
+
+    try:
+        with open(cache, "rb") as f:
+            filenames, group_file, group_frame, offsets, coords = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        tracings = pandas.read_csv(io.BytesIO(data))
+        assert tracings.columns.tolist() == ["FileName", "X1", "Y1", "X2", "Y2", "Frame"]
+
+        # Group rows by (video, frame), numbering groups in order of first appearance
+        file_code, filenames = pandas.factorize(tracings["FileName"])
+        frame = tracings["Frame"].values.astype(np.int64)
+        group, keys = pandas.factorize(file_code * (frame.max() + 1) + frame)
+        group_file = keys // (frame.max() + 1)
+        group_frame = keys % (frame.max() + 1)
+
+        order = np.argsort(group, kind="stable")
+        coords = tracings[["X1", "Y1", "X2", "Y2"]].values.astype(np.float64)[order]
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(group, minlength=len(keys)))))
+        filenames = np.asarray(filenames, dtype=object)
+
+        try:
+            os.makedirs(echonet.config.CACHE_DIR, exist_ok=True)
+            (fd, tmp) = tempfile.mkstemp(dir=echonet.config.CACHE_DIR, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump((filenames, group_file, group_frame, offsets, coords), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache)
+        except OSError:
+            # Caching is only an optimization
+            pass
+
+    frames = collections.defaultdict(list)
+    trace = collections.defaultdict(_defaultdict_of_lists)
+    for (f, frame, start, stop) in zip(filenames[group_file].tolist(), group_frame.tolist(), offsets[:-1].tolist(), offsets[1:].tolist()):
+        frames[f].append(frame)
+        trace[f][frame] = coords[start:stop]
+
+    return frames, trace, key
+
+
+def _load_trace_masks(frames, trace, shape, key, num_workers=0):
+    """Rasterizes the small and large trace of every traced video into bit-packed masks.
+
+    The masks are cached in ``echonet.config.CACHE_DIR'', keyed by the hash
+    of VolumeTracings.csv and the mask shape.
+
+    Returns:
+        A tuple (index, masks). ``masks[index[filename], 0]'' is the small
+        (systolic) mask and ``masks[index[filename], 1]'' the large (diastolic)
+        mask, as produced by ``np.packbits'' on the flattened mask.
+    """
+
+    cache = os.path.join(echonet.config.CACHE_DIR, "VolumeTracings-{}-{}x{}.npz".format(key, *shape))
+    try:
+        with np.load(cache) as data:
+            fnames, masks = data["fnames"].tolist(), data["masks"]
+    except (OSError, KeyError, ValueError):
+        fnames = sorted(f for f in frames if len(frames[f]) >= 2)
+        traces = [(trace[f][frames[f][0]], trace[f][frames[f][-1]]) for f in fnames]
+        if num_workers > 0 and len(traces) != 0:
+            chunks = np.array_split(np.arange(len(traces)), num_workers * 4)
+            with multiprocessing.Pool(num_workers) as pool:
+                masks = pool.starmap(_rasterize_traces, [([traces[i] for i in c], shape) for c in chunks])
+            masks = np.concatenate(masks)
+        else:
+            masks = _rasterize_traces(traces, shape)
+
+        try:
+            os.makedirs(echonet.config.CACHE_DIR, exist_ok=True)
+            (fd, tmp) = tempfile.mkstemp(dir=echonet.config.CACHE_DIR, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, fnames=np.array(fnames), masks=masks)
+            os.replace(tmp, cache)
+        except OSError:
+            # Caching is only an optimization
+            pass
+
+    return {f: i for (i, f) in enumerate(fnames)}, masks
+
+
+def _rasterize_traces(traces, shape):
+    """Rasterizes (small, large) pairs of traces into bit-packed masks."""
+    masks = np.zeros((len(traces), 2, (shape[0] * shape[1] + 7) // 8), np.uint8)
+    for (i, pair) in enumerate(traces):
+        for (j, t) in enumerate(pair):
+            masks[i, j] = np.packbits(trace_mask(t, shape).astype(np.uint8))
+    return masks
+
+
 def _defaultdict_of_lists():
     """Returns a defaultdict of lists.
 
@@ -0,0 +1,76 @@
+"""Packed, memory-mapped copy of the EchoNet-Dynamic dataset."""
+
+import os
+
+import numpy as np
+
+
+class PackedVideos(object):
+    """Videos and trace masks of a dataset packed by ``echonet pack''.
+
+    A packed dataset is a directory with:
+        ``FileList.csv'': copy of the video-level labels
+        ``videos.u8'': the uint8 videos, each stored contiguously with
+            dimensions (channels=3, frames, height, width)
+        ``index.npz'': filenames, byte offsets and frame counts of the videos,
+            the small (systolic) and large (diastolic) traced frames, and the
+            traces rasterized as bit-packed masks
+
+    Videos are served as read-only views of a ``np.memmap'', so nothing is
+    decoded or copied and processes reading the same dataset share pages
+    through the OS cache. The memory map is opened lazily in each process.
+
+    Args:
+        path (str): Directory of the packed dataset.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with np.load(os.path.join(path, "index.npz")) as index:
+            self.fnames = index["fnames"].tolist()
+            self.offsets = index["offsets"]
+            self.frames = index["frames"]
+            self.height = int(index["height"])
+            self.width = int(index["width"])
+            self.small = index["small"]
+            self.large = index["large"]
+            self.masks = index["masks"]
+        self._index = {f: i for (i, f) in enumerate(self.fnames)}
+        self._videos = None
+
+    def __getstate__(self):
+        # The memory map is reopened by each worker instead of being copied
+        state = self.__dict__.copy()
+        state["_videos"] = None
+        return state
+
+    def __contains__(self, filename):
+        return filename in self._index
+
+    @property
+    def videos(self):
+        if self._videos is None:
+            self._videos = np.memmap(os.path.join(self.path, "videos.u8"), dtype=np.uint8, mode="r")
+        return self._videos
+
+    def videoshape(self, filename):
+        """Returns the shape (channels=3, frames, height, width) of a video."""
+        return 3, int(self.frames[self._index[filename]]), self.height, self.width
+
+    def loadvideo(self, filename, start=0, stop=None, step=1):
+        """Returns frames ``start'', ``start + step'', ... (up to ``stop'') of a video as a read-only view."""
+        i = self._index[filename]
+        shape = self.videoshape(filename)
+        video = self.videos[self.offsets[i]:self.offsets[i] + np.prod(shape)].reshape(shape)
+        return video[:, start:stop:step]
+
+    def traceframes(self, filename):
+        """Returns the traced frames of a video, small (systolic) first, as in ``Echo.frames''."""
+        i = self._index[filename]
+        return [int(self.small[i]), int(self.large[i])]
+
+    def trace(self, filename, large):
+        """Returns the large (if ``large'') or small trace of a video as a float32 mask."""
+        mask = np.unpackbits(self.masks[self._index[filename], int(large)], count=self.height * self.width)
+        return mask.reshape(self.height, self.width).astype(np.float32)
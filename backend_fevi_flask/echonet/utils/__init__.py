@@ -1,54 +1,207 @@
-"""Utility functions for videos, plotting and computing performance metrics."""
+"""Utility functions for videos, plotting and computing performance metrics.
 
+The ``video'', ``segmentation'', ``stats'', ``pack'' and ``render''
+submodules, as well as PyTorch, scikit-learn and matplotlib, are only
+imported when needed.
+"""
+
+import importlib
+import multiprocessing
 import os
+import queue
+import sys
+import threading
 import typing
 
+import click
 import cv2  # pytype: disable=attribute-error
-import matplotlib
 import numpy as np
-import torch
 import tqdm
 
-from . import video
-from . import segmentation
+_SUBMODULES = ("video", "segmentation", "stats", "pack", "render")
 
+# Gaps of more frames than this are skipped by seeking rather than grabbing.
+# OpenCV's FFmpeg backend seeks to a frame about 16 frames before the target
+# and decodes from there, so a seek costs about as much as grabbing 16 frames.
+_MAX_GRAB = 16
 
-def loadvideo(filename: str) -> np.ndarray:
-    """Loads a video from a file.
+
+def __getattr__(name):
+    # Submodules are imported on first access (PEP 562)
+    if name in _SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_SUBMODULES))
+
+
+class VideoReader(object):
+    """A video file opened once to read its shape and then its frames.
+
+    Reading the shape with ``videoshape'' and the frames with ``loadvideo''
+    opens and probes the file twice; a reader does both with a single
+    ``cv2.VideoCapture''. Frames may be read in several calls; gaps of more
+    than 16 frames (before ``start'' or between requested frames) are skipped
+    by seeking when the container allows it, and shorter gaps are grabbed
+    without the frames being retrieved or converted.
+
+    Args:
+        filename (str): filename of video
+
+    Attributes:
+        shape (tuple): (channels=3, frames, height, width), matching the shape
+            returned by ``loadvideo''
+
+    Raises:
+        FileNotFoundError: Could not find `filename`
+    """
+
+    def __init__(self, filename: str):
+        if not os.path.exists(filename):
+            raise FileNotFoundError(filename)
+        self.filename = filename
+        self._capture = cv2.VideoCapture(filename)
+        self._position = 0
+        self.shape = (3,
+                      int(self._capture.get(cv2.CAP_PROP_FRAME_COUNT)),
+                      int(self._capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                      int(self._capture.get(cv2.CAP_PROP_FRAME_WIDTH)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._capture.release()
+
+    def iterframes(self, start: int = 0, stop: typing.Optional[int] = None, step: int = 1,
+                   max_frames: typing.Optional[int] = None) -> typing.Iterator[np.ndarray]:
+        """Iterates over the frames of the video (same arguments as ``echonet.utils.iterframes'')."""
+
+        if step < 1:
+            raise ValueError("step must be positive, got {}".format(step))
+        stop = self.shape[1] if stop is None else min(stop, self.shape[1])
+        if max_frames is not None:
+            stop = min(stop, start + max_frames * step)
+
+        for count in range(start, stop, step):
+            # Seek back or over long gaps; fall back to grabbing frames if seeking is not supported
+            if ((count < self._position or count - self._position > _MAX_GRAB)
+                    and self._capture.set(cv2.CAP_PROP_POS_FRAMES, count)):
+                self._position = int(self._capture.get(cv2.CAP_PROP_POS_FRAMES))
+            if self._position > count:
+                raise ValueError("Failed to seek to frame #{} of {}.".format(count, self.filename))
+
+            while self._position < count:
+                if not self._capture.grab():
+                    raise ValueError("Failed to load frame #{} of {}.".format(self._position, self.filename))
+                self._position += 1
+
+            ret, frame = self._capture.read()
+            if not ret:
+                raise ValueError("Failed to load frame #{} of {}.".format(count, self.filename))
+            self._position += 1
+
+            yield cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+    def loadvideo(self, start: int = 0, stop: typing.Optional[int] = None, step: int = 1,
+                  max_frames: typing.Optional[int] = None) -> np.ndarray:
+        """Loads frames of the video (same arguments and result as ``echonet.utils.loadvideo'')."""
+
+        _, frame_count, frame_height, frame_width = self.shape
+
+        stop = frame_count if stop is None else min(stop, frame_count)
+        count = len(range(start, stop, step))
+        if max_frames is not None:
+            count = min(count, max_frames)
+
+        v = np.zeros((count, frame_height, frame_width, 3), np.uint8)
+
+        for (i, frame) in enumerate(self.iterframes(start, stop, step, count)):
+            v[i, :, :] = frame
+
+        v = v.transpose((3, 0, 1, 2))
+
+        return v
+
+
+def videoshape(filename: str) -> typing.Tuple[int, int, int, int]:
+    """Reads the dimensions of a video without decoding it.
 
     Args:
         filename (str): filename of video
 
     Returns:
-        A np.ndarray with dimensions (channels=3, frames, height, width). The
-        values will be uint8's ranging from 0 to 255.
+        A tuple (channels=3, frames, height, width), matching the shape
+        returned by ``loadvideo''.
+
+    Raises:
+        FileNotFoundError: Could not find `filename`
+    """
+
+    with VideoReader(filename) as reader:
+        return reader.shape
+
+
+def iterframes(filename: str, start: int = 0, stop: typing.Optional[int] = None, step: int = 1,
+               max_frames: typing.Optional[int] = None) -> typing.Iterator[np.ndarray]:
+    """Iterates over the frames of a video, decoding only the frames requested.
+
+    Gaps of more than 16 frames (before ``start'' or between requested
+    frames) are skipped by seeking when the container allows it; shorter
+    gaps are grabbed without the frames being retrieved or converted.
+
+    Args:
+        filename (str): filename of video
+        start (int, optional): index of first frame. Defaults to 0.
+        stop (int or None, optional): index after the last frame. If ``None'',
+            iterates until the end of the video. Defaults to ``None''.
+        step (int, optional): only every ``step''-th frame is returned.
+            Defaults to 1.
+        max_frames (int or None, optional): maximum number of frames to return.
+            Defaults to ``None'' (no limit).
+
+    Yields:
+        np.ndarray's of uint8's with dimensions (height, width, channels=3) in RGB order.
 
     Raises:
         FileNotFoundError: Could not find `filename`
         ValueError: An error occurred while reading the video
     """
 
-    if not os.path.exists(filename):
-        raise FileNotFoundError(filename)
-    capture = cv2.VideoCapture(filename)
+    with VideoReader(filename) as reader:
+        yield from reader.iterframes(start, stop, step, max_frames)
 
-    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
-    frame_width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
-    v = np.zeros((frame_count, frame_height, frame_width, 3), np.uint8)
+def loadvideo(filename: str, start: int = 0, stop: typing.Optional[int] = None, step: int = 1,
+              max_frames: typing.Optional[int] = None) -> np.ndarray:
+    """Loads a video from a file.
 
-    for count in range(frame_count):
-        ret, frame = capture.read()
-        if not ret:
-            raise ValueError("Failed to load frame #{} of {}.".format(count, filename))
+    Args:
+        filename (str): filename of video
+        start (int, optional): index of first frame to load. Defaults to 0.
+        stop (int or None, optional): index after the last frame to load. If
+            ``None'', loads until the end of the video. Defaults to ``None''.
+        step (int, optional): only every ``step''-th frame is loaded.
+            Defaults to 1.
+        max_frames (int or None, optional): maximum number of frames to load.
+            Defaults to ``None'' (no limit).
 
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        v[count, :, :] = frame
+    Returns:
+        A np.ndarray with dimensions (channels=3, frames, height, width). The
+        values will be uint8's ranging from 0 to 255.
 
-    v = v.transpose((3, 0, 1, 2))
+    Raises:
+        FileNotFoundError: Could not find `filename`
+        ValueError: An error occurred while reading the video
+    """
 
-    return v
+    with VideoReader(filename) as reader:
+        return reader.loadvideo(start, stop, step, max_frames)
 
 
 def savevideo(filename: str, array: np.ndarray, fps: typing.Union[float, int] = 1):
@@ -73,9 +226,71 @@ def savevideo(filename: str, array: np.ndarray, fps: typing.Union[float, int] =
     for frame in array.transpose((1, 2, 3, 0)):
         frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
         out.write(frame)
+    out.release()
+
+
+class BackgroundEncoder(object):
+    """Runs video writes (e.g. ``savevideo'') on a background thread.
 
+    ``submit'' puts a call on a bounded queue and returns at once, so the
+    caller can prepare the next video while the previous one is encoded. It
+    blocks while ``max_pending'' calls are waiting, which bounds the memory
+    held by queued videos. Leaving the ``with'' block (or ``close'') waits
+    for all writes and re-raises the first error; calls queued after an
+    error are skipped.
 
-def get_mean_and_std(dataset: torch.utils.data.Dataset,
+    Args:
+        max_pending (int, optional): Number of calls that can wait in the
+            queue. Defaults to 2.
+    """
+
+    def __init__(self, max_pending=2):
+        self._queue = queue.Queue(max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not mask the error raised in the block
+            self._join()
+
+    def submit(self, func, *args, **kwargs):
+        """Queues ``func(*args, **kwargs)''."""
+        if self._error is not None:
+            raise self._error
+        self._queue.put((func, args, kwargs))
+
+    def close(self):
+        """Waits for all queued calls and re-raises the first error."""
+        self._join()
+        if self._error is not None:
+            raise self._error
+
+    def _join(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            (func, args, kwargs) = item
+            if self._error is None:
+                try:
+                    func(*args, **kwargs)
+                except BaseException as e:  # pylint: disable=broad-except
+                    self._error = e
+
+
+def get_mean_and_std(dataset: "torch.utils.data.Dataset",
                      samples: int = 128,
                      batch_size: int = 8,
                      num_workers: int = 4):
@@ -97,6 +312,7 @@ def get_mean_and_std(dataset: torch.utils.data.Dataset,
     Returns:
        A tuple of the mean and standard deviation. Both are represented as np.array's of dimension (channels,).
     """
+    import torch
 
     if samples is not None and len(dataset) > samples:
         indices = np.random.choice(len(dataset), samples, replace=False)
@@ -121,17 +337,95 @@ def get_mean_and_std(dataset: torch.utils.data.Dataset,
     return mean, std
 
 
-def bootstrap(a, b, func, samples=10000):
+def save_mean_and_std(filename: str, mean: np.ndarray, std: np.ndarray):
+    """Saves normalization statistics to a file.
+
+    Args:
+        filename (str): filename of the statistics file (``.npz'')
+        mean (np.ndarray): mean of each channel, with dimension (channels,)
+        std (np.ndarray): standard deviation of each channel, with dimension (channels,)
+
+    Returns:
+        None
+    """
+
+    np.savez(filename, mean=np.asarray(mean, np.float32), std=np.asarray(std, np.float32))
+
+
+def load_mean_and_std(filename: str):
+    """Loads normalization statistics saved by ``save_mean_and_std''.
+
+    Args:
+        filename (str): filename of the statistics file (``.npz'')
+
+    Returns:
+       A tuple of the mean and standard deviation. Both are represented as np.array's of dimension (channels,).
+
+    Raises:
+        FileNotFoundError: Could not find `filename`
+    """
+
+    with np.load(filename) as data:
+        mean = data["mean"].astype(np.float32)
+        std = data["std"].astype(np.float32)
+
+    return mean, std
+
+
+def select_clips(n, stride=1, max_clips=None, starts=None):
+    """Selects the start frames of the clips used for test-time augmentation.
+
+    Args:
+        n (int): number of possible clip starts (frames 0, ..., n - 1)
+        stride (int, optional): distance in frames between consecutive clip starts.
+            Defaults to 1 (every start frame).
+        max_clips (int or None, optional): maximum number of clips. If more clips
+            are selected, they are subsampled evenly across the video. If ``None'',
+            the number of clips is not limited.
+            Defaults to ``None''.
+        starts (array_like or None, optional): candidate start frames (for example
+            beats detected by segmentation). Starts outside of the video are
+            dropped, and ``stride'' is not applied. If ``None'' or if no candidate
+            is left, starts are taken every ``stride'' frames.
+            Defaults to ``None''.
+
+    Returns:
+        A np.ndarray of sorted start frames.
+    """
+
+    start = None
+    if starts is not None:
+        start = np.unique(np.asarray(starts, dtype=np.int64))
+        start = start[(start >= 0) & (start < n)]
+    if start is None or start.size == 0:
+        start = np.arange(0, n, stride)
+
+    if max_clips is not None and start.size > max_clips:
+        start = start[np.round(np.linspace(0, start.size - 1, max_clips)).astype(np.int64)]
+
+    return start
+
+
+def bootstrap(a, b, func, samples=10000, chunk_size=1000, num_workers=0):
     """Computes a bootstrapped confidence intervals for ``func(a, b)''.
 
+    The resample indices are drawn as a matrix, ``chunk_size'' resamples at a
+    time. ``sklearn.metrics.r2_score'', ``sklearn.metrics.mean_absolute_error'',
+    ``sklearn.metrics.mean_squared_error'' and ``dice_similarity_coefficient''
+    are computed on a whole chunk at once; other functions are called on each
+    resample.
+
     Args:
         a (array_like): first argument to `func`.
         b (array_like): second argument to `func`.
         func (callable): Function to compute confidence intervals for.
-            ``dataset[i][0]'' is expected to be the i-th video in the dataset, which
-            should be a ``torch.Tensor'' of dimensions (channels=3, frames, height, width)
         samples (int, optional): Number of samples to compute.
             Defaults to 10000.
+        chunk_size (int, optional): Number of resamples to draw and evaluate
+            at the same time (limits memory). Defaults to 1000.
+        num_workers (int, optional): Number of subprocesses to evaluate
+            functions without a vectorized form (``func'' must be picklable).
+            If 0, they are evaluated in the main process. Defaults to 0.
 
     Returns:
        A tuple of (`func(a, b)`, estimated 5-th percentile, estimated 95-th percentile).
@@ -139,15 +433,52 @@ def bootstrap(a, b, func, samples=10000):
     a = np.array(a)
     b = np.array(b)
 
-    bootstraps = []
-    for _ in range(samples):
-        ind = np.random.choice(len(a), len(a))
-        bootstraps.append(func(a[ind], b[ind]))
-    bootstraps = sorted(bootstraps)
+    # Same resamples as drawing them one at a time with np.random.choice
+    chunks = (np.random.choice(len(a), (min(chunk_size, samples - i), len(a))) for i in range(0, samples, chunk_size))
+
+    batched = _batched_metric(func) if a.ndim == 1 and b.ndim == 1 else None
+    if batched is not None:
+        bootstraps = np.concatenate([batched(a[ind], b[ind]) for ind in chunks])
+    elif num_workers > 0:
+        with multiprocessing.Pool(num_workers) as pool:
+            bootstraps = np.concatenate(pool.starmap(_bootstrap_chunk, ((a, b, func, ind) for ind in chunks)))
+    else:
+        bootstraps = np.concatenate([_bootstrap_chunk(a, b, func, ind) for ind in chunks])
+    bootstraps = np.sort(bootstraps)
 
     return func(a, b), bootstraps[round(0.05 * len(bootstraps))], bootstraps[round(0.95 * len(bootstraps))]
 
 
+def _bootstrap_chunk(a, b, func, ind):
+    """Evaluates ``func'' on each resample (row of ``ind'')."""
+    return np.array([func(a[i], b[i]) for i in ind])
+
+
+def _r2_score(y_true, y_pred):
+    """``sklearn.metrics.r2_score'' of each row."""
+    numerator = ((y_true - y_pred) ** 2).sum(1)
+    denominator = ((y_true - y_true.mean(1, keepdims=True)) ** 2).sum(1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        score = 1 - numerator / denominator
+    # Constant targets score 1 if predicted perfectly and 0 otherwise (as in sklearn)
+    return np.where(denominator != 0, score, np.where(numerator == 0, 1., 0.))
+
+
+def _mean_absolute_error(y_true, y_pred):
+    """``sklearn.metrics.mean_absolute_error'' of each row."""
+    return np.abs(y_true - y_pred).mean(1)
+
+
+def _mean_squared_error(y_true, y_pred):
+    """``sklearn.metrics.mean_squared_error'' of each row."""
+    return ((y_true - y_pred) ** 2).mean(1)
+
+
+def _dice_similarity_coefficient(inter, union):
+    """``dice_similarity_coefficient'' of each row."""
+    return 2 * inter.sum(1) / (union.sum(1) + inter.sum(1))
+
+
 def latexify():
     """Sets matplotlib params to appear more like LaTeX.
 
@@ -163,6 +494,7 @@ def latexify():
               'font.family': 'DejaVu Serif',
               'font.serif': 'Computer Modern',
               }
+    import matplotlib
     matplotlib.rcParams.update(params)
 
 
@@ -176,4 +508,43 @@ def dice_similarity_coefficient(inter, union):
     return 2 * sum(inter) / (sum(union) + sum(inter))
 
 
-__all__ = ["video", "segmentation", "loadvideo", "savevideo", "get_mean_and_std", "bootstrap", "latexify", "dice_similarity_coefficient"]
+def _batched_metric(func):
+    """Returns the vectorized form of ``func'' for ``bootstrap'', or None."""
+    if func is dice_similarity_coefficient:
+        return _dice_similarity_coefficient
+
+    # ``func'' can only be a scikit-learn metric if scikit-learn is already imported
+    metrics = sys.modules.get("sklearn.metrics")
+    if metrics is None:
+        return None
+    return {
+        metrics.r2_score: _r2_score,
+        metrics.mean_absolute_error: _mean_absolute_error,
+        metrics.mean_squared_error: _mean_squared_error,
+    }.get(func)
+
+
+class ModelChoice(click.Choice):
+    """``click.Choice'' of the model constructors in a torchvision module.
+
+    The module is only imported (and the choices listed) when the option is
+    parsed or its help is shown.
+
+    Args:
+        module (str): Name of the module, e.g. ``torchvision.models.video''.
+    """
+
+    def __init__(self, module, case_sensitive=True):
+        self.module = module
+        self.case_sensitive = case_sensitive
+        self._choices = None
+
+    @property
+    def choices(self):
+        if self._choices is None:
+            d = importlib.import_module(self.module).__dict__
+            self._choices = tuple(sorted(name for name in d if name.islower() and not name.startswith("__") and callable(d[name])))
+        return self._choices
+
+
+__all__ = ["video", "segmentation", "stats", "pack", "render", "VideoReader", "videoshape", "iterframes", "loadvideo", "savevideo", "BackgroundEncoder", "get_mean_and_std", "save_mean_and_std", "load_mean_and_std", "select_clips", "bootstrap", "latexify", "dice_similarity_coefficient", "ModelChoice"]
@@ -0,0 +1,104 @@
+"""Functions for packing a dataset into a memory-mapped store."""
+
+import multiprocessing
+import os
+
+import click
+import numpy as np
+import pandas
+import tqdm
+
+import echonet
+from echonet.datasets.echo import trace_mask
+
+
+@click.command("pack")
+@click.option("--data_dir", type=click.Path(exists=True, file_okay=False), default=None)
+@click.option("--output", type=click.Path(file_okay=False), default=None)
+@click.option("--num_workers", type=int, default=4)
+def run(
+    data_dir=None,
+    output=None,
+    num_workers=4,
+):
+    """Decodes a dataset once into a packed store for ``Echo(packed=...)''.
+
+    The store holds FileList.csv (restricted to the videos with traces, the
+    only ones ``Echo'' uses), all videos as uint8 in a single file that is
+    read through a memory map, and the large/small traces rasterized as
+    bit-packed masks (see ``echonet.datasets.PackedVideos'').
+
+    \b
+    Args:
+        data_dir (str, optional): Directory containing dataset. Defaults to
+            `echonet.config.DATA_DIR`.
+        output (str, optional): Directory to write the store to. Defaults to
+            <data_dir>/packed/.
+        num_workers (int, optional): Number of subprocesses to use for
+            decoding videos. If 0, videos are decoded in the main process.
+            Defaults to 4.
+    """
+
+    if data_dir is None:
+        data_dir = echonet.config.DATA_DIR
+    if output is None:
+        output = os.path.join(data_dir, "packed")
+    os.makedirs(output, exist_ok=True)
+
+    # Videos with traces, and the traces themselves
+    dataset = echonet.datasets.Echo(root=data_dir, split="all")
+    filenames = [os.path.join(data_dir, "Videos", f) for f in dataset.fnames]
+
+    offsets = np.zeros(len(filenames), np.int64)
+    frames = np.zeros(len(filenames), np.int64)
+    small = np.zeros(len(filenames), np.int64)
+    large = np.zeros(len(filenames), np.int64)
+    masks = None
+    height = width = None
+
+    # The index is written last, so an interrupted run does not leave a usable store
+    if os.path.exists(os.path.join(output, "index.npz")):
+        os.remove(os.path.join(output, "index.npz"))
+
+    pool = multiprocessing.Pool(num_workers) if num_workers > 0 else None
+    try:
+        videos = pool.imap(echonet.utils.loadvideo, filenames) if pool is not None else map(echonet.utils.loadvideo, filenames)
+        offset = 0
+        with open(os.path.join(output, "videos.u8"), "wb") as f:
+            for (i, (fname, video)) in enumerate(tqdm.tqdm(zip(dataset.fnames, videos), total=len(filenames))):
+                c, n, h, w = video.shape
+                if height is None:
+                    height, width = h, w
+                    masks = np.zeros((len(filenames), 2, (h * w + 7) // 8), np.uint8)
+                elif (h, w) != (height, width):
+                    raise ValueError("{} is {}x{}, but packed videos must all be {}x{}".format(fname, h, w, height, width))
+
+                f.write(np.ascontiguousarray(video).tobytes())
+                offsets[i] = offset
+                frames[i] = n
+                offset += video.size
+
+                # Traces are sorted by cross-sectional area (small first, large last)
+                small[i] = dataset.frames[fname][0]
+                large[i] = dataset.frames[fname][-1]
+                masks[i, 0] = np.packbits(trace_mask(dataset.trace[fname][small[i]], (h, w)).astype(np.uint8))
+                masks[i, 1] = np.packbits(trace_mask(dataset.trace[fname][large[i]], (h, w)).astype(np.uint8))
+    finally:
+        if pool is not None:
+            pool.close()
+
+    # Only the packed (traced) videos are listed, so that ``Echo(packed=...)''
+    # can still tell a missing video from one that was left out on purpose
+    filelist = pandas.read_csv(os.path.join(data_dir, "FileList.csv"))
+    names = filelist["FileName"].map(lambda f: f if os.path.splitext(f)[1] != "" else f + ".avi")
+    filelist[names.isin(set(dataset.fnames))].to_csv(os.path.join(output, "FileList.csv"), index=False)
+    np.savez(os.path.join(output, "index.npz"),
+             fnames=np.array(dataset.fnames),
+             offsets=offsets,
+             frames=frames,
+             height=height,
+             width=width,
+             small=small,
+             large=large,
+             masks=masks)
+    print("Packed {} videos ({:.1f} GB) into {}".format(len(filenames), offset / 1e9, output))
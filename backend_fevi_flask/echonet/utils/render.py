@@ -0,0 +1,120 @@
+"""Functions for drawing segmentations and size curves on videos.
+
+All functions work on canvases of dimensions (channels=3, frames, height,
+width), as taken by ``echonet.utils.savevideo'', and draw whole sets of
+points or lines at once with NumPy indexing.
+"""
+
+import functools
+
+import numpy as np
+import skimage.draw
+
+
+def side_by_side(video, mask, channels=(0,)):
+    """Lays out a video for annotation.
+
+    Args:
+        video (np.ndarray): video of dimensions (channels=3, frames, height, width)
+        mask (np.ndarray): segmentation of dimensions (frames, height, width)
+        channels (tuple of int, optional): channels saturated where ``mask''
+            is set. Defaults to (0,).
+
+    Returns:
+        A canvas of dimensions (channels=3, frames, 2 * height, 2 * width),
+        with the same dtype as ``video'': the video at the top left, the video
+        with the segmentation at the top right, and a blank area below for
+        the size curve.
+    """
+    c, f, h, w = video.shape
+    canvas = np.zeros((c, f, 2 * h, 2 * w), video.dtype)
+    canvas[:, :, :h, :w] = video
+    canvas[:, :, :h, w:] = video
+    saturated = mask * video.dtype.type(255)
+    for channel in channels:
+        canvas[channel, :, :h, w:] = np.maximum(saturated, video[channel])
+    return canvas
+
+
+def curve(size):
+    """Returns the (rows, columns) where the size curve is drawn.
+
+    Args:
+        size (np.ndarray): size of each frame, normalized to [0, 1] with 0 at
+            the top of the plot
+
+    Returns:
+        Two int arrays with the row and column of each frame's point, in the
+        area below the videos of a 112x112 ``side_by_side'' canvas.
+    """
+    size = np.asarray(size, np.float64)
+    rows = np.round(115 + 100 * size).astype(int)
+    cols = np.round(np.arange(len(size)) / len(size) * 200 + 10).astype(int)
+    return rows, cols
+
+
+@functools.lru_cache()
+def square(radius):
+    """Returns the row and column offsets, as a (2, n) array, of a square of side ``2 * radius + 1''."""
+    d = np.arange(-radius, radius + 1)
+    return _readonly(np.stack([a.ravel() for a in np.meshgrid(d, d, indexing="ij")]))
+
+
+@functools.lru_cache()
+def disk(radius):
+    """Returns the row and column offsets, as a (2, n) array, of the pixels of ``skimage.draw.disk'' of ``radius''."""
+    return _readonly(np.stack(skimage.draw.disk((0, 0), radius)))
+
+
+@functools.lru_cache()
+def dashes(start, stop, on=10, off=10):
+    """Returns the rows ``start'' to ``stop'' (exclusive) covered by a dashed line."""
+    rows = np.arange(start, stop)
+    return _readonly(rows[(rows - start) % (on + off) < on])
+
+
+def _readonly(array):
+    # Stencils are cached, so they are shared by all callers
+    array.setflags(write=False)
+    return array
+
+
+def stamp(canvas, rows, cols, offsets, color, frames=None):
+    """Draws a stencil around each point, clipped to the canvas.
+
+    Args:
+        canvas (np.ndarray): canvas to draw on, modified in place
+        rows, cols (array_like): coordinates of the points
+        offsets (np.ndarray): (2, n) row and column offsets of the stencil
+            (see ``square'' and ``disk'')
+        color (scalar or array_like): value, or value of each channel
+        frames (array_like or None, optional): frame of each point. If
+            ``None'', the points are drawn on all frames. Defaults to ``None''.
+    """
+    r = np.asarray(rows)[:, None] + offsets[0]
+    c = np.asarray(cols)[:, None] + offsets[1]
+    keep = (r >= 0) & (r < canvas.shape[2]) & (c >= 0) & (c < canvas.shape[3])
+    color = np.asarray(color, canvas.dtype).reshape(-1, 1)
+    if frames is None:
+        canvas[:, :, r[keep], c[keep]] = color[:, :, None]
+    else:
+        f = np.broadcast_to(np.asarray(frames)[:, None], r.shape)
+        keep &= (f >= 0) & (f < canvas.shape[1])
+        canvas[:, f[keep], r[keep], c[keep]] = color
+
+
+def vline(canvas, cols, rows, color, frames=slice(None)):
+    """Draws vertical lines, clipped to the canvas.
+
+    Args:
+        canvas (np.ndarray): canvas to draw on, modified in place
+        cols (int or array_like): columns of the lines
+        rows (slice or array_like): rows covered by each line (see ``dashes'')
+        color (scalar or array_like): value, or value of each channel
+        frames (slice, optional): frames to draw on. Defaults to all frames.
+    """
+    cols = np.atleast_1d(cols)
+    cols = cols[(cols >= 0) & (cols < canvas.shape[3])]
+    rows = np.arange(canvas.shape[2])[rows] if isinstance(rows, slice) else np.asarray(rows)
+    rows = rows[(rows >= 0) & (rows < canvas.shape[2])]
+    canvas[:, frames, rows[:, None], cols[None, :]] = np.asarray(color, canvas.dtype).reshape(-1, 1, 1, 1)
@@ -8,7 +8,6 @@ import click
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.signal
-import skimage.draw
 import torch
 import torchvision
 import tqdm
@@ -19,20 +18,21 @@ import echonet
 @click.command("segmentation")
 @click.option("--data_dir", type=click.Path(exists=True, file_okay=False), default=None)
 @click.option("--output", type=click.Path(file_okay=False), default=None)
-@click.option("--model_name", type=click.Choice(
-    sorted(name for name in torchvision.models.segmentation.__dict__
-           if name.islower() and not name.startswith("__") and callable(torchvision.models.segmentation.__dict__[name]))),
+@click.option("--model_name", type=echonet.utils.ModelChoice("torchvision.models.segmentation"),
     default="deeplabv3_resnet50")
 @click.option("--pretrained/--random", default=False)
 @click.option("--weights", type=click.Path(exists=True, dir_okay=False), default=None)
 @click.option("--run_test/--skip_test", default=False)
 @click.option("--save_video/--skip_video", default=False)
+@click.option("--fuse_frames/--separate_frames", default=False)
 @click.option("--num_epochs", type=int, default=50)
 @click.option("--lr", type=float, default=1e-5)
 @click.option("--weight_decay", type=float, default=0)
 @click.option("--lr_step_period", type=int, default=None)
 @click.option("--num_train_patients", type=int, default=None)
 @click.option("--num_workers", type=int, default=4)
+@click.option("--cache_bytes", type=int, default=0)
+@click.option("--cache_dir", type=click.Path(file_okay=False), default=None)
 @click.option("--batch_size", type=int, default=20)
 @click.option("--device", type=str, default=None)
 @click.option("--seed", type=int, default=0)
@@ -46,12 +46,15 @@ def run(
 
     run_test=False,
     save_video=False,
+    fuse_frames=False,
     num_epochs=50,
     lr=1e-5,
     weight_decay=1e-5,
     lr_step_period=None,
     num_train_patients=None,
     num_workers=4,
+    cache_bytes=0,
+    cache_dir=None,
     batch_size=20,
     device=None,
     seed=0,
@@ -75,6 +78,9 @@ def run(
             Defaults to False.
         save_video (bool, optional): Whether to save videos with segmentations.
             Defaults to False.
+        fuse_frames (bool, optional): Whether to run the large and small frames
+            through the model as a single batch (see ``run_epoch'').
+            Defaults to False.
         num_epochs (int, optional): Number of epochs during training
             Defaults to 50.
         lr (float, optional): Learning rate for SGD
@@ -89,6 +95,12 @@ def run(
         num_workers (int, optional): Number of subprocesses to use for data
             loading. If 0, the data will be loaded in the main process.
             Defaults to 4.
+        cache_bytes (int, optional): Memory budget in bytes for keeping decoded
+            videos between epochs. Each data loading subprocess keeps its own
+            videos, so the budget is split evenly among the subprocesses of the
+            training and validation loaders. Defaults to 0.
+        cache_dir (str or None, optional): Directory for caching decoded videos
+            on disk, shared by all subprocesses and runs. Defaults to None.
         device (str or None, optional): Name of device to run on. Options from
             https://pytorch.org/docs/stable/tensor_attributes.html#torch.torch.device
             Defaults to ``cuda'' if available, and ``cpu'' otherwise.
@@ -133,9 +145,16 @@ def run(
     tasks = ["LargeFrame", "SmallFrame", "LargeTrace", "SmallTrace"]
     kwargs = {"target_type": tasks,
               "mean": mean,
-              "std": std
+              "std": std,
+              "keyframes": True,  # Only the large and small frames are used; skip decoding clips
+              "trace_workers": num_workers
               }
 
+    # Cache decoded videos across epochs
+    if cache_bytes or cache_dir is not None:
+        # Each data loading subprocess (of the train and val loaders) holds its own in-memory tier
+        kwargs["cache"] = echonet.datasets.VideoCache(cache_bytes // max(1, 2 * num_workers), cache_dir)
+
     # Set up datasets and dataloaders
     dataset = {}
     dataset["train"] = echonet.datasets.Echo(root=data_dir, split="train", **kwargs)
@@ -144,6 +163,10 @@ def run(
         indices = np.random.choice(len(dataset["train"]), num_train_patients, replace=False)
         dataset["train"] = torch.utils.data.Subset(dataset["train"], indices)
     dataset["val"] = echonet.datasets.Echo(root=data_dir, split="val", **kwargs)
+    dataloaders = {phase: torch.utils.data.DataLoader(
+        dataset[phase], batch_size=batch_size, num_workers=num_workers, shuffle=True, pin_memory=(device.type == "cuda"), drop_last=(phase == "train"),
+        persistent_workers=(num_workers > 0 and "cache" in kwargs))  # Workers (and their cached videos) are kept between epochs
+        for phase in ["train", "val"]}
 
     # Run training and testing loops
     with open(os.path.join(output, "log.csv"), "a") as f:
@@ -168,11 +191,9 @@ def run(
                 for i in range(torch.cuda.device_count()):
                     torch.cuda.reset_peak_memory_stats(i)
 
-                ds = dataset[phase]
-                dataloader = torch.utils.data.DataLoader(
-                    ds, batch_size=batch_size, num_workers=num_workers, shuffle=True, pin_memory=(device.type == "cuda"), drop_last=(phase == "train"))
+                dataloader = dataloaders[phase]
 
-                loss, large_inter, large_union, small_inter, small_union = echonet.utils.segmentation.run_epoch(model, dataloader, phase == "train", optim, device)
+                loss, large_inter, large_union, small_inter, small_union = echonet.utils.segmentation.run_epoch(model, dataloader, phase == "train", optim, device, fuse_frames)
                 overall_dice = 2 * (large_inter.sum() + small_inter.sum()) / (large_union.sum() + large_inter.sum() + small_union.sum() + small_inter.sum())
                 large_dice = 2 * large_inter.sum() / (large_union.sum() + large_inter.sum())
                 small_dice = 2 * small_inter.sum() / (small_union.sum() + small_inter.sum())
@@ -216,7 +237,7 @@ def run(
                 dataset = echonet.datasets.Echo(root=data_dir, split=split, **kwargs)
                 dataloader = torch.utils.data.DataLoader(dataset,
                                                          batch_size=batch_size, num_workers=num_workers, shuffle=False, pin_memory=(device.type == "cuda"))
-                loss, large_inter, large_union, small_inter, small_union = echonet.utils.segmentation.run_epoch(model, dataloader, False, None, device)
+                loss, large_inter, large_union, small_inter, small_union = echonet.utils.segmentation.run_epoch(model, dataloader, False, None, device, fuse_frames)
 
                 overall_dice = 2 * (large_inter + small_inter) / (large_union + large_inter + small_union + small_inter)
                 large_dice = 2 * large_inter / (large_union + large_inter)
@@ -249,7 +270,8 @@ def run(
         os.makedirs(os.path.join(output, "size"), exist_ok=True)
         echonet.utils.latexify()
 
-        with torch.no_grad():
+        # Videos are encoded on a background thread while the next batch is segmented
+        with torch.no_grad(), echonet.utils.BackgroundEncoder() as encoder:
             with open(os.path.join(output, "size.csv"), "w") as g:
                 g.write("Filename,Frame,Size,HumanLarge,HumanSmall,ComputerSmall\n")
                 for (x, (filenames, large_index, small_index), length) in tqdm.tqdm(dataloader):
@@ -272,15 +294,10 @@ def run(
                         f, c, h, w = video.shape  # pylint: disable=W0612
                         assert c == 3
 
-                        # Put two copies of the video side by side
-                        video = np.concatenate((video, video), 3)
-
-                        # If a pixel is in the segmentation, saturate blue channel
-                        # Leave alone otherwise
-                        video[:, 0, :, w:] = np.maximum(255. * (logit > 0), video[:, 0, :, w:])  # pylint: disable=E1111
-
-                        # Add blank canvas under pair of videos
-                        video = np.concatenate((video, np.zeros_like(video)), 2)
+                        # Put two copies of the video side by side, saturate the blue
+                        # channel where a pixel is in the segmentation (on the right copy),
+                        # and add a blank canvas under the pair of videos
+                        video = echonet.utils.render.side_by_side(video.transpose(1, 0, 2, 3), logit > 0)
 
                         # Compute size of segmentation per frame
                         size = (logit > 0).sum((1, 2))
@@ -314,51 +331,18 @@ def run(
                         size = size / size.max()
                         size = 1 - size
 
-                        # Iterate the frames in this video
-                        for (f, s) in enumerate(size):
-
-                            # On all frames, mark a pixel for the size of the frame
-                            video[:, :, int(round(115 + 100 * s)), int(round(f / len(size) * 200 + 10))] = 255.
-
-                            if f in systole:
-                                # If frame is computer-selected systole, mark with a line
-                                video[:, :, 115:224, int(round(f / len(size) * 200 + 10))] = 255.
-
-                            def dash(start, stop, on=10, off=10):
-                                buf = []
-                                x = start
-                                while x < stop:
-                                    buf.extend(range(x, x + on))
-                                    x += on
-                                    x += off
-                                buf = np.array(buf)
-                                buf = buf[buf < stop]
-                                return buf
-                            d = dash(115, 224)
-
-                            if f == large_index[i]:
-                                # If frame is human-selected diastole, mark with green dashed line on all frames
-                                video[:, :, d, int(round(f / len(size) * 200 + 10))] = np.array([0, 225, 0]).reshape((1, 3, 1))
-                            if f == small_index[i]:
-                                # If frame is human-selected systole, mark with red dashed line on all frames
-                                video[:, :, d, int(round(f / len(size) * 200 + 10))] = np.array([0, 0, 225]).reshape((1, 3, 1))
-
-                            # Get pixels for a circle centered on the pixel
-                            r, c = skimage.draw.disk((int(round(115 + 100 * s)), int(round(f / len(size) * 200 + 10))), 4.1)
-
-                            # On the frame that's being shown, put a circle over the pixel
-                            video[f, :, r, c] = 255.
-
-                        # Rearrange dimensions and save
-                        video = video.transpose(1, 0, 2, 3)
+                        # Draw the size curve under the videos
+                        _draw_size(video, size, systole, large_index[i], small_index[i])
+
+                        # Save
                         video = video.astype(np.uint8)
-                        echonet.utils.savevideo(os.path.join(output, "videos", filename), video, 50)
+                        encoder.submit(echonet.utils.savevideo, os.path.join(output, "videos", filename), video, 50)
 
                         # Move to next video
                         start += offset
 
 
-def run_epoch(model, dataloader, train, optim, device):
+def run_epoch(model, dataloader, train, optim, device, fuse_frames=False):
     """Run one epoch of training/evaluation for segmentation.
 
     Args:
@@ -367,63 +351,51 @@ def run_epoch(model, dataloader, train, optim, device):
         train (bool): Whether or not to train model.
         optim (torch.optim.Optimizer): Optimizer
         device (torch.device): Device to run on
+        fuse_frames (bool, optional): If True, the large and small frames are
+            concatenated into one batch for a single forward pass (during
+            training, batch normalization then uses statistics of both).
+            Defaults to False.
     """
 
     total = 0.
     n = 0
 
-    pos = 0
-    neg = 0
-    pos_pix = 0
-    neg_pix = 0
+    # Metrics are accumulated on the device and moved to the cpu once per batch
+    pos_pix = 0  # number of times each pixel is in the human segmentation
+    neg_pix = 0  # number of times each pixel is out of the human segmentation
+    inter_union = []  # per-sample large intersection, large union, small intersection, small union
+    inter_union_total = 0
 
     model.train(train)
 
-    large_inter = 0
-    large_union = 0
-    small_inter = 0
-    small_union = 0
-    large_inter_list = []
-    large_union_list = []
-    small_inter_list = []
-    small_union_list = []
-
     with torch.set_grad_enabled(train):
         with tqdm.tqdm(total=len(dataloader)) as pbar:
             for (_, (large_frame, small_frame, large_trace, small_trace)) in dataloader:
-                # Count number of pixels in/out of human segmentation
-                pos += (large_trace == 1).sum().item()
-                pos += (small_trace == 1).sum().item()
-                neg += (large_trace == 0).sum().item()
-                neg += (small_trace == 0).sum().item()
-
-                # Count number of pixels in/out of computer segmentation
-                pos_pix += (large_trace == 1).sum(0).to("cpu").detach().numpy()
-                pos_pix += (small_trace == 1).sum(0).to("cpu").detach().numpy()
-                neg_pix += (large_trace == 0).sum(0).to("cpu").detach().numpy()
-                neg_pix += (small_trace == 0).sum(0).to("cpu").detach().numpy()
-
-                # Run prediction for diastolic frames and compute loss
                 large_frame = large_frame.to(device)
                 large_trace = large_trace.to(device)
-                y_large = model(large_frame)["out"]
-                loss_large = torch.nn.functional.binary_cross_entropy_with_logits(y_large[:, 0, :, :], large_trace, reduction="sum")
-                # Compute pixel intersection and union between human and computer segmentations
-                large_inter += np.logical_and(y_large[:, 0, :, :].detach().cpu().numpy() > 0., large_trace[:, :, :].detach().cpu().numpy() > 0.).sum()
-                large_union += np.logical_or(y_large[:, 0, :, :].detach().cpu().numpy() > 0., large_trace[:, :, :].detach().cpu().numpy() > 0.).sum()
-                large_inter_list.extend(np.logical_and(y_large[:, 0, :, :].detach().cpu().numpy() > 0., large_trace[:, :, :].detach().cpu().numpy() > 0.).sum((1, 2)))
-                large_union_list.extend(np.logical_or(y_large[:, 0, :, :].detach().cpu().numpy() > 0., large_trace[:, :, :].detach().cpu().numpy() > 0.).sum((1, 2)))
-
-                # Run prediction for systolic frames and compute loss
                 small_frame = small_frame.to(device)
                 small_trace = small_trace.to(device)
-                y_small = model(small_frame)["out"]
+
+                # Count number of pixels in/out of human segmentation
+                pos_pix += (large_trace == 1).sum(0) + (small_trace == 1).sum(0)
+                neg_pix += (large_trace == 0).sum(0) + (small_trace == 0).sum(0)
+
+                # Run prediction for diastolic and systolic frames
+                if fuse_frames:
+                    y_large, y_small = model(torch.cat((large_frame, small_frame)))["out"].split(large_frame.shape[0])
+                else:
+                    y_large = model(large_frame)["out"]
+                    y_small = model(small_frame)["out"]
+
+                # Compute loss for diastolic and systolic frames
+                loss_large = torch.nn.functional.binary_cross_entropy_with_logits(y_large[:, 0, :, :], large_trace, reduction="sum")
                 loss_small = torch.nn.functional.binary_cross_entropy_with_logits(y_small[:, 0, :, :], small_trace, reduction="sum")
+
                 # Compute pixel intersection and union between human and computer segmentations
-                small_inter += np.logical_and(y_small[:, 0, :, :].detach().cpu().numpy() > 0., small_trace[:, :, :].detach().cpu().numpy() > 0.).sum()
-                small_union += np.logical_or(y_small[:, 0, :, :].detach().cpu().numpy() > 0., small_trace[:, :, :].detach().cpu().numpy() > 0.).sum()
-                small_inter_list.extend(np.logical_and(y_small[:, 0, :, :].detach().cpu().numpy() > 0., small_trace[:, :, :].detach().cpu().numpy() > 0.).sum((1, 2)))
-                small_union_list.extend(np.logical_or(y_small[:, 0, :, :].detach().cpu().numpy() > 0., small_trace[:, :, :].detach().cpu().numpy() > 0.).sum((1, 2)))
+                batch = torch.stack(_intersection_and_union(y_large[:, 0, :, :], large_trace) +
+                                    _intersection_and_union(y_small[:, 0, :, :], small_trace), 1)
+                inter_union.append(batch)
+                inter_union_total += batch.sum(0)
 
                 # Take gradient step if training
                 loss = (loss_large + loss_small) / 2
@@ -432,29 +404,72 @@ def run_epoch(model, dataloader, train, optim, device):
                     loss.backward()
                     optim.step()
 
+                # Baselines: constant prediction of the pixel prior, overall and per pixel
+                p_pix = (pos_pix + 1) / (pos_pix + neg_pix + 2)
+                entropy_pix = (-p_pix * torch.log(p_pix) - (1 - p_pix) * torch.log(1 - p_pix)).mean()
+                stats = torch.cat([x.detach().double().view(-1) for x in (loss, pos_pix.sum(), neg_pix.sum(), entropy_pix, inter_union_total)])
+                loss_value, pos, neg, entropy_pix, large_inter, large_union, small_inter, small_union = stats.tolist()
+
                 # Accumulate losses and compute baselines
-                total += loss.item()
+                total += loss_value
                 n += large_trace.size(0)
                 p = pos / (pos + neg)
-                p_pix = (pos_pix + 1) / (pos_pix + neg_pix + 2)
 
                 # Show info on process bar
-                pbar.set_postfix_str("{:.4f} ({:.4f}) / {:.4f} {:.4f}, {:.4f}, {:.4f}".format(total / n / 112 / 112, loss.item() / large_trace.size(0) / 112 / 112, -p * math.log(p) - (1 - p) * math.log(1 - p), (-p_pix * np.log(p_pix) - (1 - p_pix) * np.log(1 - p_pix)).mean(), 2 * large_inter / (large_union + large_inter), 2 * small_inter / (small_union + small_inter)))
+                pbar.set_postfix_str("{:.4f} ({:.4f}) / {:.4f} {:.4f}, {:.4f}, {:.4f}".format(total / n / 112 / 112, loss_value / large_trace.size(0) / 112 / 112, -p * math.log(p) - (1 - p) * math.log(1 - p), entropy_pix, 2 * large_inter / (large_union + large_inter), 2 * small_inter / (small_union + small_inter)))
                 pbar.update()
 
-    large_inter_list = np.array(large_inter_list)
-    large_union_list = np.array(large_union_list)
-    small_inter_list = np.array(small_inter_list)
-    small_union_list = np.array(small_union_list)
+    inter_union = torch.cat(inter_union).to("cpu").numpy()
 
     return (total / n / 112 / 112,
-            large_inter_list,
-            large_union_list,
-            small_inter_list,
-            small_union_list,
+            inter_union[:, 0],
+            inter_union[:, 1],
+            inter_union[:, 2],
+            inter_union[:, 3],
             )
 
 
+def _draw_size(video, size, systole, large_index, small_index):
+    """Draws the normalized size of each frame on the blank canvas of ``video''.
+
+    ``video'' is a (channels=3, frames, height, width) canvas from
+    ``echonet.utils.render.side_by_side''. Marks are layered as if frames were
+    drawn one after the other: marks of later frames cover the circle of the
+    frame being shown.
+    """
+
+    render = echonet.utils.render
+    rows, cols = render.curve(size)
+
+    # On all frames, mark a pixel for the size of each frame
+    render.stamp(video, rows, cols, render.square(0), 255.)
+
+    # Mark computer-selected systoles with a line
+    render.vline(video, cols[sorted(systole)], slice(115, 224), 255.)
+
+    # Mark human-selected diastole (green) and systole (red) with dashed lines
+    dashes = [(index, color) for (index, color) in ((large_index, (0, 225, 0)), (small_index, (0, 0, 225)))
+              if 0 <= index < len(size)]
+    for (index, color) in dashes:
+        render.vline(video, cols[index], render.dashes(115, 224), color)
+
+    # On the frame that's being shown, put a circle over its pixel
+    render.stamp(video, rows, cols, render.disk(4.1), 255., frames=np.arange(len(size)))
+
+    # Dashed lines of later frames stay over the circle (pixels and systole
+    # lines are the same color as the circle, so they need not be redrawn)
+    for (index, color) in dashes:
+        render.vline(video, cols[index], render.dashes(115, 224), color, frames=slice(0, index))
+
+
+def _intersection_and_union(logits, trace):
+    """Per-sample number of pixels in the intersection and in the union of
+    the computer (``logits > 0'') and human (``trace > 0'') segmentations."""
+    pred = logits.detach() > 0.
+    truth = trace > 0.
+    return ((pred & truth).sum((1, 2)), (pred | truth).sum((1, 2)))
+
+
 def _video_collate_fn(x):
     """Collate function for Pytorch dataloader to merge multiple videos.
 
@@ -0,0 +1,67 @@
+"""Functions for precomputing normalization statistics."""
+
+import os
+
+import click
+import numpy as np
+import torch
+
+import echonet
+
+
+@click.command("stats")
+@click.option("--data_dir", type=click.Path(exists=True, file_okay=False), default=None)
+@click.option("--output", type=click.Path(dir_okay=False), default=None)
+@click.option("--split", type=str, default="train")
+@click.option("--samples", type=int, default=None)
+@click.option("--num_workers", type=int, default=4)
+@click.option("--batch_size", type=int, default=8)
+@click.option("--seed", type=int, default=0)
+def run(
+    data_dir=None,
+    output=None,
+    split="train",
+    samples=None,
+    num_workers=4,
+    batch_size=8,
+    seed=0,
+):
+    """Computes mean and std of a split once and saves them to a file.
+
+    The resulting file can be loaded with ``echonet.utils.load_mean_and_std'',
+    so that inference does not need to estimate statistics on its inputs.
+
+    \b
+    Args:
+        data_dir (str, optional): Directory containing dataset. Defaults to
+            `echonet.config.DATA_DIR`.
+        output (str, optional): File to write the statistics to. Defaults to
+            weights/echonet_mean_std.npz.
+        split (str, optional): Split to compute the statistics on.
+            Defaults to ``train''.
+        samples (int or None, optional): Number of videos to sample from the
+            split. If None, all videos are used. Defaults to None.
+        num_workers (int, optional): Number of subprocesses to use for data
+            loading. If 0, the data will be loaded in the main process.
+            Defaults to 4.
+        batch_size (int, optional): Number of samples to load per batch
+            Defaults to 8.
+        seed (int, optional): Seed for random number generator. Defaults to 0.
+    """
+
+    # Seed RNGs
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+    # Set default output file
+    if output is None:
+        output = os.path.join("weights", "echonet_mean_std.npz")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+
+    mean, std = echonet.utils.get_mean_and_std(echonet.datasets.Echo(root=data_dir, split=split),
+                                               samples=samples, batch_size=batch_size, num_workers=num_workers)
+    echonet.utils.save_mean_and_std(output, mean, std)
+
+    print("mean: {}".format(", ".join("{:.4f}".format(m) for m in mean)))
+    print("std:  {}".format(", ".join("{:.4f}".format(s) for s in std)))
+    print("Saved to {}".format(output))
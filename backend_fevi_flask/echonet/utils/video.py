@@ -1,5 +1,6 @@
 """Functions for training and running EF prediction."""
 
+import collections
 import math
 import os
 import time
@@ -14,18 +15,31 @@ import tqdm
 
 import echonet
 
+# Test-time augmentation policies compared against all clips in ``run''
+# (name, clip_stride, max_clips, beat-aligned)
+TTA_POLICIES = [
+    ("stride=2", 2, None, False),
+    ("stride=4", 4, None, False),
+    ("stride=8", 8, None, False),
+    ("stride=16", 16, None, False),
+    ("max_clips=16", 1, 16, False),
+    ("max_clips=8", 1, 8, False),
+    ("max_clips=4", 1, 4, False),
+    ("beats", 1, None, True),
+    ("beats,max_clips=4", 1, 4, True),
+]
+
 
 @click.command("video")
 @click.option("--data_dir", type=click.Path(exists=True, file_okay=False), default=None)
 @click.option("--output", type=click.Path(file_okay=False), default=None)
 @click.option("--task", type=str, default="EF")
-@click.option("--model_name", type=click.Choice(
-    sorted(name for name in torchvision.models.video.__dict__
-           if name.islower() and not name.startswith("__") and callable(torchvision.models.video.__dict__[name]))),
+@click.option("--model_name", type=echonet.utils.ModelChoice("torchvision.models.video"),
     default="r2plus1d_18")
 @click.option("--pretrained/--random", default=True)
 @click.option("--weights", type=click.Path(exists=True, dir_okay=False), default=None)
 @click.option("--run_test/--skip_test", default=False)
+@click.option("--beats", type=click.Path(exists=True, dir_okay=False), default=None)
 @click.option("--num_epochs", type=int, default=45)
 @click.option("--lr", type=float, default=1e-4)
 @click.option("--weight_decay", type=float, default=1e-4)
@@ -34,6 +48,8 @@ import echonet
 @click.option("--period", type=int, default=2)
 @click.option("--num_train_patients", type=int, default=None)
 @click.option("--num_workers", type=int, default=4)
+@click.option("--cache_bytes", type=int, default=0)
+@click.option("--cache_dir", type=click.Path(file_okay=False), default=None)
 @click.option("--batch_size", type=int, default=20)
 @click.option("--device", type=str, default=None)
 @click.option("--seed", type=int, default=0)
@@ -47,6 +63,7 @@ def run(
     weights=None,
 
     run_test=False,
+    beats=None,
     num_epochs=45,
     lr=1e-4,
     weight_decay=1e-4,
@@ -55,6 +72,8 @@ def run(
     period=2,
     num_train_patients=None,
     num_workers=4,
+    cache_bytes=0,
+    cache_dir=None,
     batch_size=20,
     device=None,
     seed=0,
@@ -79,6 +98,10 @@ def run(
             initialize model. Defaults to None.
         run_test (bool, optional): Whether or not to run on test.
             Defaults to False.
+        beats (str, optional): Path to a size.csv written by the segmentation
+            command. Its computer-selected systolic frames are used as clip
+            starts for the beat-aligned test-time augmentation policies.
+            Defaults to None (beat-aligned policies are skipped).
         num_epochs (int, optional): Number of epochs during training.
             Defaults to 45.
         lr (float, optional): Learning rate for SGD
@@ -97,6 +120,12 @@ def run(
         num_workers (int, optional): Number of subprocesses to use for data
             loading. If 0, the data will be loaded in the main process.
             Defaults to 4.
+        cache_bytes (int, optional): Memory budget in bytes for keeping decoded
+            videos between epochs. Each data loading subprocess keeps its own
+            videos, so the budget is split evenly among the subprocesses of the
+            training and validation loaders. Defaults to 0.
+        cache_dir (str or None, optional): Directory for caching decoded videos
+            on disk, shared by all subprocesses and runs. Defaults to None.
         device (str or None, optional): Name of device to run on. Options from
             https://pytorch.org/docs/stable/tensor_attributes.html#torch.torch.device
             Defaults to ``cuda'' if available, and ``cpu'' otherwise.
@@ -146,6 +175,11 @@ def run(
               "period": period,
               }
 
+    # Cache decoded videos across epochs
+    if cache_bytes or cache_dir is not None:
+        # Each data loading subprocess (of the train and val loaders) holds its own in-memory tier
+        kwargs["cache"] = echonet.datasets.VideoCache(cache_bytes // max(1, 2 * num_workers), cache_dir)
+
     # Set up datasets and dataloaders
     dataset = {}
     dataset["train"] = echonet.datasets.Echo(root=data_dir, split="train", **kwargs, pad=12)
@@ -154,6 +188,10 @@ def run(
         indices = np.random.choice(len(dataset["train"]), num_train_patients, replace=False)
         dataset["train"] = torch.utils.data.Subset(dataset["train"], indices)
     dataset["val"] = echonet.datasets.Echo(root=data_dir, split="val", **kwargs)
+    dataloaders = {phase: torch.utils.data.DataLoader(
+        dataset[phase], batch_size=batch_size, num_workers=num_workers, shuffle=True, pin_memory=(device.type == "cuda"), drop_last=(phase == "train"),
+        persistent_workers=(num_workers > 0 and "cache" in kwargs))  # Workers (and their cached videos) are kept between epochs
+        for phase in ["train", "val"]}
 
     # Run training and testing loops
     with open(os.path.join(output, "log.csv"), "a") as f:
@@ -178,9 +216,7 @@ def run(
                 for i in range(torch.cuda.device_count()):
                     torch.cuda.reset_peak_memory_stats(i)
 
-                ds = dataset[phase]
-                dataloader = torch.utils.data.DataLoader(
-                    ds, batch_size=batch_size, num_workers=num_workers, shuffle=True, pin_memory=(device.type == "cuda"), drop_last=(phase == "train"))
+                dataloader = dataloaders[phase]
 
                 loss, yhat, y = echonet.utils.video.run_epoch(model, dataloader, phase == "train", optim, device)
                 f.write("{},{},{},{},{},{},{},{},{}\n".format(epoch,
@@ -232,15 +268,24 @@ def run(
                 f.flush()
 
                 # Performance with test-time augmentation
-                ds = echonet.datasets.Echo(root=data_dir, split=split, **kwargs, clips="all")
+                ds = echonet.datasets.Echo(root=data_dir, split=split, **kwargs, clips="all", windowed=True)
                 dataloader = torch.utils.data.DataLoader(
-                    ds, batch_size=1, num_workers=num_workers, shuffle=False, pin_memory=(device.type == "cuda"))
+                    ds, batch_size=1, num_workers=num_workers, shuffle=False, pin_memory=(device.type == "cuda"), collate_fn=echonet.datasets.ClipWindows.collate)
                 loss, yhat, y = echonet.utils.video.run_epoch(model, dataloader, False, None, device, save_all=True, block_size=batch_size)
                 f.write("{} (all clips) R2:   {:.3f} ({:.3f} - {:.3f})\n".format(split, *echonet.utils.bootstrap(y, np.array(list(map(lambda x: x.mean(), yhat))), sklearn.metrics.r2_score)))
                 f.write("{} (all clips) MAE:  {:.2f} ({:.2f} - {:.2f})\n".format(split, *echonet.utils.bootstrap(y, np.array(list(map(lambda x: x.mean(), yhat))), sklearn.metrics.mean_absolute_error)))
                 f.write("{} (all clips) RMSE: {:.2f} ({:.2f} - {:.2f})\n".format(split, *tuple(map(math.sqrt, echonet.utils.bootstrap(y, np.array(list(map(lambda x: x.mean(), yhat))), sklearn.metrics.mean_squared_error)))))
                 f.flush()
 
+                # Compare cheaper test-time augmentation policies against all clips
+                # Clip i of each video starts at frame i, so policies subsample the saved predictions
+                with open(os.path.join(output, "{}_tta.csv".format(split)), "w") as g:
+                    g.write("Policy,Clips,MAE_vs_all,MAE,RMSE\n")
+                    for (name, clips, diff, mae, rmse) in evaluate_tta_policies(ds.fnames, yhat, y, load_beats(beats) if beats is not None else None):
+                        f.write("{} ({}) clips: {:.1f}, MAE vs all clips: {:.2f}, MAE: {:.2f}, RMSE: {:.2f}\n".format(split, name, clips, diff, mae, rmse))
+                        g.write("{},{:.2f},{:.4f},{:.4f},{:.4f}\n".format(name, clips, diff, mae, rmse))
+                f.flush()
+
                 # Write full performance to file
                 with open(os.path.join(output, "{}_predictions.csv".format(split)), "w") as g:
                     for (filename, pred) in zip(ds.fnames, yhat):
@@ -282,7 +327,76 @@ def run(
                 plt.close(fig)
 
 
-def run_epoch(model, dataloader, train, optim, device, save_all=False, block_size=None):
+def load_beats(filename):
+    """Loads computer-selected systolic frames from a size.csv.
+
+    Args:
+        filename (str): size.csv written by the segmentation command (or by
+            the Flask processor), with ``Filename'', ``Frame'' and
+            ``ComputerSmall'' columns.
+
+    Returns:
+        A dict mapping filenames to sorted lists of frames.
+    """
+
+    beats = collections.defaultdict(list)
+    with open(filename) as f:
+        header = f.readline().strip().split(",")
+        i_filename = header.index("Filename")
+        i_frame = header.index("Frame")
+        i_small = header.index("ComputerSmall")
+        for line in f:
+            line = line.strip().split(",")
+            if line[i_small] == "1":
+                beats[line[i_filename]].append(int(line[i_frame]))
+
+    return {filename: sorted(frames) for (filename, frames) in beats.items()}
+
+
+def evaluate_tta_policies(fnames, yhat, y, beats=None, policies=None):
+    """Measures the error of test-time augmentation policies against all clips.
+
+    Args:
+        fnames (list): filenames of the videos
+        yhat (list of np.ndarray): predictions for all clips of each video,
+            where the i-th prediction is for the clip starting at frame i
+            (as returned by ``run_epoch'' with ``save_all'' for an
+            ``echonet.datasets.Echo'' with ``clips="all"'')
+        y (np.ndarray): ground truth for each video
+        beats (dict or None, optional): maps filenames to beat frames (see
+            ``load_beats''). If ``None'', beat-aligned policies are skipped.
+        policies (list or None, optional): list of (name, clip_stride,
+            max_clips, beat-aligned) tuples. Defaults to ``TTA_POLICIES''.
+
+    Returns:
+        A list of (name, mean number of clips, MAE against all clips, MAE, RMSE) tuples.
+    """
+
+    if policies is None:
+        policies = TTA_POLICIES
+
+    full = np.array([p.mean() for p in yhat])
+    results = []
+    for (name, stride, max_clips, aligned) in policies:
+        if aligned and beats is None:
+            continue
+        pred = []
+        clips = []
+        for (filename, p) in zip(fnames, yhat):
+            start = echonet.utils.select_clips(len(p), stride, max_clips, beats.get(filename) if aligned else None)
+            pred.append(p[start].mean())
+            clips.append(len(start))
+        pred = np.array(pred)
+        results.append((name,
+                        np.mean(clips),
+                        np.abs(pred - full).mean(),
+                        np.abs(pred - y).mean(),
+                        math.sqrt(((pred - y) ** 2).mean())))
+
+    return results
+
+
+def run_epoch(model, dataloader, train, optim, device, save_all=False, block_size=None, clip_stride=1, max_clips=None):
     """Run one epoch of training/evaluation for segmentation.
 
     Args:
@@ -299,6 +413,11 @@ def run_epoch(model, dataloader, train, optim, device, save_all=False, block_siz
             to run on at the same time. Use to limit the amount of memory
             used. If None, always run on all augmentations simultaneously.
             Default is None.
+        clip_stride (int, optional): Only run every ``clip_stride''-th
+            augmentation of each video. Default is 1.
+        max_clips (int or None, optional): Maximum number of augmentations to
+            run per video (subsampled evenly). If None, all are run.
+            Default is None.
     """
 
     model.train(train)
@@ -316,27 +435,43 @@ def run_epoch(model, dataloader, train, optim, device, save_all=False, block_siz
             for (X, outcome) in dataloader:
 
                 y.append(outcome.numpy())
-                X = X.to(device)
                 outcome = outcome.to(device)
 
-                average = (len(X.shape) == 6)
-                if average:
-                    batch, n_clips, c, f, h, w = X.shape
-                    X = X.view(-1, c, f, h, w)
-
                 s1 += outcome.sum()
                 s2 += (outcome ** 2).sum()
 
-                if block_size is None:
-                    outputs = model(X)
+                if isinstance(X, list):
+                    # Windowed test-time augmentations (echonet.datasets.ClipWindows), run video by video
+                    if clip_stride != 1 or max_clips is not None:
+                        X = [x.subset(echonet.utils.select_clips(len(x), clip_stride, max_clips)) for x in X]
+                    outputs = [run_clips(model, x, device, block_size) for x in X]
+                    if save_all:
+                        yhat.extend(o.view(-1).to("cpu").detach().numpy() for o in outputs)
+                    outputs = torch.stack([o.mean(0) for o in outputs])
+                    count = sum(len(x) for x in X)
                 else:
-                    outputs = torch.cat([model(X[j:(j + block_size), ...]) for j in range(0, X.shape[0], block_size)])
+                    average = (len(X.shape) == 6)
+                    if average and (clip_stride != 1 or max_clips is not None):
+                        # Subsample test-time augmentations before moving them to the device
+                        X = X[:, echonet.utils.select_clips(X.shape[1], clip_stride, max_clips), ...]
 
-                if save_all:
-                    yhat.append(outputs.view(-1).to("cpu").detach().numpy())
+                    X = X.to(device)
+
+                    if average:
+                        batch, n_clips, c, f, h, w = X.shape
+                        X = X.view(-1, c, f, h, w)
 
-                if average:
-                    outputs = outputs.view(batch, n_clips, -1).mean(1)
+                    if block_size is None:
+                        outputs = model(X)
+                    else:
+                        outputs = torch.cat([model(X[j:(j + block_size), ...]) for j in range(0, X.shape[0], block_size)])
+
+                    if save_all:
+                        yhat.append(outputs.view(-1).to("cpu").detach().numpy())
+
+                    if average:
+                        outputs = outputs.view(batch, n_clips, -1).mean(1)
+                    count = X.size(0)
 
                 if not save_all:
                     yhat.append(outputs.view(-1).to("cpu").detach().numpy())
@@ -348,8 +483,8 @@ def run_epoch(model, dataloader, train, optim, device, save_all=False, block_siz
                     loss.backward()
                     optim.step()
 
-                total += loss.item() * X.size(0)
-                n += X.size(0)
+                total += loss.item() * count
+                n += count
 
                 pbar.set_postfix_str("{:.2f} ({:.2f}) / {:.2f}".format(total / n, loss.item(), s2 / n - (s1 / n) ** 2))
                 pbar.update()
@@ -359,3 +494,27 @@ def run_epoch(model, dataloader, train, optim, device, save_all=False, block_siz
     y = np.concatenate(y)
 
     return total / n, yhat, y
+
+
+def run_clips(model, windows, device, block_size=None):
+    """Runs a model on all clips of a video, gathering one block of clips at a time.
+
+    The video is moved to the device once, so memory stays proportional to
+    the length of the video instead of the number of clips.
+
+    Args:
+        model (torch.nn.Module): Model to evaluate.
+        windows (echonet.datasets.ClipWindows): Clips of the video.
+        device (torch.device): Device to run on
+        block_size (int or None, optional): Maximum number of clips to run on
+            at the same time. If None, all clips are run simultaneously.
+            Default is None.
+
+    Returns:
+        The outputs of the model for each clip, with dimensions (clips, outputs).
+    """
+
+    video = torch.as_tensor(windows.video).to(device)
+    if block_size is None:
+        block_size = max(len(windows), 1)
+    return torch.cat([model(windows.clips(video, j, j + block_size)) for j in range(0, len(windows), block_size)])
@@ -0,0 +1,323 @@
+import heapq
+import importlib
+import itertools
+import multiprocessing
+import multiprocessing.connection
+import threading
+import time
+
+
+class QueueFullError(Exception):
+    """La cola de análisis alcanzó su límite de trabajos pendientes."""
+
+
+def _worker_main(worker_id, processor_class, processor_args, processor_kwargs, torch_threads, tasks, events, cancel_event):
+    """Bucle de un proceso del pool: carga sus modelos una vez y procesa trabajos.
+
+    ``events`` es el extremo de escritura de una tubería propia del proceso:
+    si muere a mitad de un envío no bloquea a los demás procesos.
+    """
+    if torch_threads:
+        import torch
+        torch.set_num_threads(torch_threads)
+
+    try:
+        module, name = processor_class.rsplit(".", 1)
+        processor = getattr(importlib.import_module(module), name)(*processor_args, **processor_kwargs)
+    except Exception as e:
+        # El pool vuelve a lanzar el proceso al detectar su salida
+        print(f"Error al iniciar el proceso de análisis {worker_id}: {e}")
+        events.send(("failed", worker_id, None, str(e)))
+        return
+    events.send(("ready", worker_id, None, None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        job_id, videos_folder, output_dir = task
+
+        def update_progress(progress, message):
+            if cancel_event.is_set():
+                raise Exception("Cancelled")
+            events.send(("progress", worker_id, job_id, (progress, message)))
+
+        try:
+            processor.process_videos(videos_folder, update_progress, output_dir=output_dir)
+            events.send(("completed", worker_id, job_id, None))
+        except Exception as e:
+            if str(e) == "Cancelled":
+                events.send(("cancelled", worker_id, job_id, None))
+            else:
+                print(f"Error en tarea {job_id}: {e}")
+                events.send(("error", worker_id, job_id, str(e)))
+
+
+class AnalysisPool:
+    """Cola acotada de análisis servida por procesos con modelos precargados.
+
+    Cada proceso construye su propio DeepCardioProcessor, de modo que PyTorch
+    y matplotlib no compiten por el GIL del proceso web. Los trabajos
+    pendientes se ordenan por prioridad (mayor primero, FIFO a igual
+    prioridad) y solo se entregan a un proceso cuando está libre. El estado
+    de cada trabajo se escribe en el diccionario ``jobs``.
+
+    Si un proceso muere (falta de memoria, fallo nativo o error al construir
+    el procesador), su trabajo se marca como fallido y se lanza otro proceso
+    en su lugar. Tras ``max_start_failures`` arranques fallidos seguidos no se
+    relanza más; si no queda ninguno, los trabajos pendientes y los nuevos se
+    marcan como fallidos en vez de esperar para siempre.
+    """
+
+    def __init__(self, jobs, processor_args, processor_kwargs=None, num_workers=1, max_queue=16, torch_threads=None,
+                 processor_class="processor.DeepCardioProcessor", max_start_failures=3):
+        self.jobs = jobs
+        self.processor_class = processor_class
+        self.processor_args = processor_args
+        self.processor_kwargs = processor_kwargs or {}
+        self.num_workers = num_workers
+        self.max_queue = max_queue
+        self.max_start_failures = max_start_failures
+        if torch_threads is None:
+            torch_threads = max(1, (multiprocessing.cpu_count() or 1) // num_workers)
+        self.torch_threads = torch_threads
+
+        self._ctx = multiprocessing.get_context("spawn")
+        self._cond = threading.Condition()
+        self._pending = []  # heap de (-prioridad, orden, job_id, videos_folder, output_dir)
+        self._order = itertools.count()
+        self._worker_ids = itertools.count()
+        self._workers = {}  # worker_id -> (process, tasks, cancel_event, events); cada relanzamiento tiene un id nuevo
+        self._ready = set()
+        self._idle = []
+        self._running = {}  # worker_id -> job_id
+        self._start_failures = 0
+        self._last_error = None
+        self._failure = None
+        self._started = False
+        self._closed = False
+
+    def start(self):
+        """Lanza los procesos del pool (solo la primera vez)."""
+        with self._cond:
+            if self._started:
+                return
+            self._started = True
+
+            for _ in range(self.num_workers):
+                self._spawn()
+
+        threading.Thread(target=self._listen, daemon=True).start()
+        threading.Thread(target=self._dispatch, daemon=True).start()
+
+    def close(self):
+        """Detiene los procesos del pool; los trabajos pendientes quedan sin servir."""
+        with self._cond:
+            self._closed = True
+            workers = list(self._workers.values())
+            self._cond.notify_all()
+        for (_, tasks, _, _) in workers:
+            tasks.put(None)
+        for (process, _, _, _) in workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+    def submit(self, job_id, videos_folder, output_dir=None, priority=0, session_id=None):
+        """Encola un análisis; lanza QueueFullError si la cola está llena.
+
+        ``output_dir`` es la carpeta de resultados del trabajo (por defecto la
+        del procesador) y ``session_id`` la sesión que lo pidió.
+        """
+        self.start()
+        with self._cond:
+            if len(self._pending) >= self.max_queue:
+                raise QueueFullError(f"La cola de análisis está llena ({self.max_queue} trabajos pendientes)")
+            self.jobs[job_id] = {
+                'status': 'queued',
+                'progress': 0,
+                'message': 'En cola...',
+                'priority': priority,
+                'output_dir': output_dir,
+                'session_id': session_id
+            }
+            if self._failure is not None:
+                self._fail(job_id, self._failure)
+                return
+            heapq.heappush(self._pending, (-priority, next(self._order), job_id, videos_folder, output_dir))
+            self._cond.notify_all()
+
+    def cancel(self, job_id):
+        """Cancela un trabajo pendiente o en ejecución. Devuelve False si no existe."""
+        with self._cond:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return False
+
+            pending = [p for p in self._pending if p[2] != job_id]
+            if len(pending) != len(self._pending):
+                self._pending = pending
+                heapq.heapify(self._pending)
+            for (worker_id, running_id) in self._running.items():
+                if running_id == job_id:
+                    self._workers[worker_id][2].set()
+            if job_id not in self._running.values():
+                # Si se está ejecutando, termina cuando el proceso lo deja
+                job.setdefault('finished_at', time.time())
+
+            job['status'] = 'cancelled'
+            job['message'] = 'Cancelado por el usuario'
+            return True
+
+    def expire_jobs(self, max_age):
+        """Olvida los trabajos terminados hace más de ``max_age`` segundos y devuelve sus ids."""
+        now = time.time()
+        with self._cond:
+            expired = [job_id for (job_id, job) in self.jobs.items()
+                       if job['status'] in ('completed', 'error', 'cancelled')
+                       and now - job.get('finished_at', now) > max_age]
+            for job_id in expired:
+                del self.jobs[job_id]
+            return expired
+
+    def queue_position(self, job_id):
+        """Posición (1 = siguiente) de un trabajo pendiente, o None."""
+        with self._cond:
+            for (position, entry) in enumerate(sorted(self._pending)):
+                if entry[2] == job_id:
+                    return position + 1
+        return None
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._pending)
+
+    def _spawn(self):
+        # Llamar con self._cond adquirido
+        worker_id = next(self._worker_ids)
+        tasks = self._ctx.Queue()
+        cancel_event = self._ctx.Event()
+        events, worker_events = self._ctx.Pipe(duplex=False)
+        process = self._ctx.Process(
+            target=_worker_main,
+            args=(worker_id, self.processor_class, self.processor_args, self.processor_kwargs, self.torch_threads,
+                  tasks, worker_events, cancel_event),
+            daemon=True)
+        process.start()
+        worker_events.close()
+        self._workers[worker_id] = (process, tasks, cancel_event, events)
+
+    def _fail(self, job_id, message):
+        job = self.jobs[job_id]
+        job['status'] = 'error'
+        job['error'] = message
+        job['message'] = f"Error: {message}"
+        job['finished_at'] = time.time()
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not (self._idle and self._pending) and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                _, _, job_id, videos_folder, output_dir = heapq.heappop(self._pending)
+                worker_id = self._idle.pop()
+                _, tasks, cancel_event, _ = self._workers[worker_id]
+                cancel_event.clear()
+                self._running[worker_id] = job_id
+                self.jobs[job_id]['status'] = 'processing'
+                self.jobs[job_id]['message'] = 'Iniciando...'
+                tasks.put((job_id, videos_folder, output_dir))
+
+    def _listen(self):
+        # Espera a la vez los mensajes de cada proceso y su salida (``sentinel``)
+        while True:
+            with self._cond:
+                if self._closed or not self._workers:
+                    return
+                waiting = {}
+                for (worker_id, (process, _, _, events)) in self._workers.items():
+                    waiting[events] = waiting[process.sentinel] = worker_id
+            for ready in multiprocessing.connection.wait(list(waiting)):
+                worker_id = waiting[ready]
+                if worker_id not in self._workers:
+                    continue
+                events = self._workers[worker_id][3]
+                try:
+                    # Al morir, primero se procesan los mensajes que dejó enviados
+                    while events.poll():
+                        self._handle(*events.recv())
+                except EOFError:
+                    pass
+                else:
+                    if ready is events:
+                        continue
+                self._worker_died(worker_id)
+
+    def _handle(self, kind, worker_id, job_id, payload):
+        with self._cond:
+            if kind == "ready":
+                self._start_failures = 0
+                self._ready.add(worker_id)
+                self._idle.append(worker_id)
+                self._cond.notify_all()
+                return
+            if kind == "failed":
+                self._last_error = payload
+                return
+
+            job = self.jobs.get(job_id)
+            if kind == "progress":
+                if job is not None and job['status'] == 'processing':
+                    job['progress'], job['message'] = payload
+                return
+
+            # Un trabajo cancelado mientras se ejecutaba sigue cancelado
+            # aunque el proceso llegue a terminarlo
+            if job['status'] != 'cancelled':
+                if kind == "completed":
+                    job['status'] = 'completed'
+                    job['progress'] = 100
+                    job['message'] = 'Análisis completado exitosamente'
+                    job['finished_at'] = time.time()
+                elif kind == "cancelled":
+                    job['status'] = 'cancelled'
+                elif kind == "error":
+                    self._fail(job_id, payload)
+            job.setdefault('finished_at', time.time())
+
+            # El proceso queda libre para el siguiente trabajo
+            self._running.pop(worker_id, None)
+            self._idle.append(worker_id)
+            self._cond.notify_all()
+
+    def _worker_died(self, worker_id):
+        with self._cond:
+            if self._closed:
+                return
+            process, _, _, events = self._workers.pop(worker_id)
+            process.join()
+            events.close()
+            if worker_id in self._idle:
+                self._idle.remove(worker_id)
+            if worker_id not in self._ready:
+                self._start_failures += 1
+            self._ready.discard(worker_id)
+
+            reason = f"El proceso de análisis terminó inesperadamente (código {process.exitcode})"
+            job_id = self._running.pop(worker_id, None)
+            if job_id is not None and self.jobs[job_id]['status'] == 'processing':
+                print(f"Error en tarea {job_id}: {reason}")
+                self._fail(job_id, reason)
+
+            if self._start_failures < self.max_start_failures:
+                self._spawn()
+            elif not self._workers:
+                # Ningún proceso consigue arrancar: no dejar trabajos esperando
+                self._failure = f"No se pudo iniciar el procesador: {self._last_error or reason}"
+                print(self._failure)
+                for (_, _, pending_id, _, _) in self._pending:
+                    self._fail(pending_id, self._failure)
+                self._pending = []
+            self._cond.notify_all()
@@ -1,8 +1,12 @@
 from flask import Flask, request, jsonify, send_file, send_from_directory
 from flask_cors import CORS
+import concurrent.futures
 import os
-import uuid
+import re
+import sys
 import threading
+import time
+import uuid
 import shutil
 import pandas as pd
 import zipfile
@@ -12,7 +16,11 @@ import matplotlib
 matplotlib.use('Agg') # Asegurar backend no interactivo
 import matplotlib.pyplot as plt
 import numpy as np
-from processor import DeepCardioProcessor
+from analysis_pool import AnalysisPool, QueueFullError
+
+# Añadir el directorio padre para importar echonet (solo sus utilidades de video)
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import echonet
 
 app = Flask(__name__)
 CORS(app)
@@ -21,6 +29,8 @@ CORS(app)
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'temp_uploads')
 OUTPUT_FOLDER = os.path.join(BASE_DIR, 'output')
+# Cada análisis trabaja en jobs/<analysis_id>/{input,output}
+JOBS_FOLDER = os.path.join(BASE_DIR, 'jobs')
 WEIGHTS_FOLDER = os.path.join(BASE_DIR, 'weights')
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
@@ -28,17 +38,153 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 # Estado global de trabajos
 JOBS = {}
 
-# Inicializar procesador
-print("Inicializando DeepCardio Processor...")
-processor = DeepCardioProcessor(BASE_DIR, WEIGHTS_FOLDER, OUTPUT_FOLDER)
-print("DeepCardio Processor listo.")
+# "fixed" (estadísticas precalculadas en weights/) o "study" (por video)
+STATS_MODE = os.environ.get('DEEPCARDIO_STATS_MODE', 'fixed')
+# Procesos de análisis (cada uno con sus propios modelos) y trabajos en espera admitidos
+NUM_WORKERS = int(os.environ.get('DEEPCARDIO_WORKERS', '1'))
+MAX_QUEUE = int(os.environ.get('DEEPCARDIO_MAX_QUEUE', '16'))
+# Precisión de inferencia ("float32" o "bfloat16"), formato channels_last y
+# carpeta de AVIs para validar la precisión reducida contra float32 al arrancar
+PRECISION = os.environ.get('DEEPCARDIO_PRECISION', 'float32')
+CHANNELS_LAST = os.environ.get('DEEPCARDIO_CHANNELS_LAST', '0') == '1'
+PRECISION_REFERENCE = os.environ.get('DEEPCARDIO_PRECISION_REFERENCE')
+# Modelos float32 exportados a TorchScript en weights/torchscript/ (arranque más rápido)
+TORCHSCRIPT = os.environ.get('DEEPCARDIO_TORCHSCRIPT', '1') == '1'
+# Formato de los videos anotados ("mp4", "avi" o "both") y si se guardan además
+# los frames sin pérdida; el AVI se genera al pedirlo si no existe
+VIDEO_FORMAT = os.environ.get('DEEPCARDIO_VIDEO_FORMAT', 'mp4')
+KEEP_FRAMES = os.environ.get('DEEPCARDIO_KEEP_FRAMES', '0') == '1'
+# Segundos que una petición espera a que se genere un AVI antes de responder 202
+AVI_WAIT = float(os.environ.get('DEEPCARDIO_AVI_WAIT', '10'))
+# Clips para la EF: "tta" (todos los de 32 frames) o "single" (un clip aleatorio de 16)
+EF_PROTOCOL = os.environ.get('DEEPCARDIO_EF_PROTOCOL', 'tta')
+# Segundos que se conservan los trabajos terminados (estado y carpeta jobs/<id>)
+# y las sesiones de subida abandonadas
+JOB_RETENTION = int(os.environ.get('DEEPCARDIO_JOB_RETENTION', '86400'))
+
+# Los procesos del pool se lanzan con el primer análisis
+pool = AnalysisPool(JOBS, (BASE_DIR, WEIGHTS_FOLDER, OUTPUT_FOLDER),
+                    {'stats_mode': STATS_MODE, 'precision': PRECISION, 'channels_last': CHANNELS_LAST,
+                     'reference_folder': PRECISION_REFERENCE, 'torchscript': TORCHSCRIPT,
+                     'video_format': VIDEO_FORMAT, 'keep_frames': KEEP_FRAMES, 'ef_protocol': EF_PROTOCOL},
+                    num_workers=NUM_WORKERS, max_queue=MAX_QUEUE)
 
 def ensure_clean_folders():
     if os.path.exists(UPLOAD_FOLDER):
         shutil.rmtree(UPLOAD_FOLDER)
     os.makedirs(UPLOAD_FOLDER)
 
-ensure_clean_folders()
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+# Sesión usada por los clientes que no envían session_id
+DEFAULT_SESSION = 'default'
+VALID_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+def get_session_id():
+    """session_id del formulario, JSON o query string (None si no es válido)."""
+    data = request.get_json(silent=True) or {}
+    session_id = request.form.get('session_id') or data.get('session_id') or request.args.get('session_id') or DEFAULT_SESSION
+    if not VALID_ID.match(str(session_id)):
+        return None
+    return session_id
+
+def results_folder():
+    """Carpeta de resultados de ?analysis_id=... (None si no existe) o, si no
+    se indica, del último análisis completado de la sesión que hace la petición.
+
+    Si la sesión no tiene ninguno se devuelve una carpeta inexistente, de modo
+    que las rutas responden como antes del primer análisis (sin resultados).
+    """
+    analysis_id = request.args.get('analysis_id')
+    if analysis_id is None:
+        session_id = get_session_id()
+        completed = [(job['finished_at'], job['output_dir']) for job in list(JOBS.values())
+                     if job['status'] == 'completed' and job.get('output_dir') and job.get('session_id') == session_id]
+        if completed and session_id is not None:
+            return max(completed)[1]
+        return os.path.join(JOBS_FOLDER, '.empty')
+
+    if not VALID_ID.match(analysis_id):
+        return None
+    folder = os.path.join(JOBS_FOLDER, analysis_id, 'output')
+    return folder if os.path.isdir(folder) else None
+
+def cleanup_jobs():
+    """Borra los trabajos terminados hace más de JOB_RETENTION segundos.
+
+    También borra las carpetas de trabajos y sesiones de subida que no se
+    tocan desde hace más de JOB_RETENTION segundos (p. ej. de una ejecución
+    anterior del servidor).
+    """
+    expired = set(pool.expire_jobs(JOB_RETENTION))
+    now = time.time()
+    for (parent, keep) in ((JOBS_FOLDER, JOBS), (UPLOAD_FOLDER, ())):
+        if not os.path.isdir(parent):
+            continue
+        for name in os.listdir(parent):
+            path = os.path.join(parent, name)
+            try:
+                stale = name not in keep and now - os.path.getmtime(path) > JOB_RETENTION
+            except OSError:
+                continue
+            if name in expired or stale:
+                shutil.rmtree(path, ignore_errors=True)
+
+def ensure_avi(video_folder, base_name):
+    """Genera y deja en caché <base_name>.avi (MJPG) si no existe.
+
+    Se codifica desde los frames sin pérdida (<base_name>.npy) si se
+    guardaron, o si no desde el MP4. Devuelve False si no hay de dónde.
+    Desde el MP4 el AVI pasa por dos compresiones con pérdida (H.264 y
+    MJPG) y queda con peor calidad que uno codificado desde los frames;
+    para evitarlo hay que usar DEEPCARDIO_KEEP_FRAMES=1 o
+    DEEPCARDIO_VIDEO_FORMAT=both.
+    """
+    avi_path = os.path.join(video_folder, base_name + ".avi")
+    if os.path.exists(avi_path):
+        return True
+    frames_path = os.path.join(video_folder, base_name + ".npy")
+    mp4_path = os.path.join(video_folder, base_name + ".mp4")
+    if os.path.exists(frames_path):
+        frames = np.load(frames_path)
+    elif os.path.exists(mp4_path):
+        frames = echonet.utils.loadvideo(mp4_path)
+    else:
+        return False
+
+    # Se escribe aparte y se renombra para no servir nunca un AVI a medias
+    tmp_path = os.path.join(video_folder, f".{base_name}.{uuid.uuid4().hex}.avi")
+    try:
+        echonet.utils.savevideo(tmp_path, frames, 50)
+        os.replace(tmp_path, avi_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return True
+
+# Los AVIs se generan en hilos aparte, una sola vez por archivo: las
+# peticiones del mismo AVI esperan a la misma conversión y las de AVIs
+# distintos no se bloquean entre sí
+AVI_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix='avi')
+AVI_CONVERSIONS = {}
+AVI_CONVERSIONS_LOCK = threading.Lock()
+
+def request_avi(video_folder, base_name):
+    """Future de la generación de <base_name>.avi (la lanza si no está en curso)."""
+    avi_path = os.path.join(video_folder, base_name + ".avi")
+
+    def convert():
+        try:
+            return ensure_avi(video_folder, base_name)
+        finally:
+            with AVI_CONVERSIONS_LOCK:
+                AVI_CONVERSIONS.pop(avi_path, None)
+
+    with AVI_CONVERSIONS_LOCK:
+        future = AVI_CONVERSIONS.get(avi_path)
+        if future is None:
+            future = AVI_CONVERSIONS[avi_path] = AVI_EXECUTOR.submit(convert)
+    return future
 
 def clean_float(val):
     if val is None:
@@ -52,8 +198,18 @@ def clean_float(val):
 # ENDPOINTS
 # ============================================================================
 
+@app.route('/api/upload/session', methods=['POST'])
+def create_session():
+    session_id = uuid.uuid4().hex
+    os.makedirs(os.path.join(UPLOAD_FOLDER, session_id))
+    return jsonify({'success': True, 'session_id': session_id})
+
 @app.route('/api/upload/file', methods=['POST'])
 def upload_file():
+    session_id = get_session_id()
+    if session_id is None:
+        return jsonify({'error': 'Invalid session_id'}), 400
+    
     if 'file' not in request.files:
         return jsonify({'error': 'No file part'}), 400
     
@@ -62,36 +218,67 @@ def upload_file():
         return jsonify({'error': 'No selected file'}), 400
         
     if file:
-        filename = file.filename
+        filename = os.path.basename(file.filename)
         # Validación básica de extensión
         ext = os.path.splitext(filename)[1].lower()
         if ext not in ['.avi', '.dcm', '.dicom']:
              return jsonify({'error': 'Formato no soportado. Use .avi, .dcm o .dicom'}), 400
 
-        file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        return jsonify({'message': 'File uploaded successfully', 'filename': filename}), 200
+        session_folder = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
+        os.makedirs(session_folder, exist_ok=True)
+        file.save(os.path.join(session_folder, filename))
+        return jsonify({'message': 'File uploaded successfully', 'filename': filename, 'session_id': session_id}), 200
 
 @app.route('/api/analysis/start', methods=['POST'])
 def start_analysis():
     analysis_id = str(uuid.uuid4())
     
-    files = os.listdir(app.config['UPLOAD_FOLDER'])
-    if not files:
+    session_id = get_session_id()
+    if session_id is None:
+        return jsonify({'success': False, 'error': 'Invalid session_id'}), 400
+    
+    cleanup_jobs()
+    
+    session_folder = os.path.join(app.config['UPLOAD_FOLDER'], session_id)
+    if not os.path.isdir(session_folder) or not os.listdir(session_folder):
         return jsonify({'success': False, 'error': 'No files to analyze'}), 400
     
-    stop_event = threading.Event()
+    data = request.get_json(silent=True) or {}
+    try:
+        priority = int(data.get('priority', request.args.get('priority', 0)))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Invalid priority'}), 400
+    
+    if pool.queue_depth() >= pool.max_queue:
+        # Backpressure: el cliente debe reintentar más tarde (la sesión se conserva)
+        response = jsonify({'success': False, 'error': 'La cola de análisis está llena', 'queue_depth': pool.queue_depth()})
+        response.headers['Retry-After'] = '30'
+        return response, 503
     
-    JOBS[analysis_id] = {
-        'status': 'processing',
-        'progress': 0,
-        'message': 'Iniciando...',
-        'stop_event': stop_event
-    }
+    # Los archivos de la sesión pasan a la carpeta del trabajo, así que
+    # nuevas subidas con el mismo session_id forman otro lote
+    job_folder = os.path.join(JOBS_FOLDER, analysis_id)
+    input_folder = os.path.join(job_folder, 'input')
+    output_folder = os.path.join(job_folder, 'output')
+    os.makedirs(job_folder)
+    try:
+        os.replace(session_folder, input_folder)
+    except FileNotFoundError:
+        # Otro análisis de la misma sesión se llevó los archivos entre la
+        # comprobación y el movimiento
+        shutil.rmtree(job_folder, ignore_errors=True)
+        return jsonify({'success': False, 'error': 'Analysis already started for this session'}), 409
     
-    thread = threading.Thread(target=run_analysis_task, args=(analysis_id, stop_event))
-    thread.start()
+    try:
+        pool.submit(analysis_id, input_folder, output_folder, priority, session_id)
+    except QueueFullError as e:
+        os.replace(input_folder, session_folder)
+        shutil.rmtree(job_folder, ignore_errors=True)
+        response = jsonify({'success': False, 'error': str(e), 'queue_depth': pool.queue_depth()})
+        response.headers['Retry-After'] = '30'
+        return response, 503
     
-    return jsonify({'success': True, 'analysis_id': analysis_id})
+    return jsonify({'success': True, 'analysis_id': analysis_id, 'queue_position': pool.queue_position(analysis_id)})
 
 @app.route('/api/analysis/status/<analysis_id>', methods=['GET'])
 def get_status(analysis_id):
@@ -105,22 +292,22 @@ def get_status(analysis_id):
         'status': job['status'],
         'progress': job['progress'],
         'message': job['message'],
-        'error': job.get('error')
+        'error': job.get('error'),
+        'queue_position': pool.queue_position(analysis_id)
     })
 
 @app.route('/api/analysis/cancel/<analysis_id>', methods=['POST'])
 def cancel_analysis(analysis_id):
-    job = JOBS.get(analysis_id)
-    if job:
-        job['stop_event'].set()
-        job['status'] = 'cancelled'
-        job['message'] = 'Cancelado por el usuario'
+    if pool.cancel(analysis_id):
         return jsonify({'success': True})
     return jsonify({'success': False, 'error': 'Job not found'}), 404
 
 @app.route('/api/results/all', methods=['GET'])
 def get_all_results():
-    csv_path = os.path.join(OUTPUT_FOLDER, "classification_results.csv")
+    folder = results_folder()
+    if folder is None:
+        return jsonify({'success': False, 'error': 'Analysis ID not found'}), 404
+    csv_path = os.path.join(folder, "classification_results.csv")
     
     if not os.path.exists(csv_path):
         return jsonify({'success': False, 'count': 0, 'results': []})
@@ -178,7 +365,10 @@ def get_all_results():
     
 @app.route('/api/results/summary-plot', methods=['GET'])
 def get_summary_plot():
-    csv_path = os.path.join(OUTPUT_FOLDER, "classification_results.csv")
+    folder = results_folder()
+    if folder is None:
+        return jsonify({'error': 'Analysis ID not found'}), 404
+    csv_path = os.path.join(folder, "classification_results.csv")
     
     if not os.path.exists(csv_path):
         return jsonify({'error': 'No results available'}), 404
@@ -221,15 +411,32 @@ def get_summary_plot():
 # ============================================================================
 @app.route('/api/results/video/<filename>', methods=['GET'])
 def get_video(filename):
-    video_folder = os.path.join(OUTPUT_FOLDER, "videos")
+    folder = results_folder()
+    if folder is None:
+        return jsonify({'error': 'Analysis ID not found'}), 404
+    video_folder = os.path.join(folder, "videos")
     
     # 1. Intentar servir el archivo exacto solicitado (ej: video.avi)
     if os.path.exists(os.path.join(video_folder, filename)):
         return send_from_directory(video_folder, filename)
-    
-    # 2. Fallback: Si piden .avi pero no existe, intentar servir .mp4
+
+    # 2. Si piden un .avi que no se codificó, generarlo una vez (queda en caché).
+    # Si tarda más de AVI_WAIT segundos se responde 202 y el cliente reintenta.
+    base_name, ext = os.path.splitext(filename)
+    if ext.lower() == ".avi" and os.path.isdir(video_folder):
+        try:
+            if request_avi(video_folder, base_name).result(timeout=AVI_WAIT):
+                return send_from_directory(video_folder, base_name + ".avi")
+        except concurrent.futures.TimeoutError:
+            response = jsonify({'status': 'processing', 'message': 'Generando AVI...'})
+            response.headers['Retry-After'] = '5'
+            return response, 202
+        except Exception as e:
+            print(f"Error generando AVI de {base_name}: {e}")
+            return jsonify({'error': str(e)}), 500
+
+    # 3. Fallback: intentar servir .mp4
     # (Esto ayuda si el navegador prefiere MP4 o si solo se generó MP4)
-    base_name = os.path.splitext(filename)[0]
     mp4_name = base_name + ".mp4"
     if os.path.exists(os.path.join(video_folder, mp4_name)):
         return send_from_directory(video_folder, mp4_name)
@@ -243,7 +450,10 @@ def get_plot(filename):
     base_name = os.path.splitext(filename)[0]
     pdf_filename = base_name + ".pdf"
     
-    plot_path = os.path.join(OUTPUT_FOLDER, "size", pdf_filename)
+    folder = results_folder()
+    if folder is None:
+        return jsonify({'error': 'Analysis ID not found'}), 404
+    plot_path = os.path.join(folder, "size", pdf_filename)
     if os.path.exists(plot_path):
         return send_file(plot_path, mimetype='application/pdf')
     return jsonify({'error': 'Plot not found'}), 404
@@ -255,50 +465,32 @@ def get_csv(type):
     elif type == 'size': filename = "size.csv"
     elif type == 'classification': filename = "classification_results.csv"
     
-    file_path = os.path.join(OUTPUT_FOLDER, filename)
+    folder = results_folder()
+    if folder is None:
+        return jsonify({'error': 'Analysis ID not found'}), 404
+    file_path = os.path.join(folder, filename)
     if os.path.exists(file_path):
         return send_file(file_path, as_attachment=True)
     return jsonify({'error': 'CSV not found'}), 404
 
 @app.route('/api/results/export-all', methods=['GET'])
 def export_all():
+    folder = results_folder()
+    if folder is None:
+        return jsonify({'error': 'Analysis ID not found'}), 404
+    
     memory_file = io.BytesIO()
     with zipfile.ZipFile(memory_file, 'w', zipfile.ZIP_DEFLATED) as zf:
-        for root, dirs, files in os.walk(OUTPUT_FOLDER):
+        for root, dirs, files in os.walk(folder):
             for file in files:
                 file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, OUTPUT_FOLDER)
+                arcname = os.path.relpath(file_path, folder)
                 zf.write(file_path, arcname)
     
     memory_file.seek(0)
     return send_file(memory_file, download_name='deepcardio_results.zip', as_attachment=True)
 
-# ============================================================================
-# TAREA EN SEGUNDO PLANO
-# ============================================================================
-
-def run_analysis_task(analysis_id, stop_event):
-    try:
-        def update_progress(progress, message):
-            if stop_event.is_set():
-                raise Exception("Cancelled")
-            JOBS[analysis_id]['progress'] = progress
-            JOBS[analysis_id]['message'] = message
-            
-        processor.process_videos(app.config['UPLOAD_FOLDER'], update_progress)
-        
-        JOBS[analysis_id]['status'] = 'completed'
-        JOBS[analysis_id]['progress'] = 100
-        JOBS[analysis_id]['message'] = 'Análisis completado exitosamente'
-        
-    except Exception as e:
-        if str(e) == "Cancelled":
-            JOBS[analysis_id]['status'] = 'cancelled'
-        else:
-            JOBS[analysis_id]['status'] = 'error'
-            JOBS[analysis_id]['error'] = str(e)
-            JOBS[analysis_id]['message'] = f"Error: {str(e)}"
-            print(f"Error en tarea {analysis_id}: {e}")
-
 if __name__ == '__main__':
+    # Los procesos del pool importan este módulo sin ejecutar este bloque
+    ensure_clean_folders()
     app.run(host='0.0.0.0', port=5000, debug=True, threaded=True)
\ No newline at end of file
@@ -67,7 +67,7 @@ def main(fig_root=os.path.join("figure", "noise"),
             INTER.append([])
             UNION.append([])
 
-            dataset = echonet.datasets.Echo(split="test", noise=noise)
+            dataset = echonet.datasets.Echo(split="test", noise=noise, noise_seed=0)
             PIL.Image.fromarray(dataset[0][0][:, 0, :, :].astype(np.uint8).transpose(1, 2, 0)).save(os.path.join(fig_root, "noise_{}.tif".format(round(100 * noise))))
 
             mean, std = echonet.utils.get_mean_and_std(echonet.datasets.Echo(split="train"))
@@ -77,7 +77,8 @@ def main(fig_root=os.path.join("figure", "noise"),
                 "target_type": tasks,
                 "mean": mean,
                 "std": std,
-                "noise": noise
+                "noise": noise,
+                "noise_seed": 0
             }
             dataset = echonet.datasets.Echo(split="test", **kwargs)
 
@@ -97,7 +98,8 @@ def main(fig_root=os.path.join("figure", "noise"),
                       "std": std,
                       "length": 32,
                       "period": 2,
-                      "noise": noise
+                      "noise": noise,
+                      "noise_seed": 0
                       }
 
             dataset = echonet.datasets.Echo(split="test", **kwargs)
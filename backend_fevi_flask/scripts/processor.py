@@ -1,3 +1,5 @@
+import collections
+import hashlib
 import os
 import sys
 import time
@@ -19,11 +21,117 @@ import pydicom
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import echonet
 
+
+class _DecodedEcho(echonet.datasets.Echo):
+    """Dataset Echo que sirve videos ya decodificados en memoria.
+
+    ``buffers`` asocia el nombre de cada archivo de ``external_test_location``
+    con su video uint8 (channels=3, frames, height, width), de modo que el
+    pipeline no vuelve a leer el AVI del disco.
+    """
+
+    def __init__(self, buffers, external_test_location, stats=None, **kwargs):
+        super().__init__(split="external_test", external_test_location=external_test_location, **kwargs)
+        # Solo los videos decodificados (la carpeta puede tener otros archivos)
+        self.fnames = list(buffers)
+        self.buffers = buffers
+        self.stats = stats
+
+    def __getitem__(self, index):
+        # Normalización propia de cada estudio (si se calcularon por video)
+        if self.stats is not None:
+            self.mean, self.std = self.stats[self.fnames[index]]
+        return super().__getitem__(index)
+
+    def _video_shape(self, index):
+        return self.buffers[self.fnames[index]].shape
+
+    def _load_video(self, index, start=0, stop=None, step=1):
+        return self.buffers[self.fnames[index]][:, start:stop:step]
+
+
+def _mean_and_std(videos):
+    """Calcula media y desviación estándar por canal de videos uint8.
+
+    Usa un histograma de los 256 valores posibles por canal, así que no hace
+    copias en float de los videos.
+    """
+    counts = np.zeros((3, 256), np.int64)
+    for video in videos:
+        for (c, channel) in enumerate(video):
+            counts[c] += np.bincount(channel.reshape(-1), minlength=256)
+
+    values = np.arange(256, dtype=np.float64)
+    n = counts.sum(1)
+    mean = (counts @ values) / n
+    std = np.sqrt((counts @ values ** 2) / n - mean ** 2)
+
+    return mean.astype(np.float32), std.astype(np.float32)
+
+
 class DeepCardioProcessor:
-    def __init__(self, base_dir, weights_dir, output_dir):
+    # Archivo de estadísticas generado con `python -m echonet stats`
+    STATS_FILENAME = "echonet_mean_std.npz"
+
+    PRECISIONS = ("float32", "bfloat16")
+    # "mp4": un único MP4 para la web (el AVI lo genera la API al pedirlo);
+    # "avi": solo el AVI MJPG; "both": ambos
+    VIDEO_FORMATS = ("mp4", "avi", "both")
+    # Protocolo de EF: "tta" promedia los clips de 32 frames con periodo 2
+    # (r2plus1d_18_32_2, como el test de `echonet video`); "single" es el
+    # anterior, un único clip aleatorio de 16 frames con padding de 12
+    EF_PROTOCOLS = ("tta", "single")
+
+    def __init__(self, base_dir, weights_dir, output_dir, stats_mode="fixed", ef_batch_size=32,
+                 ef_clip_stride=1, ef_max_clips=None, precision="float32", channels_last=False,
+                 reference_folder=None, max_ef_error=1.0, torchscript=True, video_format="mp4",
+                 keep_frames=False, ef_protocol="tta"):
+        """Prepara directorios, pesos, modelos y estadísticas de normalización.
+
+        stats_mode: "fixed" normaliza con la media/desviación guardadas junto a
+        los pesos; "study" las calcula para cada video mientras se decodifica.
+        ef_batch_size: número de clips (de cualquier video) por pasada del
+        modelo de EF.
+        ef_clip_stride / ef_max_clips: política de test-time augmentation para
+        la EF (ver `echonet.utils.video.evaluate_tta_policies` para su error
+        frente a usar todos los clips).
+        precision: "float32" o "bfloat16" (autocast).
+        channels_last: usar formato de memoria channels_last(_3d) en modelos y
+        entradas.
+        reference_folder / max_ef_error: si se usa una precisión reducida y se
+        indica una carpeta de AVIs de referencia, se compara contra float32 al
+        arrancar (`check_precision`); si el error de EF supera
+        `max_ef_error` se vuelve a float32.
+        torchscript: en float32, cargar los modelos como TorchScript congelado,
+        exportado una vez a `weights/torchscript/` (ver `_load_model`).
+        video_format: formato(s) en que se codifican los videos anotados (ver
+        `VIDEO_FORMATS`).
+        keep_frames: guardar además los frames anotados sin pérdida
+        (`videos/<nombre>.npy`, uint8), de los que se genera el AVI a demanda.
+        ef_protocol: clips con los que se predice la EF (ver `EF_PROTOCOLS`).
+        """
+        if stats_mode not in ("fixed", "study"):
+            raise ValueError(f"stats_mode debe ser 'fixed' o 'study', no '{stats_mode}'")
+        if precision not in self.PRECISIONS:
+            raise ValueError(f"precision debe ser una de {self.PRECISIONS}, no '{precision}'")
+        if video_format not in self.VIDEO_FORMATS:
+            raise ValueError(f"video_format debe ser uno de {self.VIDEO_FORMATS}, no '{video_format}'")
+        if ef_protocol not in self.EF_PROTOCOLS:
+            raise ValueError(f"ef_protocol debe ser uno de {self.EF_PROTOCOLS}, no '{ef_protocol}'")
+
         self.base_dir = base_dir
         self.weights_dir = weights_dir
         self.output_dir = output_dir
+        self.stats_mode = stats_mode
+        self.ef_batch_size = ef_batch_size
+        self.ef_clip_stride = ef_clip_stride
+        self.ef_max_clips = ef_max_clips
+        self.precision = precision
+        self.channels_last = channels_last
+        self.torchscript = torchscript
+        self.video_format = video_format
+        self.keep_frames = keep_frames
+        self.ef_protocol = ef_protocol
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         
         # URLs de pesos. esta seccion se descomenta cuando se tengan los urls de los pesos
@@ -33,15 +141,28 @@ class DeepCardioProcessor:
         self._ensure_directories()
         self._download_weights()
         
-        self.seg_model = self._load_seg_model()
-        self.ef_model = self._load_ef_model()
+        self.seg_model = self._load_model("seg", self._load_seg_model, self.seg_weights_url, (2, 3, 112, 112), torch.channels_last)
+        self.ef_model = self._load_model("ef", self._load_ef_model, self.ef_weights_url, (1, 3, 32, 112, 112), torch.channels_last_3d)
+        self.mean, self.std = self._load_stats()
+
+        if (precision != "float32" or channels_last) and reference_folder is not None:
+            result = self.check_precision(reference_folder)
+            if result["ef_max_error"] > max_ef_error:
+                print(f"La EF con precision={precision} difiere hasta {result['ef_max_error']:.2f} puntos "
+                      f"de float32 (límite {max_ef_error}); se usará float32.")
+                self.precision, self.channels_last = "float32", False
+                self.seg_model = self._load_seg_model()
+                self.ef_model = self._load_ef_model()
 
     def _ensure_directories(self):
         os.makedirs(self.weights_dir, exist_ok=True)
-        os.makedirs(self.output_dir, exist_ok=True)
-        os.makedirs(os.path.join(self.output_dir, "videos"), exist_ok=True)
-        os.makedirs(os.path.join(self.output_dir, "size"), exist_ok=True)
-        os.makedirs(os.path.join(self.output_dir, "labels"), exist_ok=True)
+        self._ensure_output_directories(self.output_dir)
+
+    def _ensure_output_directories(self, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        os.makedirs(os.path.join(output_dir, "videos"), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, "size"), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, "labels"), exist_ok=True)
 
     def _download_weights(self):
         seg_path = os.path.join(self.weights_dir, os.path.basename(self.seg_weights_url))
@@ -55,6 +176,20 @@ class DeepCardioProcessor:
             print(f"Descargando pesos de EF a {ef_path}...")
             wget.download(self.ef_weights_url, out=self.weights_dir)
 
+    def _load_stats(self):
+        if self.stats_mode != "fixed":
+            return None, None
+
+        stats_path = os.path.join(self.weights_dir, self.STATS_FILENAME)
+        if not os.path.exists(stats_path):
+            print(f"No se encontró {stats_path} (generar con `python -m echonet stats`); "
+                  "se usarán estadísticas por estudio.")
+            self.stats_mode = "study"
+            return None, None
+
+        print("Cargando estadísticas de normalización...")
+        return echonet.utils.load_mean_and_std(stats_path)
+
     def _load_seg_model(self):
         print("Cargando modelo de segmentación...")
         model = torchvision.models.segmentation.deeplabv3_resnet50(pretrained=False, aux_loss=False)
@@ -95,6 +230,219 @@ class DeepCardioProcessor:
         model.eval()
         return model
 
+    def _load_model(self, name, loader, weights_url, example_shape, memory_format):
+        """Carga un modelo listo para inferencia.
+
+        En float32 el modelo se exporta una sola vez con ``torch.jit.trace`` +
+        ``torch.jit.freeze`` a ``weights/torchscript/``, con un nombre que
+        incluye un hash del checkpoint y de las versiones de torch y
+        torchvision, el dispositivo y el formato de memoria; los siguientes
+        arranques cargan ese archivo sin reconstruir el modelo de torchvision
+        ni el checkpoint. Si el archivo no se puede cargar, se exporta de nuevo. Con precisión reducida (autocast)
+        o varias GPUs se usa el modelo de PyTorch directamente.
+        """
+        if not self.torchscript or self.precision != "float32" or torch.cuda.device_count() > 1:
+            return self._prepare_model(loader(), memory_format)
+
+        sha1 = hashlib.sha1()
+        with open(os.path.join(self.weights_dir, os.path.basename(weights_url)), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(chunk)
+        # Un grafo congelado con otra versión de PyTorch no se reutiliza
+        sha1.update(f"torch={torch.__version__};torchvision={torchvision.__version__}".encode())
+        cache_dir = os.path.join(self.weights_dir, "torchscript")
+        suffix = "-cl" if self.channels_last else ""
+        path = os.path.join(cache_dir, f"{name}-{sha1.hexdigest()[:16]}-{self.device.type}{suffix}.pt")
+
+        if os.path.exists(path):
+            try:
+                return torch.jit.load(path, map_location=self.device)
+            except Exception as e:
+                print(f"No se pudo cargar {path} ({e}); se exporta de nuevo.")
+
+        model = self._prepare_model(loader(), memory_format)
+        if isinstance(model, torch.nn.DataParallel):
+            model = model.module
+        example = torch.zeros(example_shape, device=self.device)
+        if self.channels_last:
+            example = example.contiguous(memory_format=memory_format)
+        with torch.no_grad():
+            module = torch.jit.freeze(torch.jit.trace(model, example, strict=False))
+
+        print(f"Guardando modelo TorchScript en {path}...")
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = path + f".{os.getpid()}.tmp"
+        torch.jit.save(module, tmp)
+        os.replace(tmp, path)
+        return module
+
+    def _prepare_model(self, model, memory_format):
+        """Aplica el formato de memoria configurado."""
+        if self.channels_last:
+            model = model.to(memory_format=memory_format)
+        return model
+
+    def _run_model(self, model, x, memory_format):
+        """Ejecuta un modelo con el formato de memoria y la precisión configurados."""
+        if self.channels_last:
+            x = x.contiguous(memory_format=memory_format)
+        with torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=(self.precision == "bfloat16")):
+            return model(x)
+
+    def _segment(self, video, mean, std, max_length, block=1024):
+        """Logits de segmentación (frames, height, width) en float16 de un video uint8."""
+        x = video[:, :max_length, :, :].astype(np.float32)
+        x -= mean.reshape(3, 1, 1, 1)
+        x /= std.reshape(3, 1, 1, 1)
+        x = torch.as_tensor(np.swapaxes(x, 0, 1)).to(self.device)
+
+        y_list = []
+        with torch.no_grad():
+            for idx in range(0, x.shape[0], block):
+                batch = x[idx:(idx + block), :, :, :]
+                output = self._run_model(self.seg_model, batch, torch.channels_last)["out"]
+                y_list.append(output.detach().float().cpu().numpy())
+
+        return np.concatenate(y_list, axis=0).astype(np.float16)[:, 0, :, :]
+
+    def check_precision(self, reference_folder, frames=32, period=2, max_length=250):
+        """Compara EF y segmentación de la configuración actual contra float32.
+
+        Usa los AVIs de ``reference_folder`` y devuelve un dict con el error
+        absoluto medio y máximo de la EF (en puntos porcentuales) y el Dice
+        entre ambas segmentaciones.
+        """
+        buffers = collections.OrderedDict()
+        stats = {}
+        for filename in sorted(os.listdir(reference_folder)):
+            if filename.lower().endswith(".avi"):
+                video = echonet.utils.loadvideo(os.path.join(reference_folder, filename))
+                buffers[filename] = video
+                stats[filename] = (self.mean, self.std) if self.stats_mode == "fixed" else _mean_and_std([video])
+        if not buffers:
+            raise ValueError(f"No hay videos .avi de referencia en {reference_folder}")
+
+        def predict():
+            ds = _DecodedEcho(buffers, reference_folder, stats=stats, target_type="Filename",
+                              length=frames, period=period, clips="all", windowed=True,
+                              clip_stride=self.ef_clip_stride, max_clips=self.ef_max_clips)
+            ef = {f: np.mean(p) for (f, p) in self._predict_ef(ds).items()}
+            masks = {f: self._segment(v, *stats[f], max_length) > 0 for (f, v) in buffers.items()}
+            return ef, masks
+
+        ef, masks = predict()
+
+        current = (self.precision, self.channels_last, self.seg_model, self.ef_model)
+        try:
+            self.precision, self.channels_last = "float32", False
+            self.seg_model = self._load_seg_model()
+            self.ef_model = self._load_ef_model()
+            ef_ref, masks_ref = predict()
+        finally:
+            self.precision, self.channels_last, self.seg_model, self.ef_model = current
+
+        error = np.array([abs(ef[f] - ef_ref[f]) for f in buffers])
+        inter = sum((masks[f] & masks_ref[f]).sum() for f in buffers)
+        total = sum(masks[f].sum() + masks_ref[f].sum() for f in buffers)
+        result = {
+            "videos": len(buffers),
+            "ef_mean_error": float(error.mean()),
+            "ef_max_error": float(error.max()),
+            "dice": float(2 * inter / total) if total else 1.0,
+        }
+        print(f"Precisión {self.precision} (channels_last={self.channels_last}) frente a float32: "
+              f"EF error medio {result['ef_mean_error']:.3f}, máximo {result['ef_max_error']:.3f}, "
+              f"Dice {result['dice']:.4f} ({result['videos']} videos)")
+        return result
+
+    def _predict_ef(self, ds):
+        """Predice la EF de todos los clips de ``ds`` en lotes de tamaño fijo.
+
+        Los clips de test-time augmentation de videos distintos comparten la
+        misma pasada del modelo; cada predicción se devuelve a su video. Los
+        clips se copian al lote solo cuando entran en él, así que la memoria no
+        crece con el número de clips por video. ``ds`` devuelve por video sus
+        clips (`ClipWindows`) o un único clip (channels=3, frames, height, width).
+
+        Returns:
+            dict: nombre de archivo -> np.array con la predicción de cada clip.
+        """
+        yhat = collections.defaultdict(list)
+        batch = None
+        owners = []
+
+        def flush():
+            x = torch.from_numpy(batch[:len(owners)]).to(self.device)
+            outputs = self._run_model(self.ef_model, x, torch.channels_last_3d).view(-1).float().cpu().numpy()
+            for (filename, p) in zip(owners, outputs):
+                yhat[filename].append(p)
+            owners.clear()
+
+        with torch.no_grad():
+            for index in range(len(ds)):
+                clips, filename = ds[index]
+                if isinstance(clips, np.ndarray):
+                    clips = echonet.datasets.ClipWindows(clips, [0], clips.shape[1], 1)
+
+                if batch is None or batch.shape[1:] != clips.shape[1:]:
+                    # Videos con otro tamaño de frame no se pueden mezclar en el lote
+                    if owners:
+                        flush()
+                    batch = np.empty((self.ef_batch_size,) + clips.shape[1:], np.float32)
+
+                start = 0
+                while start < len(clips):
+                    n = min(self.ef_batch_size - len(owners), len(clips) - start)
+                    batch[len(owners):(len(owners) + n)] = clips.clips(None, start, start + n)
+                    owners.extend([filename] * n)
+                    start += n
+                    if len(owners) == self.ef_batch_size:
+                        flush()
+
+            if owners:
+                flush()
+
+        return {filename: np.array(pred) for (filename, pred) in yhat.items()}
+
+    @staticmethod
+    def _render_video(video, logit, size_norm, peaks):
+        """Compone el video de salida (3, T, 2H, 2W) en uint8.
+
+        Arriba: el eco en gris y, a la derecha, la segmentación en amarillo.
+        Abajo: la curva de tamaño (blanco), el cursor del frame actual (rojo,
+        7x7) y una línea amarilla en cada sístole, dibujados con
+        `echonet.utils.render`.
+        """
+        render = echonet.utils.render
+        img = render.side_by_side(np.broadcast_to(video[:1], video.shape), logit > 0, (0, 1))
+        rows, cols = render.curve(size_norm)
+
+        # Curva estática (3x3) en todos los frames
+        render.stamp(img, rows, cols, render.square(1), 255)
+
+        # Las líneas de los picos se pintan en todos los frames, pero el cursor
+        # de un frame posterior al pico queda por encima
+        peaks = sorted(peaks)
+        yellow = (255, 255, 0)
+        render.vline(img, cols[peaks], slice(200, 225), yellow)
+        render.stamp(img, rows, cols, render.square(3), (255, 0, 0), frames=np.arange(len(rows)))
+        for p in peaks:
+            render.vline(img, cols[p], slice(200, 225), yellow, frames=slice(0, p + 1))
+
+        return img
+
+    def _save_video(self, img, videos_dir, base_name):
+        """Codifica un video anotado según `video_format` (se ejecuta en el hilo de codificación)."""
+        # Codificar una sola vez: MP4 para la web y/o AVI MJPG (si el MP4
+        # falla se guarda el AVI para no quedarse sin video)
+        save_avi = self.video_format in ("avi", "both")
+        if self.video_format in ("mp4", "both"):
+            save_avi |= not self._save_as_mp4(img, os.path.join(videos_dir, base_name + ".mp4"))
+        if save_avi:
+            echonet.utils.savevideo(os.path.join(videos_dir, base_name + ".avi"), img, 50)
+        if self.keep_frames:
+            np.save(os.path.join(videos_dir, base_name + ".npy"), img)
+
     def _save_as_mp4(self, img_array, output_path):
         """Convierte el array de frames (C, T, H, W) a un archivo MP4 compatible con web."""
         try:
@@ -107,11 +455,11 @@ class DeepCardioProcessor:
                 print("Codec avc1 no disponible, intentando mp4v...")
                 fourcc = cv2.VideoWriter_fourcc(*'mp4v')
                 out = cv2.VideoWriter(output_path, fourcc, fps, (w, h))
+            if not out.isOpened():
+                print(f"No hay codec MP4 disponible para {output_path}")
+                return False
 
-            for frame_idx in range(t):
-                frame = img_array[:, frame_idx, :, :]
-                frame = np.transpose(frame, (1, 2, 0))
-                frame = frame.astype(np.uint8)
+            for frame in np.asarray(img_array, np.uint8).transpose(1, 2, 3, 0):
                 frame_bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
                 out.write(frame_bgr)
                 
@@ -217,11 +565,16 @@ class DeepCardioProcessor:
     # PROCESAMIENTO PRINCIPAL
     # =========================================================================
 
-    def process_videos(self, videos_folder, progress_callback=None):
+    def process_videos(self, videos_folder, progress_callback=None, output_dir=None):
         # Carpeta temporal aislada para que EchoNet solo vea AVIs válidos
         inference_folder = os.path.join(videos_folder, "inference_ready")
+        # Cada trabajo puede escribir en su propia carpeta de resultados
+        if output_dir is None:
+            output_dir = self.output_dir
         
         try:
+            self._ensure_output_directories(output_dir)
+            
             # 0. PRE-PROCESAMIENTO: AISLAR Y CONVERTIR VIDEOS
             if progress_callback: progress_callback(5, "Preparando archivos para análisis...")
             
@@ -254,184 +607,117 @@ class DeepCardioProcessor:
             # para todas las operaciones de EchoNet de aquí en adelante.
             
             # Configuración de Dataset
+            # Clips de 32 frames con periodo 2 (r2plus1d_18_32_2)
             frames = 32
-            period = 1
-            batch_size = 1 
+            period = 2
+            max_length = 250
             
-            # 1. CALCULAR EF
-            if progress_callback: progress_callback(10, "Calculando Fracción de Eyección (Modelo)...")
+            # 1. DECODIFICAR CADA VIDEO UNA SOLA VEZ
+            # El mismo buffer uint8 alimenta estadísticas, EF, segmentación y renderizado.
+            if progress_callback: progress_callback(8, "Decodificando videos...")
             
-            ds = echonet.datasets.Echo(split="external_test", external_test_location=inference_folder, pad=12, crops="all")
-            mean, std = echonet.utils.get_mean_and_std(ds, batch_size=1, num_workers=0)
+            buffers = collections.OrderedDict()
+            stats = {}
+            for filename in sorted(os.listdir(inference_folder)):
+                video = echonet.utils.loadvideo(os.path.join(inference_folder, filename))
+                buffers[filename] = video
+                if self.stats_mode == "study":
+                    stats[filename] = _mean_and_std([video])
+                else:
+                    stats[filename] = (self.mean, self.std)
             
-            ds = echonet.datasets.Echo(split="external_test", external_test_location=inference_folder, pad=12, crops="all", mean=mean, std=std)
-            dataloader = torch.utils.data.DataLoader(ds, batch_size=1, num_workers=0, shuffle=False, pin_memory=(self.device.type == "cuda"))
+            # 2. CALCULAR EF
+            if progress_callback: progress_callback(10, "Calculando Fracción de Eyección (Modelo)...")
             
-            _, yhat, _ = echonet.utils.video.run_epoch(self.ef_model, dataloader, False, None, self.device, save_all=True, block_size=25)
+            if self.ef_protocol == "tta":
+                ds = _DecodedEcho(buffers, inference_folder, stats=stats, target_type="Filename",
+                                  length=frames, period=period, clips="all", windowed=True,
+                                  clip_stride=self.ef_clip_stride, max_clips=self.ef_max_clips)
+            else:
+                ds = _DecodedEcho(buffers, inference_folder, stats=stats, target_type="Filename",
+                                  length=16, period=2, pad=12)
+            yhat = self._predict_ef(ds)
             
             ef_data = {}
-            for (filename, pred) in zip(ds.fnames, yhat):
+            for (filename, pred) in yhat.items():
                 ef_data[filename] = np.mean(pred)
 
-            # 2. GENERAR SEGMENTACIONES
+            # 3-4. GENERAR SEGMENTACIONES, VIDEOS Y GRÁFICAS (video a video)
+            # Los videos anotados se codifican en un hilo aparte mientras se
+            # segmenta el siguiente.
             if progress_callback: progress_callback(30, "Generando segmentaciones del ventrículo...")
             
-            def collate_fn(x):
-                x, f = zip(*x)
-                i = list(map(lambda t: t.shape[1], x))
-                x = torch.as_tensor(np.swapaxes(np.concatenate(x, 1), 0, 1))
-                return x, f, i
-
-            seg_ds = echonet.datasets.Echo(split="external_test", external_test_location=inference_folder, target_type=["Filename"], length=None, period=1, mean=mean, std=std)
-            seg_dataloader = torch.utils.data.DataLoader(seg_ds, batch_size=1, num_workers=0, shuffle=False, pin_memory=(self.device.type == "cuda"), collate_fn=collate_fn)
-            
-            block = 1024
-            with torch.no_grad():
-                for (x, f, i) in seg_dataloader:
-                    x = x.to(self.device)
-                    y_list = []
-                    for idx in range(0, x.shape[0], block):
-                        batch = x[idx:(idx + block), :, :, :]
-                        output = self.seg_model(batch)["out"]
-                        y_list.append(output.detach().cpu().numpy())
-                    
-                    y = np.concatenate(y_list, axis=0).astype(np.float16)
-                    
-                    start = 0
-                    for (filename, offset) in zip(f, i):
-                        seg_output = y[start:(start + offset), 0, :, :]
-                        np.save(os.path.join(self.output_dir, "labels", os.path.splitext(filename)[0]), seg_output)
-                        start += offset
-
-            # 3. GENERAR VIDEOS Y GRÁFICAS
-            if progress_callback: progress_callback(60, "Generando videos y gráficas de volumen...")
-            
-            vis_dataloader = torch.utils.data.DataLoader(
-                echonet.datasets.Echo(split="external_test", external_test_location=inference_folder, target_type=["Filename"], length=None, period=1),
-                batch_size=1, num_workers=0, shuffle=False, pin_memory=False
-            )
-            
             echonet.utils.latexify()
-            size_csv_path = os.path.join(self.output_dir, "size.csv")
+            size_csv_path = os.path.join(output_dir, "size.csv")
             
             csv_lines = []
             csv_lines.append("Filename,Frame,Size,ComputerSmall,EF_Mean,ESV,EDV\n")
             
-            for (x, filename) in vis_dataloader:
-                filename_str = filename[0]
-                seg_path = os.path.join(self.output_dir, "labels", os.path.splitext(filename_str)[0] + ".npy")
-                
-                if not os.path.exists(seg_path):
-                    continue
-                    
-                logit = np.load(seg_path)
-                x_numpy = x.numpy()
-                
-                img = x_numpy[0, :, :, :, :].copy()
-                img[1, :, :, :] = img[0, :, :, :]
-                img[2, :, :, :] = img[0, :, :, :]
-                img = np.concatenate((img, img), 3)
-                
-                mask = (logit > 0)
-                img[0, :, :, 112:] = np.maximum(255. * mask, img[0, :, :, 112:])
-                img[1, :, :, 112:] = np.maximum(255. * mask, img[1, :, :, 112:])
-                
-                img = np.concatenate((img, np.zeros_like(img)), 2)
-                size = (logit > 0).sum(2).sum(1)
-                
-                try:
-                    trim_min = sorted(size)[round(len(size) ** 0.05)]
-                    trim_max = sorted(size)[round(len(size) ** 0.95)]
-                except:
-                    trim_min = size.min() if len(size) > 0 else 0
-                    trim_max = size.max() if len(size) > 0 else 0
-                
-                trim_range = trim_max - trim_min
-                peaks = set()
-                if trim_range > 0:
-                    peaks = set(scipy.signal.find_peaks(-size, distance=20, prominence=(0.50 * trim_range))[0])
-                
-                esv_pixel = size.min() if len(size) > 0 else 0
-                edv_pixel = size.max() if len(size) > 0 else 0
-                pixel_to_ml = 0.03
-                esv_ml = esv_pixel * pixel_to_ml
-                edv_ml = edv_pixel * pixel_to_ml
-                
-                ef_model_val = ef_data.get(filename_str, 0)
-                
-                for (frame_idx, size_val) in enumerate(size):
-                    csv_lines.append("{},{},{},{},{:.2f},{:.2f},{:.2f}\n".format(
-                        filename_str, frame_idx, size_val, 1 if frame_idx in peaks else 0,
-                        ef_model_val, esv_ml, edv_ml
-                    ))
-                
-                # Generar Plot
-                fig = plt.figure(figsize=(size.shape[0] / 50 * 1.5, 3))
-                plt.scatter(np.arange(size.shape[0]) / 50, size, s=1)
-                ylim = plt.ylim()
-                for p in peaks:
-                    plt.plot(np.array([p, p]) / 50, ylim, linewidth=1)
-                plt.ylim(ylim)
-                title_text = f"{os.path.splitext(filename_str)[0]}\nEF: {ef_model_val:.1f}% | ESV: {esv_ml:.1f}mL | EDV: {edv_ml:.1f}mL"
-                plt.title(title_text, fontsize=10)
-                plt.xlabel("Seconds")
-                plt.ylabel("Size (pixels)")
-                plt.tight_layout()
-                plt.savefig(os.path.join(self.output_dir, "size", os.path.splitext(filename_str)[0] + ".pdf"))
-                plt.close(fig)
-                
-                # Generar Video
-                if size.max() > size.min():
-                    size_norm = (size - size.min()) / (size.max() - size.min())
-                    size_norm = 1 - size_norm
-                else:
-                    size_norm = np.zeros_like(size)
-
-                # 1. DIBUJAR LA GRÁFICA ESTÁTICA
-                for (t_point, y_val) in enumerate(size_norm):
-                    x_coord = int(round(t_point / len(size_norm) * 200 + 10))
-                    y_coord = int(round(115 + 100 * y_val))
-                    interval_static = np.array([-1, 0, 1])
-                    for a in interval_static:
-                        for b in interval_static:
-                            y_pos = a + y_coord
-                            x_pos = b + x_coord
-                            if (0 <= y_pos < img.shape[2] and 0 <= x_pos < img.shape[3]):
-                                img[:, :, y_pos, x_pos] = 255.
-
-                # 2. DIBUJAR EL CURSOR MÓVIL
-                for (frame_idx, y_val) in enumerate(size_norm):
-                    x_coord = int(round(frame_idx / len(size_norm) * 200 + 10))
-                    y_coord = int(round(115 + 100 * y_val))
-                    
-                    interval_cursor = np.array([-3, -2, -1, 0, 1, 2, 3])
-                    for a in interval_cursor:
-                        for b in interval_cursor:
-                            y_pos = a + y_coord
-                            x_pos = b + x_coord
-                            if (0 <= y_pos < img.shape[2] and 0 <= x_pos < img.shape[3] and 0 <= frame_idx < img.shape[1]):
-                                img[0, frame_idx, y_pos, x_pos] = 255. # R
-                                img[1, frame_idx, y_pos, x_pos] = 0.   # G
-                                img[2, frame_idx, y_pos, x_pos] = 0.   # B
-                    
-                    if frame_idx in peaks and 0 <= x_coord < img.shape[3]:
-                        img[0, :, 200:225, x_coord] = 255. # R
-                        img[1, :, 200:225, x_coord] = 255. # G
-                        img[2, :, 200:225, x_coord] = 0.   # B
-                
-                # Guardar AVI (Original)
-                avi_path = os.path.join(self.output_dir, "videos", filename_str)
-                echonet.utils.savevideo(avi_path, img.astype(np.uint8), 50)
-                
-                # Guardar MP4 (Para Web)
-                mp4_filename = os.path.splitext(filename_str)[0] + ".mp4"
-                mp4_path = os.path.join(self.output_dir, "videos", mp4_filename)
-                self._save_as_mp4(img.astype(np.uint8), mp4_path)
+            with echonet.utils.BackgroundEncoder() as encoder:
+                for (i, (filename_str, video)) in enumerate(buffers.items()):
+                    if progress_callback and i > 0:
+                        progress_callback(30 + 60 * i // len(buffers), f"Generando segmentaciones, videos y gráficas ({i + 1}/{len(buffers)})...")
+
+                    logit = self._segment(video, *stats[filename_str], max_length)
+                    np.save(os.path.join(output_dir, "labels", os.path.splitext(filename_str)[0]), logit)
+
+                    size = (logit > 0).sum(2).sum(1)
+
+                    try:
+                        trim_min = sorted(size)[round(len(size) ** 0.05)]
+                        trim_max = sorted(size)[round(len(size) ** 0.95)]
+                    except:
+                        trim_min = size.min() if len(size) > 0 else 0
+                        trim_max = size.max() if len(size) > 0 else 0
+
+                    trim_range = trim_max - trim_min
+                    peaks = set()
+                    if trim_range > 0:
+                        peaks = set(scipy.signal.find_peaks(-size, distance=20, prominence=(0.50 * trim_range))[0])
+
+                    esv_pixel = size.min() if len(size) > 0 else 0
+                    edv_pixel = size.max() if len(size) > 0 else 0
+                    pixel_to_ml = 0.03
+                    esv_ml = esv_pixel * pixel_to_ml
+                    edv_ml = edv_pixel * pixel_to_ml
+
+                    ef_model_val = ef_data.get(filename_str, 0)
+
+                    for (frame_idx, size_val) in enumerate(size):
+                        csv_lines.append("{},{},{},{},{:.2f},{:.2f},{:.2f}\n".format(
+                            filename_str, frame_idx, size_val, 1 if frame_idx in peaks else 0,
+                            ef_model_val, esv_ml, edv_ml
+                        ))
+
+                    # Generar Plot
+                    fig = plt.figure(figsize=(size.shape[0] / 50 * 1.5, 3))
+                    plt.scatter(np.arange(size.shape[0]) / 50, size, s=1)
+                    ylim = plt.ylim()
+                    for p in peaks:
+                        plt.plot(np.array([p, p]) / 50, ylim, linewidth=1)
+                    plt.ylim(ylim)
+                    title_text = f"{os.path.splitext(filename_str)[0]}\nEF: {ef_model_val:.1f}% | ESV: {esv_ml:.1f}mL | EDV: {edv_ml:.1f}mL"
+                    plt.title(title_text, fontsize=10)
+                    plt.xlabel("Seconds")
+                    plt.ylabel("Size (pixels)")
+                    plt.tight_layout()
+                    plt.savefig(os.path.join(output_dir, "size", os.path.splitext(filename_str)[0] + ".pdf"))
+                    plt.close(fig)
+
+                    # Generar Video
+                    if size.max() > size.min():
+                        size_norm = (size - size.min()) / (size.max() - size.min())
+                        size_norm = 1 - size_norm
+                    else:
+                        size_norm = np.zeros_like(size)
+
+                    img = self._render_video(video[:, :max_length], logit, size_norm, peaks)
+                    encoder.submit(self._save_video, img, os.path.join(output_dir, "videos"), os.path.splitext(filename_str)[0])
 
             with open(size_csv_path, "w") as f:
                 f.writelines(csv_lines)
 
-            # 4. CLASIFICACIÓN FINAL
+            # 5. CLASIFICACIÓN FINAL
             if progress_callback: progress_callback(90, "Clasificando resultados...")
             
             df_size = pd.read_csv(size_csv_path)
@@ -489,7 +775,7 @@ class DeepCardioProcessor:
                 })
                 
             df_results = pd.DataFrame(results)
-            df_results.to_csv(os.path.join(self.output_dir, "classification_results.csv"), index=False)
+            df_results.to_csv(os.path.join(output_dir, "classification_results.csv"), index=False)
             
             if progress_callback: progress_callback(100, "Análisis completado")
             return True
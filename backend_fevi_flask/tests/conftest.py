@@ -0,0 +1,59 @@
+"""Shared fixtures: a tiny synthetic EchoNet-Dynamic dataset."""
+
+import os
+import sys
+
+import numpy as np
+import pandas
+import pytest
+
+# Flask app, processor and analysis pool live in scripts/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts"))
+
+import echonet  # noqa: E402
+
+# FileName -> (frames, split, traced frames)
+VIDEOS = {
+    "A": (30, "TRAIN", (4, 20)),
+    "B": (45, "TRAIN", (10, 30)),
+    "C": (40, "VAL", (8, 25)),
+    "D": (35, "TRAIN", ()),  # no traces, as some videos of the real dataset
+}
+
+
+def _write_dataset(root):
+    os.makedirs(os.path.join(root, "Videos"))
+    rng = np.random.RandomState(0)
+
+    rows = []
+    for (name, (frames, split, _)) in VIDEOS.items():
+        video = rng.randint(0, 256, (3, frames, 112, 112)).astype(np.uint8)
+        echonet.utils.savevideo(os.path.join(root, "Videos", name + ".avi"), video, 50)
+        rows.append((name, 55.0 + len(rows), 30.0, 60.0, 112, 112, 50, frames, split))
+    pandas.DataFrame(rows, columns=["FileName", "EF", "ESV", "EDV", "FrameHeight", "FrameWidth", "FPS", "NumberOfFrames", "Split"]).to_csv(
+        os.path.join(root, "FileList.csv"), index=False)
+
+    traces = []
+    for (name, (_, _, traced)) in VIDEOS.items():
+        for (i, frame) in enumerate(traced):
+            # Long axis first, then chords; the second traced frame is larger
+            half = 20 + 10 * i
+            traces.append((name + ".avi", 56, 56 - half, 56, 56 + half, frame))
+            for y in range(56 - half + 5, 56 + half, 5):
+                traces.append((name + ".avi", 56 - half / 2, y, 56 + half / 2, y, frame))
+    pandas.DataFrame(traces, columns=["FileName", "X1", "Y1", "X2", "Y2", "Frame"]).to_csv(
+        os.path.join(root, "VolumeTracings.csv"), index=False)
+
+
+@pytest.fixture(scope="session")
+def data_dir(tmp_path_factory):
+    """Directory with FileList.csv, VolumeTracings.csv and Videos/ (see ``VIDEOS'')."""
+    root = str(tmp_path_factory.mktemp("echonet"))
+    _write_dataset(root)
+    return root
+
+
+@pytest.fixture(autouse=True)
+def _cache_dir(tmp_path, monkeypatch):
+    # Keep tracing caches out of the user's home directory
+    monkeypatch.setattr(echonet.config, "CACHE_DIR", str(tmp_path / "cache"))
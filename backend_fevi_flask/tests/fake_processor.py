@@ -0,0 +1,30 @@
+"""Stand-in for ``processor.DeepCardioProcessor'' used by the AnalysisPool tests.
+
+``videos_folder'' names what the job does instead of a folder of videos:
+``"done"'' completes at once, ``"wait:<path>"'' reports progress until
+``<path>'' exists, ``"error:<message>"'' raises and ``"crash"'' kills the
+worker process.
+"""
+
+import os
+import time
+
+
+class FakeProcessor:
+    def __init__(self, fail=False):
+        if fail:
+            raise RuntimeError("no weights")
+
+    def process_videos(self, videos_folder, update_progress, output_dir=None):
+        action, _, arg = videos_folder.partition(":")
+        if action == "crash":
+            os._exit(3)
+        if action == "error":
+            raise ValueError(arg)
+        if action == "wait":
+            progress = 0
+            while not os.path.exists(arg):
+                progress = min(progress + 1, 99)
+                update_progress(progress, "waiting")
+                time.sleep(0.02)
+        update_progress(100, "done")
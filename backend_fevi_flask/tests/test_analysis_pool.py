@@ -0,0 +1,119 @@
+"""Tests for the AnalysisPool queue, backpressure, cancellation and worker failures."""
+
+import time
+
+import pytest
+
+from analysis_pool import AnalysisPool, QueueFullError
+
+
+def make_pool(jobs, num_workers=1, max_queue=4, fail=False):
+    return AnalysisPool(jobs, (), {"fail": fail}, num_workers=num_workers, max_queue=max_queue, torch_threads=0,
+                        processor_class="fake_processor.FakeProcessor")
+
+
+def wait_for(condition, timeout=60):
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, "timed out"
+        time.sleep(0.02)
+
+
+@pytest.fixture
+def jobs():
+    return {}
+
+
+@pytest.fixture
+def pool(jobs):
+    pool = make_pool(jobs)
+    yield pool
+    pool.close()
+
+
+def test_completes_jobs(pool, jobs):
+    pool.submit("a", "done")
+    pool.submit("b", "error:bad video")
+    wait_for(lambda: jobs["b"]["status"] not in ("queued", "processing"))
+    wait_for(lambda: jobs["a"]["status"] == "completed")
+    assert jobs["a"]["progress"] == 100
+    assert jobs["b"]["status"] == "error"
+    assert jobs["b"]["error"] == "bad video"
+
+
+def test_priority_and_backpressure(pool, jobs, tmp_path):
+    gate = tmp_path / "gate"
+    pool.submit("running", f"wait:{gate}")
+    wait_for(lambda: jobs["running"]["status"] == "processing")
+
+    pool.submit("low", "done", priority=0)
+    pool.submit("low2", "done", priority=0)
+    pool.submit("high", "done", priority=5)
+    assert [pool.queue_position(j) for j in ("high", "low", "low2")] == [1, 2, 3]
+    assert pool.queue_position("running") is None
+
+    pool.submit("low3", "done")
+    assert pool.queue_depth() == pool.max_queue
+    with pytest.raises(QueueFullError):
+        pool.submit("rejected", "done")
+    assert "rejected" not in jobs
+
+    gate.touch()
+    wait_for(lambda: all(jobs[j]["status"] == "completed" for j in ("running", "low", "low2", "high", "low3")))
+    finished = sorted(("high", "low", "low2", "low3"), key=lambda j: jobs[j]["finished_at"])
+    assert finished == ["high", "low", "low2", "low3"]
+
+
+def test_cancel(pool, jobs, tmp_path):
+    gate = tmp_path / "gate"
+    pool.submit("running", f"wait:{gate}")
+    pool.submit("queued", "done")
+    wait_for(lambda: jobs["running"]["status"] == "processing")
+
+    assert pool.cancel("queued")
+    assert pool.queue_position("queued") is None
+    assert pool.cancel("running")
+    assert not pool.cancel("unknown")
+
+    # The worker notices the cancellation on its next progress update and is
+    # free again; neither job is overwritten afterwards
+    pool.submit("next", "done")
+    wait_for(lambda: jobs["next"]["status"] == "completed")
+    assert jobs["running"]["status"] == "cancelled"
+    assert jobs["queued"]["status"] == "cancelled"
+
+
+def test_cancelled_job_is_not_overwritten(pool, jobs, tmp_path):
+    gate = tmp_path / "gate"
+    pool.submit("running", f"wait:{gate}")
+    wait_for(lambda: jobs["running"]["status"] == "processing")
+    with pool._cond:
+        # Cancelled after the worker finished, before its result arrives
+        gate.touch()
+        jobs["running"]["status"] = "cancelled"
+    pool.submit("next", "done")
+    wait_for(lambda: jobs["next"]["status"] == "completed")
+    assert jobs["running"]["status"] == "cancelled"
+
+
+def test_worker_crash(pool, jobs):
+    pool.submit("crash", "crash")
+    pool.submit("after", "done")
+    wait_for(lambda: jobs["after"]["status"] == "completed")
+    assert jobs["crash"]["status"] == "error"
+    assert "código 3" in jobs["crash"]["error"]
+    assert len(pool._workers) == 1
+
+
+def test_processor_fails_to_start(jobs):
+    pool = make_pool(jobs, num_workers=2, fail=True)
+    try:
+        pool.submit("a", "done")
+        wait_for(lambda: jobs["a"]["status"] == "error")
+        assert jobs["a"]["error"].startswith("No se pudo iniciar el procesador")
+
+        # Later jobs fail at once instead of waiting for a worker
+        pool.submit("b", "done")
+        assert jobs["b"]["status"] == "error"
+    finally:
+        pool.close()
@@ -0,0 +1,155 @@
+"""Tests for the analysis start, results lookup, job retention and on-demand AVIs of the Flask app."""
+
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+import app as server
+import echonet
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "JOBS_FOLDER", str(tmp_path / "jobs"))
+    monkeypatch.setattr(server, "UPLOAD_FOLDER", str(tmp_path / "uploads"))
+    monkeypatch.setitem(server.app.config, "UPLOAD_FOLDER", server.UPLOAD_FOLDER)
+    os.makedirs(server.JOBS_FOLDER)
+    os.makedirs(server.UPLOAD_FOLDER)
+    server.JOBS.clear()
+    yield server.app.test_client()
+    server.JOBS.clear()
+
+
+def add_job(job_id, status="completed", session_id="default", finished_at=None):
+    output_dir = os.path.join(server.JOBS_FOLDER, job_id, "output")
+    os.makedirs(output_dir)
+    with open(os.path.join(output_dir, "size.csv"), "w") as f:
+        f.write(job_id)
+    server.JOBS[job_id] = {"status": status, "progress": 0, "message": "", "output_dir": output_dir,
+                           "session_id": session_id}
+    if finished_at is not None:
+        server.JOBS[job_id]["finished_at"] = finished_at
+
+
+def test_results_fallback_is_scoped_to_session(client):
+    now = time.time()
+    add_job("mine", session_id="s1", finished_at=now - 10)
+    add_job("theirs", session_id="s2", finished_at=now)
+
+    response = client.get("/api/results/csv/size?session_id=s1")
+    assert response.status_code == 200
+    assert response.data == b"mine"
+
+    assert client.get("/api/results/csv/size?session_id=s3").status_code == 404
+    assert client.get("/api/results/csv/size").status_code == 404
+    assert client.get("/api/results/csv/size?analysis_id=theirs").data == b"theirs"
+
+
+def test_results_without_analysis(client):
+    # As before the first analysis: no results, but not an error
+    response = client.get("/api/results/all?session_id=s1")
+    assert response.status_code == 200
+    assert response.get_json() == {"success": False, "count": 0, "results": []}
+    assert client.get("/api/results/all").status_code == 200
+    assert client.get("/api/results/summary-plot").status_code == 404
+
+    # An unknown or invalid analysis_id is
+    assert client.get("/api/results/all?analysis_id=missing").status_code == 404
+    assert client.get("/api/results/all?analysis_id=../jobs").status_code == 404
+
+
+def test_concurrent_start(client, monkeypatch):
+    session_folder = os.path.join(server.UPLOAD_FOLDER, "s1")
+    os.makedirs(session_folder)
+    with open(os.path.join(session_folder, "a.avi"), "wb") as f:
+        f.write(b"video")
+
+    # Another request moves the session's files between the checks and the move
+    replace = os.replace
+
+    def race(src, dst):
+        replace(src, os.path.join(server.JOBS_FOLDER, "winner"))
+        return replace(src, dst)
+
+    monkeypatch.setattr(server.os, "replace", race)
+    response = client.post("/api/analysis/start", json={"session_id": "s1"})
+    assert response.status_code == 409
+    assert response.get_json()["success"] is False
+    assert os.listdir(server.JOBS_FOLDER) == ["winner"]
+    assert server.JOBS == {}
+
+
+def test_cleanup_jobs(client, monkeypatch):
+    monkeypatch.setattr(server, "JOB_RETENTION", 100)
+    now = time.time()
+    add_job("old", finished_at=now - 200)
+    add_job("recent", finished_at=now - 10)
+    add_job("running", status="processing")
+    os.utime(os.path.join(server.JOBS_FOLDER, "running"), (now - 200, now - 200))
+
+    # Folders left by a previous run of the server
+    for (parent, name, age) in ((server.JOBS_FOLDER, "orphan", 200), (server.JOBS_FOLDER, "starting", 0),
+                                (server.UPLOAD_FOLDER, "abandoned", 200), (server.UPLOAD_FOLDER, "uploading", 0)):
+        os.makedirs(os.path.join(parent, name))
+        os.utime(os.path.join(parent, name), (now - age, now - age))
+
+    server.cleanup_jobs()
+    assert sorted(server.JOBS) == ["recent", "running"]
+    assert sorted(os.listdir(server.JOBS_FOLDER)) == ["recent", "running", "starting"]
+    assert os.listdir(server.UPLOAD_FOLDER) == ["uploading"]
+
+
+def add_video(job_id="job", frames=True):
+    add_job(job_id)
+    video_folder = os.path.join(server.JOBS[job_id]["output_dir"], "videos")
+    os.makedirs(video_folder)
+    video = np.random.RandomState(0).randint(0, 256, (3, 8, 32, 32)).astype(np.uint8)
+    if frames:
+        np.save(os.path.join(video_folder, "a.npy"), video)
+    else:
+        echonet.utils.savevideo(os.path.join(video_folder, "a.mp4"), video, 50)
+    return video_folder
+
+
+@pytest.mark.parametrize("frames", [True, False])
+def test_avi_on_demand(client, frames):
+    video_folder = add_video(frames=frames)
+    response = client.get("/api/results/video/a.avi?analysis_id=job")
+    assert response.status_code == 200
+    response.close()
+    assert echonet.utils.loadvideo(os.path.join(video_folder, "a.avi")).shape == (3, 8, 32, 32)
+    assert client.get("/api/results/video/b.avi?analysis_id=job").status_code == 404
+
+
+def test_avi_conversions(client, monkeypatch):
+    add_video()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    ensure_avi = server.ensure_avi
+
+    def slow(video_folder, base_name):
+        calls.append(base_name)
+        started.set()
+        release.wait(10)
+        return ensure_avi(video_folder, base_name)
+
+    monkeypatch.setattr(server, "ensure_avi", slow)
+    monkeypatch.setattr(server, "AVI_WAIT", 0)
+
+    # The request does not wait for the conversion, and repeated requests share it
+    response = client.get("/api/results/video/a.avi?analysis_id=job")
+    assert response.status_code == 202
+    assert response.headers["Retry-After"]
+    started.wait(10)
+    assert client.get("/api/results/video/a.avi?analysis_id=job").status_code == 202
+
+    release.set()
+    monkeypatch.setattr(server, "AVI_WAIT", 10)
+    response = client.get("/api/results/video/a.avi?analysis_id=job")
+    assert response.status_code == 200
+    response.close()
+    assert calls == ["a"]
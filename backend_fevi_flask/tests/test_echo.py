@@ -0,0 +1,293 @@
+"""Tests for ``echonet.datasets.Echo''."""
+
+import collections
+import os
+import pickle
+
+import cv2
+import numpy as np
+import pandas
+import pytest
+import skimage.draw
+import torch
+
+import echonet
+from echonet.datasets import echo
+from echonet.datasets.echo import _load_tracings
+
+
+def test_keyframes(data_dir, monkeypatch):
+    kwargs = dict(root=data_dir, split="all", target_type=["LargeIndex", "SmallIndex", "LargeFrame", "SmallFrame"])
+    full = echonet.datasets.Echo(length=None, period=1, max_length=None, **kwargs)
+    keyframes = echonet.datasets.Echo(keyframes=True, **kwargs)
+
+    decoded = []
+    load_video = echonet.datasets.Echo._load_video
+
+    def record(self, index, start=0, stop=None, step=1):
+        video = load_video(self, index, start, stop, step)
+        decoded.append(video.shape[1])
+        return video
+
+    monkeypatch.setattr(echonet.datasets.Echo, "_load_video", record)
+    for i in range(len(full)):
+        (_, (large, small, large_frame, small_frame)) = full[i]
+        (video, target) = keyframes[i]
+
+        # Only the two traced frames are decoded
+        assert video.shape == (3, 0, 112, 112)
+        assert decoded[-1] == 2
+        np.testing.assert_array_equal(target[2], large_frame)
+        np.testing.assert_array_equal(target[3], small_frame)
+        assert target[:2] == (large, small)
+
+
+def test_short_video_is_not_keyframes(data_dir):
+    # length=None on a video shorter than ``period'' is an empty clip, not keyframe mode
+    dataset = echonet.datasets.Echo(root=data_dir, split="all", target_type="LargeFrame", length=None, period=100, clips=3)
+    (video, frame) = dataset[0]
+    assert video.shape == (3, 3, 0, 112, 112)
+    assert frame.shape == (3, 112, 112)
+
+
+def test_windowed_matches_clips(data_dir):
+    kwargs = dict(root=data_dir, split="all", target_type="EF", mean=np.array([10., 20., 30.]), std=np.array([2., 3., 4.]),
+                  length=8, period=3, clips="all", clip_stride=3)
+    clips = echonet.datasets.Echo(**kwargs)
+    windowed = echonet.datasets.Echo(windowed=True, **kwargs)
+
+    for i in range(len(clips)):
+        (expected, ef) = clips[i]
+        (windows, ef_windowed) = windowed[i]
+        assert isinstance(windows, echonet.datasets.ClipWindows)
+        assert ef == ef_windowed
+        assert windows.shape == expected.shape
+        np.testing.assert_array_equal(np.asarray(windows), expected)
+        np.testing.assert_array_equal(windows.clips(None, 1, 3), expected[1:3])
+        np.testing.assert_array_equal(windows.subset([0, 2]).clips(), expected[[0, 2]])
+        np.testing.assert_array_equal(windows.clips(torch.from_numpy(windows.video)).numpy(), expected)
+
+
+def test_windowed_collate(data_dir):
+    dataset = echonet.datasets.Echo(root=data_dir, split="all", target_type=["EF", "Filename"], length=8, period=2,
+                                    clips="all", windowed=True)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=2, collate_fn=echonet.datasets.ClipWindows.collate)
+    (windows, (ef, filename)) = next(iter(loader))
+    assert len(windows) == 2 and all(isinstance(w, echonet.datasets.ClipWindows) for w in windows)
+    assert ef.shape == (2,)
+    assert list(filename) == dataset.fnames[:2]
+
+
+def test_videos_are_opened_once(data_dir, monkeypatch):
+    dataset = echonet.datasets.Echo(root=data_dir, split="all", target_type=["EF", "LargeTrace"], length=8, period=2)
+    np.random.seed(0)
+    expected = [dataset[i][0] for i in range(len(dataset))]
+
+    opened = []
+    video_capture = cv2.VideoCapture
+
+    def capture(filename):
+        opened.append(filename)
+        return video_capture(filename)
+
+    monkeypatch.setattr(echonet.utils.cv2, "VideoCapture", capture)
+    np.random.seed(0)
+    for i in range(len(dataset)):
+        # The shape and the frames are read through the same capture
+        np.testing.assert_array_equal(dataset[i][0], expected[i])
+        assert len(opened) == i + 1
+
+    # A dataset with an open video can still be sent to worker processes
+    dataset._video_shape(0)
+    copy = pickle.loads(pickle.dumps(dataset))
+    assert copy._reader is None
+    np.random.seed(1)
+    clip = copy[0][0]
+    np.random.seed(1)
+    np.testing.assert_array_equal(clip, dataset[0][0])
+
+
+def load_tracings_loop(filename):
+    # Reference: the line-by-line parsing of VolumeTracings.csv
+    frames = collections.defaultdict(list)
+    trace = collections.defaultdict(lambda: collections.defaultdict(list))
+    with open(filename) as f:
+        assert f.readline().strip().split(",") == ["FileName", "X1", "Y1", "X2", "Y2", "Frame"]
+        for line in f:
+            (name, x1, y1, x2, y2, frame) = line.strip().split(",")
+            frame = int(frame)
+            if frame not in trace[name]:
+                frames[name].append(frame)
+            trace[name][frame].append((float(x1), float(y1), float(x2), float(y2)))
+    return frames, trace
+
+
+def test_load_tracings(tmp_path, monkeypatch):
+    # Rows of different videos and frames are interleaved
+    filename = str(tmp_path / "VolumeTracings.csv")
+    rng = np.random.RandomState(0)
+    rows = [("{}.avi".format("ABC"[i % 3]), *rng.uniform(0, 112, 4).round(2), int(rng.choice([3, 17, 40])))
+            for i in range(200)]
+    pandas.DataFrame(rows, columns=["FileName", "X1", "Y1", "X2", "Y2", "Frame"]).to_csv(filename, index=False)
+
+    (expected_frames, expected_trace) = load_tracings_loop(filename)
+    for _ in range(2):
+        (frames, trace, _) = _load_tracings(filename)
+        assert frames == expected_frames
+        assert set(trace) == set(expected_trace)
+        for name in trace:
+            assert set(trace[name]) == set(expected_trace[name])
+            for frame in trace[name]:
+                np.testing.assert_array_equal(trace[name][frame], expected_trace[name][frame])
+
+        # The second load comes from the cache
+        monkeypatch.setattr(pandas, "read_csv", None)
+
+
+def test_load_tracings_cache(data_dir, tmp_path):
+    filename = str(tmp_path / "VolumeTracings.csv")
+    with open(os.path.join(data_dir, "VolumeTracings.csv")) as f:
+        data = f.read()
+    with open(filename, "w") as f:
+        f.write(data)
+    (frames, _, key) = _load_tracings(filename)
+    (cache,) = os.listdir(echonet.config.CACHE_DIR)
+    assert key in cache
+
+    # A corrupt cache is parsed again
+    with open(os.path.join(echonet.config.CACHE_DIR, cache), "wb") as f:
+        f.write(b"truncated")
+    assert _load_tracings(filename)[0] == frames
+
+    # A modified file gets a new cache entry
+    with open(filename, "w") as f:
+        f.write(data.replace("A.avi", "E.avi"))
+    (changed, _, other) = _load_tracings(filename)
+    assert other != key and "E.avi" in changed and "A.avi" not in changed
+    assert len(os.listdir(echonet.config.CACHE_DIR)) == 2
+
+
+def trace_mask_loop(t, shape):
+    # Reference: the per-item rasterization of a trace
+    x1, y1, x2, y2 = t[:, 0], t[:, 1], t[:, 2], t[:, 3]
+    x = np.concatenate((x1[1:], np.flip(x2[1:])))
+    y = np.concatenate((y1[1:], np.flip(y2[1:])))
+    r, c = skimage.draw.polygon(np.rint(y).astype(int), np.rint(x).astype(int), shape)
+    mask = np.zeros(shape, np.float32)
+    mask[r, c] = 1
+    return mask
+
+
+@pytest.mark.parametrize("trace_workers", [0, 2])
+def test_trace_masks(data_dir, monkeypatch, trace_workers):
+    kwargs = dict(root=data_dir, split="all", target_type=["Filename", "LargeTrace", "SmallTrace"])
+    dataset = echonet.datasets.Echo(trace_workers=trace_workers, **kwargs)
+    assert dataset.masks is not None
+
+    def check(dataset):
+        for i in range(len(dataset)):
+            (_, (filename, large, small)) = dataset[i]
+            frames = dataset.frames[filename]
+            assert large.dtype == small.dtype == np.float32
+            assert large.sum() > small.sum() > 0
+            np.testing.assert_array_equal(large, trace_mask_loop(dataset.trace[filename][frames[-1]], (112, 112)))
+            np.testing.assert_array_equal(small, trace_mask_loop(dataset.trace[filename][frames[0]], (112, 112)))
+
+    check(dataset)
+
+    # Later datasets load the masks from the cache
+    monkeypatch.setattr(echo, "_rasterize_traces", None)
+    check(echonet.datasets.Echo(**kwargs))
+
+    # Videos of another size than the masks are rasterized when loaded
+    dataset.mask_shape = (64, 64)
+    check(dataset)
+
+
+def getitem_loop(dataset, index):
+    # Reference: decode everything to float, normalize, then select clips
+    video = echonet.utils.loadvideo(os.path.join(dataset.root, "Videos", dataset.fnames[index])).astype(np.float32)
+    video -= np.reshape(dataset.mean, (-1, 1, 1, 1))
+    video /= np.reshape(dataset.std, (-1, 1, 1, 1))
+
+    c, f, h, w = video.shape
+    length = f // dataset.period if dataset.length is None else dataset.length
+    if dataset.max_length is not None:
+        length = min(length, dataset.max_length)
+    if f < length * dataset.period:
+        video = np.concatenate((video, np.zeros((c, length * dataset.period - f, h, w), video.dtype)), axis=1)
+        c, f, h, w = video.shape
+
+    if dataset.clips == "all":
+        start = np.arange(f - (length - 1) * dataset.period)
+    else:
+        start = np.random.choice(f - (length - 1) * dataset.period, dataset.clips)
+
+    key = dataset.fnames[index]
+    target = (np.float32(dataset.outcome[index][dataset.header.index("EF")]),
+              video[:, dataset.frames[key][-1], :, :], video[:, dataset.frames[key][0], :, :])
+
+    video = tuple(video[:, s + dataset.period * np.arange(length), :, :] for s in start)
+    video = video[0] if dataset.clips == 1 else np.stack(video)
+
+    if dataset.pad is not None:
+        c, l, h, w = video.shape
+        temp = np.zeros((c, l, h + 2 * dataset.pad, w + 2 * dataset.pad), dtype=video.dtype)
+        temp[:, :, dataset.pad:-dataset.pad, dataset.pad:-dataset.pad] = video
+        i, j = np.random.randint(0, 2 * dataset.pad, 2)
+        video = temp[:, :, i:(i + h), j:(j + w)]
+
+    return video, target
+
+
+@pytest.mark.parametrize("kwargs", [
+    dict(),
+    dict(mean=np.array([10., 20., 30.]), std=np.array([2., 3., 4.]), length=8, period=3, clips=3),
+    dict(mean=5., std=2., length=None, period=1, max_length=20),
+    dict(mean=np.array([10., 20., 30.]), std=np.array([2., 3., 4.]), length=32, period=2, pad=12),
+    dict(length=8, period=4, clips="all"),
+])
+def test_getitem_matches_loop(data_dir, kwargs):
+    kwargs = dict(dict(mean=0., std=1.), **kwargs)
+    dataset = echonet.datasets.Echo(root=data_dir, split="all", target_type=["EF", "LargeFrame", "SmallFrame"], **kwargs)
+    for i in range(len(dataset)):
+        np.random.seed(i)
+        (expected, expected_target) = getitem_loop(dataset, i)
+        np.random.seed(i)
+        (video, target) = dataset[i]
+
+        assert video.dtype == np.float32
+        np.testing.assert_allclose(video, expected, rtol=1e-6, atol=1e-6)
+        for (t, e) in zip(target, expected_target):
+            np.testing.assert_allclose(t, e, rtol=1e-6, atol=1e-6)
+
+
+def test_noise(data_dir):
+    kwargs = dict(root=data_dir, split="all", length=None, period=1)
+    clean = echonet.datasets.Echo(**kwargs)
+    noisy = echonet.datasets.Echo(noise=0.3, noise_seed=5, **kwargs)
+
+    np.random.seed(0)
+    (video, _) = clean[0]
+    np.random.seed(0)
+    (blacked, _) = noisy[0]
+
+    # Pixels are blacked out in all channels at once, with probability ``noise''
+    mask = (blacked == 0).all(0)
+    assert abs(mask.mean() - 0.3) < 0.01
+    np.testing.assert_array_equal(blacked[:, ~mask], video[:, ~mask])
+
+    # With a seed, each video always gets the same noise, but videos get different noise
+    np.random.seed(1)
+    np.testing.assert_array_equal(noisy[0][0] == 0, noisy[0][0] == 0)
+    assert not np.array_equal(noisy[0][0] == 0, noisy[1][0] == 0)
+    np.random.seed(0)
+    np.testing.assert_array_equal(noisy[0][0], blacked)
+
+    # Without a seed, the noise follows np.random
+    unseeded = echonet.datasets.Echo(noise=0.3, **kwargs)
+    np.random.seed(0)
+    first = unseeded[0][0]
+    assert not np.array_equal(first == 0, unseeded[0][0] == 0)
+    np.random.seed(0)
+    np.testing.assert_array_equal(unseeded[0][0], first)
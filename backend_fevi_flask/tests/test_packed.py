@@ -0,0 +1,53 @@
+"""Tests for ``echonet pack'' and ``Echo(packed=...)''."""
+
+import os
+
+import numpy as np
+import pytest
+
+import echonet
+
+
+@pytest.fixture(scope="module")
+def packed_dir(data_dir, tmp_path_factory):
+    output = str(tmp_path_factory.mktemp("packed"))
+    echonet.utils.pack.run.callback(data_dir=data_dir, output=output, num_workers=0)
+    return output
+
+
+def test_pack_skips_untraced_videos(packed_dir):
+    packed = echonet.datasets.PackedVideos(packed_dir)
+    assert sorted(packed.fnames) == ["A.avi", "B.avi", "C.avi"]
+
+
+@pytest.mark.parametrize("split", ["all", "train", "val"])
+def test_packed_matches_videos(data_dir, packed_dir, split):
+    # D.avi has no traces: it is not packed, and must not be reported missing
+    kwargs = dict(split=split, target_type=["EF", "LargeFrame", "SmallTrace"], length=8, period=2, clips="all")
+    videos = echonet.datasets.Echo(root=data_dir, **kwargs)
+    packed = echonet.datasets.Echo(root=data_dir, packed=packed_dir, **kwargs)
+
+    assert videos.fnames == packed.fnames
+    assert "D.avi" not in packed.fnames
+    for i in range(len(videos)):
+        (x, (ef, frame, trace)) = videos[i]
+        (y, (ef_packed, frame_packed, trace_packed)) = packed[i]
+        np.testing.assert_array_equal(x, y)
+        assert ef == ef_packed
+        np.testing.assert_array_equal(frame, frame_packed)
+        np.testing.assert_array_equal(trace, trace_packed)
+
+
+def test_packed_reports_missing_videos(data_dir, packed_dir, tmp_path):
+    # A traced video listed in FileList.csv but absent from the store is an error
+    broken = tmp_path / "broken"
+    broken.mkdir()
+    for name in ("index.npz", "videos.u8"):
+        os.symlink(os.path.join(packed_dir, name), str(broken / name))
+    with open(os.path.join(packed_dir, "FileList.csv")) as f:
+        lines = f.readlines()
+    lines.append(lines[-1].replace("C,", "E,", 1))
+    (broken / "FileList.csv").write_text("".join(lines))
+
+    with pytest.raises(FileNotFoundError):
+        echonet.datasets.Echo(root=data_dir, split="all", packed=str(broken))
@@ -0,0 +1,269 @@
+"""Tests for DeepCardioProcessor: analysis options and the TorchScript model cache."""
+
+import os
+
+import numpy as np
+import pandas
+import pytest
+import torch
+import torchvision
+
+import echonet
+from processor import DeepCardioProcessor, _mean_and_std
+
+
+@pytest.fixture(scope="module")
+def weights_dir(tmp_path_factory):
+    """Checkpoints of randomly initialized models, saved like the released weights."""
+    path = tmp_path_factory.mktemp("weights")
+    torch.manual_seed(0)
+    seg = torchvision.models.segmentation.deeplabv3_resnet50(weights=None, weights_backbone=None, aux_loss=False)
+    seg.classifier[-1] = torch.nn.Conv2d(seg.classifier[-1].in_channels, 1, kernel_size=seg.classifier[-1].kernel_size)
+    ef = torchvision.models.video.r2plus1d_18()
+    ef.fc = torch.nn.Linear(ef.fc.in_features, 1)
+    for (model, filename) in ((seg, "deeplabv3_resnet50_random.pt"), (ef, "r2plus1d_18_32_2_pretrained.pt")):
+        # Saved from torch.nn.DataParallel
+        torch.save({"state_dict": {"module." + k: v for (k, v) in model.state_dict().items()}}, str(path / filename))
+    echonet.utils.save_mean_and_std(str(path / DeepCardioProcessor.STATS_FILENAME), [30., 40., 50.], [45., 50., 55.])
+    return path
+
+
+@pytest.fixture(autouse=True)
+def _no_backbone_download(monkeypatch):
+    # The checkpoints hold every weight; do not download the ImageNet backbone
+    deeplabv3_resnet50 = torchvision.models.segmentation.deeplabv3_resnet50
+    monkeypatch.setattr(torchvision.models.segmentation, "deeplabv3_resnet50",
+                        lambda pretrained=False, **kwargs: deeplabv3_resnet50(weights=None, weights_backbone=None, **kwargs))
+
+
+@pytest.fixture
+def videos_dir(tmp_path):
+    path = tmp_path / "input"
+    path.mkdir()
+    rng = np.random.RandomState(0)
+    for (name, frames) in (("A.avi", 8), ("B.avi", 12)):
+        video = rng.randint(0, 256, (3, frames, 112, 112)).astype(np.uint8)
+        echonet.utils.savevideo(str(path / name), video, 50)
+    (path / "notes.txt").write_text("not a video")
+    return path
+
+
+def analyze(weights_dir, videos_dir, output_dir, **kwargs):
+    processor = DeepCardioProcessor(str(output_dir), str(weights_dir), str(output_dir / "output"), **kwargs)
+    progress = []
+    assert processor.process_videos(str(videos_dir), lambda p, message: progress.append(p))
+    assert progress[-1] == 100
+    return processor, pandas.read_csv(str(output_dir / "output" / "classification_results.csv"))
+
+
+@pytest.mark.parametrize("kwargs,clip,videos", [
+    (dict(), (3, 32, 112, 112), ["A.mp4", "B.mp4"]),
+    (dict(torchscript=False, ef_protocol="single", video_format="both", keep_frames=True, stats_mode="study"),
+     (3, 16, 112, 112), ["A.avi", "A.mp4", "A.npy", "B.avi", "B.mp4", "B.npy"]),
+])
+def test_process_videos(weights_dir, videos_dir, tmp_path, monkeypatch, kwargs, clip, videos):
+    loaded = []
+    loadvideo = echonet.utils.loadvideo
+
+    def record_load(filename, *args):
+        loaded.append(os.path.basename(filename))
+        return loadvideo(filename, *args)
+
+    clips = []
+    predict_ef = DeepCardioProcessor._predict_ef
+
+    def record_clips(self, ds):
+        clips.extend(np.shape(ds[i][0]) for i in range(len(ds)))
+        return predict_ef(self, ds)
+
+    monkeypatch.setattr(echonet.utils, "loadvideo", record_load)
+    monkeypatch.setattr(DeepCardioProcessor, "_predict_ef", record_clips)
+    processor, results = analyze(weights_dir, videos_dir, tmp_path, ef_clip_stride=8, **kwargs)
+
+    # Each video is decoded once for statistics, EF, segmentation and rendering
+    assert sorted(loaded) == ["A.avi", "B.avi"]
+    assert list(results["Filename"]) == ["A.avi", "B.avi"]
+    assert np.isfinite(results["EF_Model"]).all()
+    assert isinstance(processor.ef_model, torch.jit.ScriptModule) == kwargs.get("torchscript", True)
+
+    # "tta": the 32-frame clips of each video (one with this stride); "single": one 16-frame clip
+    if kwargs.get("ef_protocol", "tta") == "tta":
+        assert clips == [(1,) + clip] * 2
+    else:
+        assert clips == [clip] * 2
+
+    output = tmp_path / "output"
+    assert sorted(os.listdir(str(output / "videos"))) == videos
+    assert sorted(os.listdir(str(output / "labels"))) == ["A.npy", "B.npy"]
+    assert np.load(str(output / "labels" / "B.npy")).shape == (12, 112, 112)
+    if "B.npy" in videos:
+        assert np.load(str(output / "videos" / "B.npy")).shape == (3, 12, 224, 224)
+    assert len(pandas.read_csv(str(output / "size.csv"))) == 8 + 12
+
+
+@pytest.fixture
+def processor(tmp_path):
+    # Only the attributes used by _load_model (the constructor downloads weights)
+    processor = DeepCardioProcessor.__new__(DeepCardioProcessor)
+    processor.weights_dir = str(tmp_path)
+    processor.torchscript = True
+    processor.precision = "float32"
+    processor.channels_last = False
+    processor.device = torch.device("cpu")
+    (tmp_path / "model.pt").write_bytes(b"checkpoint")
+    return processor
+
+
+def load(processor, calls):
+    def loader():
+        calls.append(None)
+        torch.manual_seed(0)
+        return torch.nn.Linear(4, 2).eval()
+    return processor._load_model("m", loader, "https://example.com/model.pt", (1, 4), torch.contiguous_format)
+
+
+def exports(processor):
+    return sorted(os.listdir(os.path.join(processor.weights_dir, "torchscript")))
+
+
+def test_export_is_reused(processor):
+    calls = []
+    x = torch.randn(3, 4)
+    expected = load(processor, calls)(x)
+    module = load(processor, calls)
+    assert len(calls) == 1
+    assert isinstance(module, torch.jit.ScriptModule)
+    torch.testing.assert_close(module(x), expected)
+
+
+def test_torch_upgrade_exports_again(processor, monkeypatch):
+    calls = []
+    load(processor, calls)
+    (old,) = exports(processor)
+
+    monkeypatch.setattr(torch, "__version__", torch.__version__ + ".upgraded")
+    load(processor, calls)
+    assert len(calls) == 2
+    assert old in exports(processor) and len(exports(processor)) == 2
+
+
+def test_unreadable_export_is_replaced(processor):
+    calls = []
+    load(processor, calls)
+    (name,) = exports(processor)
+    with open(os.path.join(processor.weights_dir, "torchscript", name), "wb") as f:
+        f.write(b"not a TorchScript archive")
+
+    module = load(processor, calls)
+    assert len(calls) == 2
+    assert isinstance(module, torch.jit.ScriptModule)
+    assert isinstance(torch.jit.load(os.path.join(processor.weights_dir, "torchscript", name)), torch.jit.ScriptModule)
+
+
+@pytest.mark.parametrize("kwargs", [dict(precision="int8"), dict(stats_mode="batch"), dict(video_format="gif"),
+                                    dict(ef_protocol="all")])
+def test_invalid_options(tmp_path, kwargs):
+    # Options are checked before anything is downloaded or created
+    with pytest.raises(ValueError):
+        DeepCardioProcessor(str(tmp_path), str(tmp_path / "weights"), str(tmp_path / "output"), **kwargs)
+    assert os.listdir(tmp_path) == []
+
+
+def test_load_stats(processor):
+    processor.stats_mode = "fixed"
+    path = os.path.join(processor.weights_dir, DeepCardioProcessor.STATS_FILENAME)
+    echonet.utils.save_mean_and_std(path, [1., 2., 3.], [4., 5., 6.])
+    (mean, std) = processor._load_stats()
+    np.testing.assert_array_equal(mean, [1., 2., 3.])
+    np.testing.assert_array_equal(std, [4., 5., 6.])
+
+    # Without the precomputed file, statistics are computed for each study
+    os.remove(path)
+    assert processor._load_stats() == (None, None)
+    assert processor.stats_mode == "study"
+
+
+def test_study_stats():
+    rng = np.random.RandomState(0)
+    videos = [rng.randint(0, 256, (3, frames, 8, 8)).astype(np.uint8) for frames in (2, 5)]
+    x = np.concatenate([v.reshape(3, -1) for v in videos], 1).astype(np.float64)
+    (mean, std) = _mean_and_std(videos)
+    np.testing.assert_allclose(mean, x.mean(1), rtol=1e-6)
+    np.testing.assert_allclose(std, x.std(1), rtol=1e-5)
+
+
+def test_reduced_precision_models(processor):
+    # Reduced precision runs the PyTorch model under autocast, without TorchScript
+    processor.precision = "bfloat16"
+    processor.channels_last = True
+    calls = []
+    model = load(processor, calls)
+    assert not isinstance(model, torch.jit.ScriptModule)
+    assert not os.path.exists(os.path.join(processor.weights_dir, "torchscript"))
+    assert processor._run_model(model, torch.randn(3, 4), torch.contiguous_format).dtype == torch.bfloat16
+
+    conv = processor._prepare_model(torch.nn.Conv2d(3, 4, 3), torch.channels_last)
+    assert conv.weight.is_contiguous(memory_format=torch.channels_last)
+    x = torch.randn(2, 3, 8, 8)
+    y = processor._run_model(conv, x, torch.channels_last)
+    torch.testing.assert_close(y.float(), conv(x), atol=0.1, rtol=0.05)
+
+
+def test_precision_check_falls_back_to_float32(weights_dir, videos_dir, tmp_path, monkeypatch):
+    os.remove(str(videos_dir / "B.avi"))
+    results = []
+    check_precision = DeepCardioProcessor.check_precision
+
+    def record(self, *args, **kwargs):
+        results.append((self.precision, self.channels_last, check_precision(self, *args, **kwargs)))
+        return results[-1][2]
+
+    monkeypatch.setattr(DeepCardioProcessor, "check_precision", record)
+    processor = DeepCardioProcessor(str(tmp_path), str(weights_dir), str(tmp_path / "output"), precision="bfloat16",
+                                    channels_last=True, reference_folder=str(videos_dir), max_ef_error=-1.)
+
+    # The check runs the configured precision against float32, then float32 is kept
+    ((precision, channels_last, result),) = results
+    assert (precision, channels_last) == ("bfloat16", True)
+    assert result["videos"] == 1
+    assert result["ef_max_error"] >= result["ef_mean_error"] >= 0
+    assert 0 <= result["dice"] <= 1
+    assert (processor.precision, processor.channels_last) == ("float32", False)
+    assert processor.seg_model.training is False and processor.ef_model.training is False
+
+
+def render_video_loop(img, size_norm, peaks):
+    # Reference: the pixel-by-pixel drawing of the original process_videos
+    for (t, y_val) in enumerate(size_norm):
+        x = int(round(t / len(size_norm) * 200 + 10))
+        y = int(round(115 + 100 * y_val))
+        for a in range(-1, 2):
+            for b in range(-1, 2):
+                if 0 <= y + a < img.shape[2] and 0 <= x + b < img.shape[3]:
+                    img[:, :, y + a, x + b] = 255.
+    for (t, y_val) in enumerate(size_norm):
+        x = int(round(t / len(size_norm) * 200 + 10))
+        y = int(round(115 + 100 * y_val))
+        for a in range(-3, 4):
+            for b in range(-3, 4):
+                if 0 <= y + a < img.shape[2] and 0 <= x + b < img.shape[3]:
+                    img[:, t, y + a, x + b] = (255., 0., 0.)
+        if t in peaks and 0 <= x < img.shape[3]:
+            img[:, :, 200:225, x] = np.array([255., 255., 0.])[:, None, None]
+
+
+@pytest.mark.parametrize("frames,peaks", [(40, {5, 20, 39}), (150, {0, 149}), (60, set())])
+def test_render_video_matches_loop(frames, peaks):
+    rng = np.random.RandomState(frames)
+    video = rng.randint(0, 256, (3, frames, 112, 112)).astype(np.uint8)
+    logit = rng.normal(size=(frames, 112, 112)).astype(np.float32)
+    size_norm = rng.uniform(size=frames)
+    size_norm[0] = 1.
+
+    expected = echonet.utils.render.side_by_side(np.broadcast_to(video[:1], video.shape), logit > 0, (0, 1))
+    expected = expected.astype(np.float32)
+    render_video_loop(expected, size_norm, peaks)
+
+    img = DeepCardioProcessor._render_video(video, logit, size_norm, peaks)
+    assert img.dtype == np.uint8
+    np.testing.assert_array_equal(img, expected.astype(np.uint8))
@@ -0,0 +1,111 @@
+"""Tests for ``echonet.utils.render''."""
+
+import numpy as np
+import pytest
+import skimage.draw
+
+import echonet
+from echonet.utils import render
+
+
+def offsets(stencil):
+    return set(zip(*stencil.tolist()))
+
+
+def test_stencils():
+    assert offsets(render.square(0)) == {(0, 0)}
+    assert offsets(render.square(2)) == {(i, j) for i in range(-2, 3) for j in range(-2, 3)}
+    assert offsets(render.disk(4.1)) == set(zip(*skimage.draw.disk((0, 0), 4.1)))
+    np.testing.assert_array_equal(render.dashes(115, 160), [r for r in range(115, 160) if (r - 115) % 20 < 10])
+
+    # Stencils are cached and shared, so they cannot be modified
+    assert render.square(2) is render.square(2)
+    with pytest.raises(ValueError):
+        render.disk(4.1)[0, 0] = 1
+
+
+@pytest.mark.parametrize("frames", [None, np.array([0, 1, 2, 5])])
+def test_stamp_matches_loop(frames):
+    rows = np.array([0, 5, 9, 3])
+    cols = np.array([1, 9, 4, -1])
+    color = np.array([10, 20, 30], np.uint8)
+    stencil = render.disk(2.5)
+
+    canvas = np.zeros((3, 4, 10, 10), np.uint8)
+    render.stamp(canvas, rows, cols, stencil, color, frames=frames)
+
+    expected = np.zeros_like(canvas)
+    for (k, (r, c)) in enumerate(zip(rows, cols)):
+        for (dr, dc) in zip(*stencil):
+            if 0 <= r + dr < 10 and 0 <= c + dc < 10:
+                if frames is None:
+                    expected[:, :, r + dr, c + dc] = color[:, None]
+                elif frames[k] < 4:
+                    expected[:, frames[k], r + dr, c + dc] = color
+    np.testing.assert_array_equal(canvas, expected)
+
+
+def test_vline():
+    canvas = np.zeros((3, 4, 10, 10), np.float32)
+    render.vline(canvas, [2, 7, 12], slice(3, 8), 255., frames=slice(1, 3))
+    expected = np.zeros_like(canvas)
+    expected[:, 1:3, 3:8, 2] = 255.
+    expected[:, 1:3, 3:8, 7] = 255.
+    np.testing.assert_array_equal(canvas, expected)
+
+    canvas[...] = 0
+    render.vline(canvas, 4, render.dashes(0, 30, 2, 3), (1, 2, 3))
+    expected[...] = 0
+    expected[:, :, [0, 1, 5, 6], 4] = np.array([1, 2, 3])[:, None, None]
+    np.testing.assert_array_equal(canvas, expected)
+
+
+def test_side_by_side():
+    video = np.random.RandomState(0).randint(0, 256, (3, 2, 4, 4)).astype(np.uint8)
+    mask = np.zeros((2, 4, 4), bool)
+    mask[0, 1, 1] = True
+
+    canvas = render.side_by_side(video, mask, channels=(0, 1))
+    assert canvas.shape == (3, 2, 8, 8) and canvas.dtype == np.uint8
+    np.testing.assert_array_equal(canvas[:, :, :4, :4], video)
+    np.testing.assert_array_equal(canvas[:, :, 4:, :], 0)
+
+    expected = video.copy()
+    expected[:2, 0, 1, 1] = 255
+    np.testing.assert_array_equal(canvas[:, :, :4, 4:], expected)
+
+
+def test_curve():
+    rows, cols = render.curve([0., 0.5, 1.])
+    np.testing.assert_array_equal(rows, [115, 165, 215])
+    np.testing.assert_array_equal(cols, [10, 77, 143])
+
+
+def draw_size_loop(video, size, systole, large_index, small_index):
+    # Reference: the frame-by-frame drawing of echonet.utils.segmentation.run
+    video = video.transpose(1, 0, 2, 3)
+    d = np.array([r for r in range(115, 224) if (r - 115) % 20 < 10])
+    for (f, s) in enumerate(size):
+        video[:, :, int(round(115 + 100 * s)), int(round(f / len(size) * 200 + 10))] = 255.
+        if f in systole:
+            video[:, :, 115:224, int(round(f / len(size) * 200 + 10))] = 255.
+        if f == large_index:
+            video[:, :, d, int(round(f / len(size) * 200 + 10))] = np.array([0, 225, 0]).reshape((1, 3, 1))
+        if f == small_index:
+            video[:, :, d, int(round(f / len(size) * 200 + 10))] = np.array([0, 0, 225]).reshape((1, 3, 1))
+        r, c = skimage.draw.disk((int(round(115 + 100 * s)), int(round(f / len(size) * 200 + 10))), 4.1)
+        video[f, :, r, c] = 255.
+
+
+@pytest.mark.parametrize("frames,large_index,small_index", [(60, 30, 31), (60, 10, 10), (150, 149, 0), (40, 5, 40)])
+def test_draw_size_matches_loop(frames, large_index, small_index):
+    rng = np.random.RandomState(frames)
+    video = rng.uniform(0, 255, (3, frames, 112, 112)).astype(np.float32)
+    canvas = render.side_by_side(video, rng.uniform(size=(frames, 112, 112)) > 0.5)
+    size = rng.uniform(size=frames)
+    systole = {3, frames // 2, frames - 1}
+
+    expected = canvas.copy()
+    draw_size_loop(expected, size, systole, large_index, small_index)
+    echonet.utils.segmentation._draw_size(canvas, size, systole, large_index, small_index)
+    np.testing.assert_array_equal(canvas, expected)
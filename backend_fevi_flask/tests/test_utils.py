@@ -0,0 +1,303 @@
+"""Tests for ``echonet.utils''."""
+
+import os
+import subprocess
+import sys
+import threading
+
+import click.testing
+import cv2
+import numpy as np
+import pytest
+import sklearn.metrics
+import torch
+
+import echonet
+
+
+def test_select_clips():
+    np.testing.assert_array_equal(echonet.utils.select_clips(5), [0, 1, 2, 3, 4])
+    np.testing.assert_array_equal(echonet.utils.select_clips(10, stride=4), [0, 4, 8])
+    np.testing.assert_array_equal(echonet.utils.select_clips(100, max_clips=3), [0, 50, 99])
+    np.testing.assert_array_equal(echonet.utils.select_clips(10, stride=2, max_clips=2), [0, 8])
+
+
+def test_select_clips_starts():
+    # Candidates are sorted, deduplicated and restricted to the video; stride does not apply
+    np.testing.assert_array_equal(echonet.utils.select_clips(10, stride=4, starts=[7, -1, 3, 3, 12]), [3, 7])
+    np.testing.assert_array_equal(echonet.utils.select_clips(10, starts=[1, 2, 4, 8, 9], max_clips=3), [1, 4, 9])
+    # Without candidates in the video, starts are taken every ``stride'' frames
+    np.testing.assert_array_equal(echonet.utils.select_clips(6, stride=3, starts=[20]), [0, 3])
+    np.testing.assert_array_equal(echonet.utils.select_clips(6, stride=3, starts=[]), [0, 3])
+
+
+@pytest.fixture
+def video_file(tmp_path):
+    filename = str(tmp_path / "video.avi")
+    echonet.utils.savevideo(filename, np.random.RandomState(0).randint(0, 256, (3, 60, 16, 16)).astype(np.uint8), 50)
+    return filename
+
+
+@pytest.mark.parametrize("start,stop,step,grabbed", [(0, None, 1, 0), (2, 50, 5, 38), (3, None, 40, 3),
+                                                     (20, 21, 1, 0), (0, None, 17, 48)])
+def test_loadvideo_skips_frames(video_file, monkeypatch, start, stop, step, grabbed):
+    expected = echonet.utils.loadvideo(video_file)[:, start:stop:step]
+
+    grabs = []
+    video_capture = cv2.VideoCapture
+
+    class Capture(object):
+        # Wraps (subclasses of cv2.VideoCapture crash when redefined)
+        def __init__(self, filename):
+            self.capture = video_capture(filename)
+
+        def __getattr__(self, name):
+            return getattr(self.capture, name)
+
+        def grab(self):
+            grabs.append(None)
+            return self.capture.grab()
+
+    # Gaps of more than 16 frames are skipped by seeking instead of grabbing every frame
+    monkeypatch.setattr(echonet.utils.cv2, "VideoCapture", Capture)
+    np.testing.assert_array_equal(echonet.utils.loadvideo(video_file, start, stop, step), expected)
+    assert len(grabs) == grabbed
+
+
+def test_video_reader(video_file):
+    expected = echonet.utils.loadvideo(video_file)
+    with echonet.utils.VideoReader(video_file) as reader:
+        assert reader.shape == echonet.utils.videoshape(video_file) == expected.shape
+        np.testing.assert_array_equal(reader.loadvideo(40, 50, 3), expected[:, 40:50:3])
+        # Frames before the current position are read by seeking back
+        np.testing.assert_array_equal(reader.loadvideo(5, 8), expected[:, 5:8])
+        np.testing.assert_array_equal(np.stack(list(reader.iterframes(55))).transpose(3, 0, 1, 2), expected[:, 55:])
+
+
+def bootstrap_loop(a, b, func, samples):
+    # Reference: one np.random.choice resample at a time
+    a, b = np.array(a), np.array(b)
+    bootstraps = sorted(func(a[ind], b[ind]) for ind in (np.random.choice(len(a), len(a)) for _ in range(samples)))
+    return func(a, b), bootstraps[round(0.05 * len(bootstraps))], bootstraps[round(0.95 * len(bootstraps))]
+
+
+def median_error(a, b):
+    return np.median(a - b)
+
+
+@pytest.mark.parametrize("func", [sklearn.metrics.r2_score, sklearn.metrics.mean_absolute_error,
+                                  sklearn.metrics.mean_squared_error, echonet.utils.dice_similarity_coefficient,
+                                  median_error])
+def test_bootstrap_matches_loop(func):
+    rng = np.random.RandomState(0)
+    a = rng.uniform(20, 80, 50)
+    b = a + rng.normal(0, 5, 50)
+
+    np.random.seed(1)
+    expected = bootstrap_loop(a, b, func, 500)
+    np.random.seed(1)
+    result = echonet.utils.bootstrap(a, b, func, samples=500, chunk_size=128)
+    np.testing.assert_allclose(result, expected, rtol=1e-10)
+
+
+def test_bootstrap_constant_targets():
+    # r2_score of constant targets is 1 if predicted perfectly and 0 otherwise
+    a = np.full(5, 3.)
+    np.random.seed(0)
+    assert echonet.utils.bootstrap(a, a, sklearn.metrics.r2_score, samples=20)[1:] == (1., 1.)
+    np.random.seed(0)
+    assert echonet.utils.bootstrap(a, a + 1, sklearn.metrics.r2_score, samples=20)[1:] == (0., 0.)
+
+
+def test_bootstrap_workers():
+    a = np.arange(20.)
+    b = a[::-1].copy()
+    np.random.seed(2)
+    expected = echonet.utils.bootstrap(a, b, median_error, samples=100)
+    np.random.seed(2)
+    assert echonet.utils.bootstrap(a, b, median_error, samples=100, chunk_size=30, num_workers=2) == expected
+
+
+def test_background_encoder_runs_in_order():
+    calls = []
+    with echonet.utils.BackgroundEncoder() as encoder:
+        for i in range(5):
+            encoder.submit(calls.append, i)
+    assert calls == [0, 1, 2, 3, 4]
+
+
+def test_background_encoder_bounds_pending_calls():
+    release = threading.Event()
+    encoder = echonet.utils.BackgroundEncoder(max_pending=1)
+    encoder.submit(release.wait)
+    encoder.submit(lambda: None)  # waits in the queue
+
+    blocked = threading.Thread(target=encoder.submit, args=(lambda: None,))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    release.set()
+    blocked.join(5)
+    assert not blocked.is_alive()
+    encoder.close()
+
+
+def test_background_encoder_propagates_errors():
+    calls = []
+
+    def fail():
+        raise ValueError("disk full")
+
+    encoder = echonet.utils.BackgroundEncoder()
+    encoder.submit(fail)
+    encoder.submit(calls.append, 1)  # skipped after the error
+    with pytest.raises(ValueError, match="disk full"):
+        encoder.close()
+    assert calls == []
+    with pytest.raises(ValueError, match="disk full"):
+        encoder.submit(calls.append, 2)
+
+    # An error raised in the ``with'' block is not masked by the encoder's
+    with pytest.raises(KeyError):
+        with echonet.utils.BackgroundEncoder() as encoder:
+            encoder.submit(fail)
+            raise KeyError("block")
+
+
+def test_stats_command(data_dir, tmp_path):
+    output = str(tmp_path / "weights" / "stats.npz")
+    result = click.testing.CliRunner().invoke(echonet.main, ["stats", "--data_dir", data_dir, "--output", output,
+                                                             "--num_workers", "0", "--seed", "3"])
+    assert result.exit_code == 0, result.output
+
+    np.random.seed(3)
+    torch.manual_seed(3)
+    expected = echonet.utils.get_mean_and_std(echonet.datasets.Echo(root=data_dir, split="train"),
+                                              samples=None, num_workers=0)
+    (mean, std) = echonet.utils.load_mean_and_std(output)
+    assert mean.dtype == std.dtype == np.float32 and mean.shape == std.shape == (3,)
+    np.testing.assert_array_equal(mean, expected[0])
+    np.testing.assert_array_equal(std, expected[1])
+
+
+class TinySegmentation(torch.nn.Module):
+    # Stands in for deeplabv3; without batch normalization, samples do not interact
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(3, 1, 3, padding=1)
+
+    def forward(self, x):
+        return {"out": self.conv(x)}
+
+
+def run_epoch_loop(model, dataloader, train, optim):
+    # Reference: losses and intersections/unions moved to the cpu for each frame type
+    total = 0.
+    n = 0
+    lists = [[], [], [], []]
+    model.train(train)
+    with torch.set_grad_enabled(train):
+        for (_, (large_frame, small_frame, large_trace, small_trace)) in dataloader:
+            y_large = model(large_frame)["out"]
+            y_small = model(small_frame)["out"]
+            loss = 0
+            for (k, (y, trace)) in enumerate(((y_large, large_trace), (y_small, small_trace))):
+                loss += torch.nn.functional.binary_cross_entropy_with_logits(y[:, 0, :, :], trace, reduction="sum") / 2
+                pred = y[:, 0, :, :].detach().numpy() > 0.
+                truth = trace.numpy() > 0.
+                lists[2 * k].extend(np.logical_and(pred, truth).sum((1, 2)))
+                lists[2 * k + 1].extend(np.logical_or(pred, truth).sum((1, 2)))
+            if train:
+                optim.zero_grad()
+                loss.backward()
+                optim.step()
+            total += loss.item()
+            n += large_trace.size(0)
+    return (total / n / 112 / 112,) + tuple(np.array(x) for x in lists)
+
+
+@pytest.mark.parametrize("train", [False, True])
+@pytest.mark.parametrize("fuse_frames", [False, True])
+def test_segmentation_run_epoch(data_dir, train, fuse_frames):
+    dataset = echonet.datasets.Echo(root=data_dir, split="all", keyframes=True, mean=np.array([128., 128., 128.]),
+                                    std=np.array([64., 64., 64.]),
+                                    target_type=["LargeFrame", "SmallFrame", "LargeTrace", "SmallTrace"])
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=2)
+
+    results = []
+    for run in (run_epoch_loop, echonet.utils.segmentation.run_epoch):
+        torch.manual_seed(0)
+        model = TinySegmentation()
+        optim = torch.optim.SGD(model.parameters(), lr=1e-5)
+        if run is run_epoch_loop:
+            results.append(run(model, dataloader, train, optim))
+        else:
+            results.append(run(model, dataloader, train, optim, torch.device("cpu"), fuse_frames=fuse_frames))
+        results.append(model.conv.weight.detach().clone())
+
+    (expected, expected_weight, result, weight) = results
+    np.testing.assert_allclose(result[0], expected[0], rtol=1e-5)
+    for (r, e) in zip(result[1:], expected[1:]):
+        np.testing.assert_array_equal(r, e)
+        assert len(r) == len(dataset)
+    torch.testing.assert_close(weight, expected_weight)
+
+
+def test_segmentation_fused_forward(data_dir):
+    # With fuse_frames, the large and small frames of a batch go through the model together
+    dataset = echonet.datasets.Echo(root=data_dir, split="all", keyframes=True,
+                                    target_type=["LargeFrame", "SmallFrame", "LargeTrace", "SmallTrace"])
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=3)
+    batches = []
+
+    class Recorder(TinySegmentation):
+        def forward(self, x):
+            batches.append(x.shape[0])
+            return super().forward(x)
+
+    echonet.utils.segmentation.run_epoch(Recorder(), dataloader, False, None, torch.device("cpu"), fuse_frames=True)
+    assert batches == [6]
+    echonet.utils.segmentation.run_epoch(Recorder(), dataloader, False, None, torch.device("cpu"))
+    assert batches == [6, 3, 3]
+
+
+def run_python(*args):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(echonet.__file__))))
+    result = subprocess.run([sys.executable] + list(args), env=env, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def test_lazy_imports():
+    heavy = "[m for m in ('torch', 'torchvision', 'sklearn', 'matplotlib') if m in sys.modules]"
+    output = run_python("-c", "; ".join([
+        "import sys",
+        "import echonet",
+        "print(echonet.config is not None, {})".format(heavy),
+        "import echonet.utils, echonet.datasets",
+        "print('echonet.utils.video' in sys.modules, 'echonet.datasets.echo' in sys.modules, {})".format(heavy),
+        "print(echonet.datasets.Echo.__name__, callable(echonet.utils.video.run), 'torch' in sys.modules)",
+        "print('datasets' in dir(echonet), 'video' in dir(echonet.utils), 'Echo' in dir(echonet.datasets))",
+    ])).split("\n")
+    assert output[:4] == ["True []", "False False []", "Echo True True", "True True True"]
+
+
+def test_lazy_cli():
+    # Commands are listed without being imported
+    output = run_python("-c", "; ".join([
+        "import sys",
+        "import click.testing",
+        "import echonet",
+        "result = click.testing.CliRunner().invoke(echonet.main, ['--help'])",
+        "print(result.exit_code, 'torch' in sys.modules)",
+        "print(result.output)",
+    ]))
+    assert output.startswith("0 False\n")
+    for command in ("pack", "segmentation", "stats", "video"):
+        assert "\n  {} ".format(command) in output
+
+    # A command is imported when invoked
+    output = run_python("-m", "echonet", "segmentation", "--help")
+    assert "--data_dir" in output and "--fuse_frames" in output
+    with pytest.raises(AssertionError, match="No such command"):
+        run_python("-m", "echonet", "unknown")
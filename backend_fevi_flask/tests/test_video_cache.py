@@ -0,0 +1,81 @@
+"""Tests for ``echonet.datasets.VideoCache''."""
+
+import os
+import pickle
+
+import numpy as np
+
+import echonet
+
+
+def write_videos(path, n, frames=10):
+    filenames = []
+    for i in range(n):
+        filename = str(path / "{}.avi".format(i))
+        video = np.random.RandomState(i).randint(0, 256, (3, frames, 16, 16)).astype(np.uint8)
+        echonet.utils.savevideo(filename, video, 50)
+        filenames.append(filename)
+    return filenames
+
+
+def test_matches_loadvideo(tmp_path):
+    (filename,) = write_videos(tmp_path, 1)
+    cache = echonet.datasets.VideoCache()
+    np.testing.assert_array_equal(cache.loadvideo(filename), echonet.utils.loadvideo(filename))
+    np.testing.assert_array_equal(cache.loadvideo(filename, 2, 8, 3), echonet.utils.loadvideo(filename)[:, 2:8:3])
+    assert cache.videoshape(filename) == echonet.utils.videoshape(filename)
+
+
+def test_lru_eviction(tmp_path):
+    filenames = write_videos(tmp_path, 3)
+    size = echonet.utils.loadvideo(filenames[0]).nbytes
+    cache = echonet.datasets.VideoCache(2 * size)
+
+    cache.loadvideo(filenames[0])
+    cache.loadvideo(filenames[1])
+    cache.loadvideo(filenames[0])  # 1 is now the least recently used
+    cache.loadvideo(filenames[2])
+    assert len(cache) == 2
+    assert cache.nbytes == 2 * size
+    assert list(cache._videos) == [cache._key(filenames[0]), cache._key(filenames[2])]
+
+    # Videos larger than the budget are not kept
+    small = echonet.datasets.VideoCache(size - 1)
+    small.loadvideo(filenames[0])
+    assert len(small) == 0
+
+
+def test_disk_tier(tmp_path, monkeypatch):
+    (filename,) = write_videos(tmp_path, 1)
+    cache_dir = str(tmp_path / "cache")
+    expected = echonet.datasets.VideoCache(0, cache_dir).loadvideo(filename)
+
+    # A second cache (e.g. in another process) reads the video from disk
+    calls = []
+    monkeypatch.setattr(echonet.utils, "loadvideo", lambda *args, **kwargs: calls.append(args))
+    video = echonet.datasets.VideoCache(0, cache_dir).loadvideo(filename)
+    np.testing.assert_array_equal(video, expected)
+    assert calls == []
+
+
+def test_modified_video_is_decoded_again(tmp_path):
+    (filename,) = write_videos(tmp_path, 1)
+    cache = echonet.datasets.VideoCache(cache_dir=str(tmp_path / "cache"))
+    cache.loadvideo(filename)
+
+    video = np.zeros((3, 5, 16, 16), np.uint8)
+    echonet.utils.savevideo(filename, video, 50)
+    os.utime(filename, ns=(0, 1))
+    assert cache.loadvideo(filename).shape == (3, 5, 16, 16)
+
+
+def test_pickle_drops_memory_tier(tmp_path):
+    (filename,) = write_videos(tmp_path, 1)
+    cache = echonet.datasets.VideoCache()
+    cache.loadvideo(filename)
+
+    copy = pickle.loads(pickle.dumps(cache))
+    assert len(copy) == 0
+    assert copy.max_bytes == cache.max_bytes
+    copy.loadvideo(filename)
+    assert len(copy) == 1